@@ -0,0 +1,277 @@
+"""
+In-process WebSocket load benchmarks (run by the `ws_benchmark` command).
+
+Each scenario connects N clients to one room of a consumer through Channels'
+WebsocketCommunicator, has some of them send tracked messages (chat
+messages, edit ops, terminal output) while every client adds presence noise
+(typing, cursors, pings), and measures:
+
+  - fan-out latency: send to delivery at every other client (p50/p99)
+  - frames per second delivered to all clients
+  - DB queries per tracked message on the request path, plus the queries
+    spent afterwards on disconnects and flushing write-behind buffers
+
+Rounds, senders and noise come from a seeded RNG so runs are repeatable.
+"""
+import asyncio
+import random
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+
+from .execution_logs import percentile
+
+DRAIN_TIMEOUT = 10  # Seconds to wait for the last deliveries
+
+
+class QueryCounter:
+    """connection.execute_wrapper that counts queries"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class BenchmarkClient:
+    def __init__(self, index, user, communicator):
+        self.index = index
+        self.user = user
+        self.communicator = communicator
+        self.frames = 0
+        self.seq = 0  # Last sequence seen (collaborative sessions)
+        self.reader = None
+
+
+class Scenario:
+    """One consumer under load; subclasses create the room and describe its traffic"""
+
+    name = None
+
+    def setup(self, clients):
+        """Create the room and `clients` users in the database; returns the users"""
+        raise NotImplementedError
+
+    def path(self):
+        raise NotImplementedError
+
+    def tracked(self, client, key):
+        """Message whose delivery to the other clients is timed, tagged with `key`"""
+        raise NotImplementedError
+
+    def noise(self, client, rng):
+        """Presence-style traffic sent alongside; not timed"""
+        raise NotImplementedError
+
+    def key_of(self, message):
+        """The tracking key of a delivered message, or None"""
+        raise NotImplementedError
+
+    def observe(self, client, message):
+        """Update client state from a delivered message"""
+
+    def _users(self, prefix, count):
+        from django.contrib.auth.models import User
+
+        # No passwords: hashing hundreds of them would dominate setup
+        User.objects.bulk_create([User(username=f'{prefix}{n}') for n in range(count)])
+        return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+class ChatScenario(Scenario):
+    name = 'chat'
+
+    def setup(self, clients):
+        from .models import Server, ServerChannel, ServerMember
+
+        users = self._users('bench_chat_', clients)
+        server = Server.objects.create(name='Benchmark', owner=users[0])
+        ServerMember.objects.bulk_create([
+            ServerMember(server=server, user=user, role='owner' if n == 0 else 'member')
+            for n, user in enumerate(users)
+        ], ignore_conflicts=True)
+        self.channel = ServerChannel.objects.create(server=server, name='bench')
+        return users
+
+    def path(self):
+        return f'/ws/server/channel/{self.channel.channel_id}/'
+
+    def tracked(self, client, key):
+        return {'type': 'new_message', 'content': f'bench {key}'}
+
+    def noise(self, client, rng):
+        return {'type': rng.choice(['typing_start', 'typing_end'])}
+
+    def key_of(self, message):
+        if message.get('type') == 'new_message' and message.get('message'):
+            return message['message']['content'].split(' ', 1)[1]
+        return None
+
+
+class CollabScenario(Scenario):
+    name = 'collab'
+
+    def setup(self, clients):
+        from .models import SessionMember, SharedCode
+
+        users = self._users('bench_collab_', clients)
+        self.session = SharedCode.objects.create(
+            user=users[0], title='Benchmark', code_content='', session_type='collaborative',
+            session_state={'code': ''}
+        )
+        SessionMember.objects.bulk_create([
+            SessionMember(session=self.session, user=user, permission='edit') for user in users[1:]
+        ])
+        return users
+
+    def path(self):
+        return f'/ws/python/code/{self.session.share_id}/'
+
+    def tracked(self, client, key):
+        return {'type': 'op', 'base_seq': client.seq, 'client_id': key,
+                'ops': [{'type': 'insert', 'pos': 0, 'text': 'x'}]}
+
+    def noise(self, client, rng):
+        return {'type': 'cursor', 'position': {'row': rng.randrange(100), 'column': rng.randrange(80)}}
+
+    def key_of(self, message):
+        return message.get('client_id') if message.get('type') == 'op' else None
+
+    def observe(self, client, message):
+        if message.get('type') in ('op', 'ack', 'resync') and message.get('seq'):
+            client.seq = max(client.seq, message['seq'])
+
+
+class TerminalScenario(Scenario):
+    name = 'terminal'
+
+    def setup(self, clients):
+        from .models import IDEProject
+
+        # Terminal sockets belong to the project owner; each client is another tab
+        owner = self._users('bench_terminal_', 1)[0]
+        self.project = IDEProject.objects.create(user=owner, name='Benchmark')
+        return [owner] * clients
+
+    def path(self):
+        return f'/ws/ide/terminal/{self.project.project_id}/'
+
+    def tracked(self, client, key):
+        return {'type': 'output', 'output': f'bench {key}\n'}
+
+    def noise(self, client, rng):
+        return {'type': 'ping'}
+
+    def key_of(self, message):
+        if message.get('type') == 'output' and message.get('output', '').startswith('bench '):
+            return message['output'][6:-1]
+        return None
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (ChatScenario, CollabScenario, TerminalScenario)}
+
+
+def run_scenario(scenario, clients, rounds, senders, noise_per_round, seed=0):
+    """
+    Run one scenario against the current database (use a throwaway one) and
+    return its metrics dict. Must be called from synchronous code.
+    """
+    from asgiref.sync import async_to_sync
+    from .collab import live_sessions
+    from .counters import counters
+    from .routing import websocket_urlpatterns
+
+    users = scenario.setup(clients)
+    application = URLRouter(websocket_urlpatterns)
+    rng = random.Random(seed)
+    queries = QueryCounter()
+    sent_at = {}  # key -> (sender index, send time)
+    latencies = []
+    expected = {}  # key -> deliveries still to come
+
+    async def read(client):
+        while True:
+            message = await client.communicator.receive_json_from(timeout=3600)
+            client.frames += 1
+            scenario.observe(client, message)
+            key = scenario.key_of(message)
+            if key in expected and sent_at[key][0] != client.index:
+                latencies.append(time.perf_counter() - sent_at[key][1])
+                expected[key] -= 1
+                if not expected[key]:
+                    del expected[key]
+
+    async def run():
+        connect_times = []
+        bench_clients = []
+        for index, user in enumerate(users):
+            communicator = WebsocketCommunicator(application, scenario.path())
+            communicator.scope['user'] = user
+            started = time.perf_counter()
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Client {index} was refused by the {scenario.name} consumer')
+            connect_times.append(time.perf_counter() - started)
+            client = BenchmarkClient(index, user, communicator)
+            client.reader = asyncio.ensure_future(read(client))
+            bench_clients.append(client)
+        # Let join notifications settle before timing anything
+        await asyncio.sleep(0.2)
+        for client in bench_clients:
+            client.frames = 0
+
+        started = time.perf_counter()
+        queries_before = queries.count
+        tracked = 0
+        for round_number in range(rounds):
+            for client in rng.sample(bench_clients, min(senders, len(bench_clients))):
+                key = f'{round_number}-{client.index}'
+                expected[key] = len(bench_clients) - 1
+                sent_at[key] = (client.index, time.perf_counter())
+                await client.communicator.send_json_to(scenario.tracked(client, key))
+                tracked += 1
+            for client in rng.sample(bench_clients, min(noise_per_round, len(bench_clients))):
+                await client.communicator.send_json_to(scenario.noise(client, rng))
+            await asyncio.sleep(0)
+
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        frames = sum(client.frames for client in bench_clients)
+        traffic_queries, traffic_end = queries.count - queries_before, queries.count
+
+        for client in bench_clients:
+            client.reader.cancel()
+        await asyncio.gather(*(client.reader for client in bench_clients), return_exceptions=True)
+        for client in bench_clients:
+            await client.communicator.disconnect()
+        return tracked, frames, elapsed, traffic_queries, traffic_end, connect_times
+
+    # Consumers' database work runs on this thread while it waits in async_to_sync
+    with connection.execute_wrapper(queries):
+        tracked, frames, elapsed, traffic_queries, traffic_end, connect_times = async_to_sync(run)()
+        # Disconnect writes plus whatever the write-behind buffers still hold
+        live_sessions.flush()
+        counters.flush()
+        flush_queries = queries.count - traffic_end
+
+    latencies.sort()
+    connect_times.sort()
+    return {
+        'scenario': scenario.name,
+        'clients': clients,
+        'messages': tracked,
+        'deliveries': len(latencies),
+        'lost': sum(expected.values()),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'frames_per_sec': round(frames / elapsed, 1) if elapsed else None,
+        'queries_per_message': round(traffic_queries / tracked, 2) if tracked else None,
+        'flush_queries': flush_queries,
+        'connect_p50_ms': round(percentile(connect_times, 0.5) * 1000, 2),
+    }
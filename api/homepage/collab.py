@@ -0,0 +1,493 @@
+"""
+Operational transform for collaborative Python sessions.
+
+Clients send small edit operations against the last sequence number they
+have seen instead of the whole document:
+
+    {'type': 'insert', 'pos': 10, 'text': 'abc'}
+    {'type': 'delete', 'pos': 4, 'length': 2}
+
+The server transforms each incoming batch against the operations committed
+since the client's base and assigns it the next sequence number. Live session
+state is held in memory by `live_sessions` and written behind: each flush
+stores the new ops as small CollabOperation rows and the document in
+SharedCode.session_state ({'code', 'seq', 'terminal_output'}), pruning ops
+older than COLLAB_OPLOG_SIZE.
+"""
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .flushing import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidOperation(ValueError):
+    """Raised when an operation is malformed or does not fit the document"""
+
+
+class StaleBaseError(Exception):
+    """Raised when a client's base sequence is older than the retained operation log"""
+
+
+class SessionEnded(LookupError):
+    """Raised when a session that must already be live is not, e.g. it was ended meanwhile"""
+
+
+def insert_op(pos, text):
+    return {'type': 'insert', 'pos': pos, 'text': text}
+
+
+def delete_op(pos, length):
+    return {'type': 'delete', 'pos': pos, 'length': length}
+
+
+def validate_ops(ops):
+    """Return `ops` as a list of clean operation dicts; raises InvalidOperation"""
+    if not isinstance(ops, list):
+        raise InvalidOperation('ops must be a list')
+    clean = []
+    for op in ops:
+        if not isinstance(op, dict) or not isinstance(op.get('pos'), int) or op['pos'] < 0:
+            raise InvalidOperation('Invalid operation')
+        if op.get('type') == 'insert' and isinstance(op.get('text'), str):
+            if op['text']:
+                clean.append(insert_op(op['pos'], op['text']))
+        elif op.get('type') == 'delete' and isinstance(op.get('length'), int) and op['length'] >= 0:
+            if op['length']:
+                clean.append(delete_op(op['pos'], op['length']))
+        else:
+            raise InvalidOperation('Invalid operation')
+    return clean
+
+
+def apply_ops(text, ops):
+    """Apply operations in order; raises InvalidOperation if one falls outside the text"""
+    for op in ops:
+        pos = op['pos']
+        if op['type'] == 'insert':
+            if pos > len(text):
+                raise InvalidOperation('Insert position out of range')
+            text = text[:pos] + op['text'] + text[pos:]
+        else:
+            if pos + op['length'] > len(text):
+                raise InvalidOperation('Delete range out of range')
+            text = text[:pos] + text[pos + op['length']:]
+    return text
+
+
+def diff_ops(old, new):
+    """Operations turning `old` into `new`: one delete and/or insert around the common prefix/suffix"""
+    if old == new:
+        return []
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]:
+        suffix += 1
+
+    ops = []
+    if len(old) - prefix - suffix:
+        ops.append(delete_op(prefix, len(old) - prefix - suffix))
+    if len(new) - prefix - suffix:
+        ops.append(insert_op(prefix, new[prefix:len(new) - suffix]))
+    return ops
+
+
+def _transform_one(a, b, a_first):
+    """Rewrite single op `a` to apply after concurrent op `b`; returns a list of ops"""
+    if a['type'] == 'insert':
+        if b['type'] == 'insert':
+            if b['pos'] < a['pos'] or (b['pos'] == a['pos'] and not a_first):
+                return [insert_op(a['pos'] + len(b['text']), a['text'])]
+            return [a]
+        # b deletes
+        if a['pos'] <= b['pos']:
+            return [a]
+        if a['pos'] >= b['pos'] + b['length']:
+            return [insert_op(a['pos'] - b['length'], a['text'])]
+        return [insert_op(b['pos'], a['text'])]
+
+    a_end = a['pos'] + a['length']
+    if b['type'] == 'insert':
+        if b['pos'] <= a['pos']:
+            return [delete_op(a['pos'] + len(b['text']), a['length'])]
+        if b['pos'] >= a_end:
+            return [a]
+        # The insert lands inside the deleted range: keep it, delete around it
+        before = b['pos'] - a['pos']
+        return [
+            delete_op(a['pos'], before),
+            delete_op(a['pos'] + len(b['text']), a['length'] - before),
+        ]
+
+    # Both delete
+    b_end = b['pos'] + b['length']
+    if a_end <= b['pos']:
+        return [a]
+    if a['pos'] >= b_end:
+        return [delete_op(a['pos'] - b['length'], a['length'])]
+    overlap = min(a_end, b_end) - max(a['pos'], b['pos'])
+    if a['length'] == overlap:
+        return []
+    return [delete_op(min(a['pos'], b['pos']), a['length'] - overlap)]
+
+
+def transform(ops, against, ops_first=False):
+    """
+    Transform two concurrent operation lists against each other.
+
+    Returns (ops', against') such that applying `against` then `ops'` gives
+    the same text as applying `ops` then `against'`. Inserts at the same
+    position are ordered by `ops_first`.
+    """
+    if not ops or not against:
+        return ops, against
+    if len(ops) == 1 and len(against) == 1:
+        return (
+            _transform_one(ops[0], against[0], ops_first),
+            _transform_one(against[0], ops[0], not ops_first),
+        )
+    if len(ops) > 1:
+        head, against = transform(ops[:1], against, ops_first)
+        tail, against = transform(ops[1:], against, ops_first)
+        return head + tail, against
+    ops, head = transform(ops, against[:1], ops_first)
+    ops, tail = transform(ops, against[1:], ops_first)
+    return ops, head + tail
+
+
+def oplog_size():
+    return max(getattr(settings, 'COLLAB_OPLOG_SIZE', 200), 1)
+
+
+def join_terminal_lines():
+    return max(getattr(settings, 'COLLAB_JOIN_TERMINAL_LINES', 100), 0)
+
+
+class LiveSession:
+    """Authoritative in-memory state of one collaborative session"""
+
+    def __init__(self, pk, state, rows, meta=None):
+        state = dict(state or {})
+        self.pk = pk
+        self.meta = meta or {}  # session_type, owner_id, is_active as loaded
+        self.code = state.pop('code', '')
+        self.seq = state.pop('seq', 0)
+        self.terminal_output = list(state.pop('terminal_output', []))
+        self.terminal_total = state.pop('terminal_total', len(self.terminal_output))  # Lines ever appended
+        self.extra = state  # Any other session_state keys, written back untouched
+        # (seq, ops, client_id) for transforming late edits and catching up reconnects
+        self.log = deque(maxlen=oplog_size())
+        for seq, ops in rows:
+            if seq > self.seq:
+                self.code = apply_ops(self.code, ops)
+                self.seq = seq
+            self.log.append((seq, ops, None))
+        self.unflushed = []  # CollabOperation kwargs not yet written
+        self.dirty = False
+        self.last_activity = None  # Latest activity not yet written
+        self.activity_written_at = None
+        self.members = 0
+        self.online = {}  # user_id -> member dict for connections in this process
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        state = dict(self.extra)
+        state.update({
+            'code': self.code,
+            'seq': self.seq,
+            'terminal_output': list(self.terminal_output),
+            'terminal_total': self.terminal_total,
+        })
+        return state
+
+
+class LiveSessionStore:
+    """
+    Per-process registry of live collaborative sessions.
+
+    Edits, terminal output and activity only change memory; a background
+    thread writes each changed session every COLLAB_FLUSH_INTERVAL seconds
+    (one session_state UPDATE plus one bulk insert of its new ops), and the
+    last member leaving flushes and evicts it. All members of a session must
+    be served by the same process, as with the in-memory channel layer.
+
+    Methods that read or edit a session load it from the database if it is
+    not live yet. Async callers pass create=False so that never happens on
+    the event loop; they get SessionEnded instead.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._flusher = PeriodicFlusher('collab-session-flusher', self.flush, lambda: self.flush_interval)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'COLLAB_FLUSH_INTERVAL', 2)
+
+    @property
+    def activity_interval(self):
+        return getattr(settings, 'COLLAB_ACTIVITY_INTERVAL', 60)
+
+    def get(self, share_id, create=True):
+        """The live session for `share_id`, loading it from the database if needed"""
+        from .models import CollabOperation, SharedCode
+
+        key = str(share_id)
+        with self._lock:
+            live = self._sessions.get(key)
+        if live is not None or not create:
+            return live
+
+        session = SharedCode.objects.only(
+            'id', 'session_state', 'session_type', 'user_id', 'is_active'
+        ).get(share_id=share_id)
+        rows = CollabOperation.objects.filter(session=session).order_by('seq').values_list('seq', 'ops')
+        loaded = LiveSession(session.pk, session.session_state, list(rows), meta={
+            'session_type': session.session_type,
+            'owner_id': session.user_id,
+            'is_active': session.is_active,
+        })
+        with self._lock:
+            # Another thread may have loaded it meanwhile
+            live = self._sessions.setdefault(key, loaded)
+        self._flusher.start()
+        return live
+
+    def join(self, share_id, member=None):
+        """Count a connection; `member` ({'user_id', 'username', ...}) is added to the online roster"""
+        live = self.get(share_id)
+        with live.lock:
+            live.members += 1
+            if member:
+                entry = live.online.setdefault(member['user_id'], {'connections': 0})
+                entry.update(member)
+                entry['connections'] += 1
+        return live
+
+    def leave(self, share_id, user_id=None):
+        """Drop a connection; the last one out flushes the session and evicts it"""
+        live = self.get(share_id, create=False)
+        if live is None:
+            return
+        with live.lock:
+            live.members -= 1
+            entry = live.online.get(user_id)
+            if entry:
+                entry['connections'] -= 1
+                if entry['connections'] <= 0:
+                    del live.online[user_id]
+            empty = live.members <= 0
+        if empty:
+            self.flush(share_id, force=True)
+            with self._lock:
+                if live.members <= 0 and self._sessions.get(str(share_id)) is live:
+                    del self._sessions[str(share_id)]
+
+    def _require(self, share_id, create):
+        live = self.get(share_id, create=create)
+        if live is None:
+            raise SessionEnded(f'Session {share_id} is not live')
+        return live
+
+    def discard(self, share_id):
+        """Forget a session without writing it"""
+        with self._lock:
+            self._sessions.pop(str(share_id), None)
+
+    def state(self, share_id, terminal_lines=None, create=True):
+        """Full session state; only the last `terminal_lines` lines of terminal output if given"""
+        live = self._require(share_id, create)
+        with live.lock:
+            state = live.snapshot()
+        if terminal_lines is not None:
+            state['terminal_output'] = state['terminal_output'][-terminal_lines:] if terminal_lines else []
+        return state
+
+    def catch_up(self, share_id, since, terminal_since=None, create=True):
+        """
+        What a client that has seen up to `since` is missing: the ops after it and
+        the new terminal lines. Returns None if the log no longer reaches back that far.
+        """
+        live = self._require(share_id, create)
+        with live.lock:
+            if since > live.seq:
+                return None
+            entries = [
+                {'seq': seq, 'ops': ops, 'client_id': client_id}
+                for seq, ops, client_id in live.log if seq > since
+            ]
+            if len(entries) != live.seq - since:
+                return None
+            missing = live.terminal_total - (terminal_since if terminal_since is not None else live.terminal_total)
+            if 0 <= missing <= len(live.terminal_output):
+                terminal_output = live.terminal_output[len(live.terminal_output) - missing:]
+            else:
+                terminal_output = live.terminal_output[-join_terminal_lines():] if join_terminal_lines() else []
+            return {
+                'seq': live.seq,
+                'ops': entries,
+                'terminal_output': terminal_output,
+                'terminal_total': live.terminal_total,
+            }
+
+    def members(self, share_id, create=True):
+        """Members connected to this session in this process"""
+        live = self._require(share_id, create)
+        with live.lock:
+            return [
+                {key: value for key, value in entry.items() if key != 'connections'}
+                for entry in live.online.values()
+            ]
+
+    def set_permission(self, share_id, user_id, permission):
+        live = self.get(share_id, create=False)
+        if live is not None:
+            with live.lock:
+                if user_id in live.online:
+                    live.online[user_id]['permission'] = permission
+
+    def submit_ops(self, share_id, user, base_seq, ops, client_id=None, create=True):
+        ops = validate_ops(ops)
+        live = self._require(share_id, create)
+        with live.lock:
+            if base_seq > live.seq:
+                raise StaleBaseError('Base sequence is ahead of the session')
+            concurrent = [log_ops for log_seq, log_ops, _ in live.log if log_seq > base_seq]
+            if len(concurrent) != live.seq - base_seq:
+                raise StaleBaseError('Operations since the base sequence are no longer available')
+
+            for committed in concurrent:
+                ops, _ = transform(ops, committed)
+            if not ops:
+                return None, []
+            live.code = apply_ops(live.code, ops)
+            live.seq += 1
+            live.log.append((live.seq, ops, client_id))
+            live.unflushed.append({'seq': live.seq, 'user_id': getattr(user, 'id', None), 'ops': ops})
+            live.dirty = True
+            return live.seq, ops
+
+    def submit_text(self, share_id, user, code, client_id=None, create=True):
+        if not isinstance(code, str):
+            raise InvalidOperation('code must be a string')
+        live = self._require(share_id, create)
+        with live.lock:
+            base_seq, ops = live.seq, diff_ops(live.code, code)
+        return self.submit_ops(share_id, user, base_seq, ops, client_id, create=create)
+
+    def append_terminal_output(self, share_id, output, create=True):
+        live = self._require(share_id, create)
+        with live.lock:
+            live.terminal_output.append(output)
+            live.terminal_total += 1
+            # Keep only last 1000 lines
+            del live.terminal_output[:-1000]
+            live.dirty = True
+            return live.terminal_total
+
+    def touch(self, share_id):
+        """Record activity; written at most once per COLLAB_ACTIVITY_INTERVAL"""
+        live = self.get(share_id, create=False)
+        if live is not None:
+            live.last_activity = timezone.now()
+
+    def flush(self, share_id=None, force=False):
+        """
+        Write changed sessions (or just `share_id`); returns the number of sessions written.
+
+        Activity on its own is written at most once per COLLAB_ACTIVITY_INTERVAL unless `force` is set.
+        """
+        with self._lock:
+            if share_id is None:
+                sessions = list(self._sessions.values())
+            else:
+                sessions = [live for live in [self._sessions.get(str(share_id))] if live]
+
+        written = 0
+        for live in sessions:
+            with live.lock:
+                last_activity = live.last_activity
+                # Activity rides along with any state write, otherwise it waits for the interval
+                if last_activity and not (force or live.dirty or live.activity_written_at is None or (
+                        (last_activity - live.activity_written_at).total_seconds() >= self.activity_interval)):
+                    last_activity = None
+                if not live.dirty and last_activity is None:
+                    continue
+                dirty, rows, state, seq = live.dirty, live.unflushed, live.snapshot(), live.seq
+                live.unflushed, live.dirty = [], False
+                if last_activity:
+                    live.last_activity, live.activity_written_at = None, last_activity
+            try:
+                self._write(live.pk, dirty, rows, state, seq, last_activity)
+                written += 1
+            except Exception:
+                logger.exception('Failed to flush collaborative session %s', live.pk)
+                with live.lock:
+                    live.unflushed = rows + live.unflushed
+                    live.dirty = live.dirty or dirty
+                    if last_activity:
+                        live.last_activity = live.last_activity or last_activity
+                        live.activity_written_at = None
+        return written
+
+    def _write(self, pk, dirty, rows, state, seq, last_activity):
+        from .models import CollabOperation, SharedCode
+
+        updates = {}
+        if dirty:
+            updates['session_state'] = state
+            updates['updated_at'] = timezone.now()
+        if last_activity:
+            updates['last_activity'] = last_activity
+        with transaction.atomic():
+            if rows:
+                CollabOperation.objects.bulk_create(
+                    [CollabOperation(session_id=pk, **row) for row in rows], ignore_conflicts=True
+                )
+            SharedCode.objects.filter(pk=pk).update(**updates)
+            if rows:
+                CollabOperation.objects.filter(session_id=pk, seq__lte=seq - oplog_size()).delete()
+
+
+live_sessions = LiveSessionStore()
+
+
+def document_state(session):
+    """Current (code, seq) of a collaborative session, from memory if it is live here"""
+    live = live_sessions.get(session.share_id, create=False)
+    if live is not None:
+        with live.lock:
+            return live.code, live.seq
+    from .models import CollabOperation
+
+    loaded = LiveSession(
+        session.pk, session.session_state,
+        list(CollabOperation.objects.filter(session=session).order_by('seq').values_list('seq', 'ops'))
+    )
+    return loaded.code, loaded.seq
+
+
+def submit_ops(share_id, user, base_seq, ops):
+    """
+    Sequence a client's operations made against `base_seq`.
+
+    Returns (seq, ops) with the ops rewritten to apply at the new head, or
+    (None, []) if nothing remains after transforming. Raises InvalidOperation
+    or StaleBaseError; the client should resync from document_state then.
+    """
+    return live_sessions.submit_ops(share_id, user, base_seq, ops)
+
+
+def submit_text(share_id, user, code):
+    """Sequence a full-text update (legacy `code_change` clients) as a diff against the head"""
+    return live_sessions.submit_text(share_id, user, code)
@@ -1,21 +1,35 @@
-import json
+import asyncio
+from collections import deque
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.utils import timezone
 import uuid
 
+from . import gateway
+from .collab import InvalidOperation, SessionEnded, StaleBaseError, join_terminal_lines, live_sessions
+from .presence import presence
+from .wire import WireProtocolMixin, encode_frame
 
-class CollaborativeSessionConsumer(AsyncWebsocketConsumer):
+
+class CollaborativeSessionConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
         self.room_group_name = f'code_session_{self.session_id}'
         self.user = self.scope['user']
         
-        # Validate session exists and is collaborative
-        session = await self.get_session()
-        if not session or session['session_type'] != 'collaborative':
+        # Validate the session, register the member and join the live session in one trip;
+        # warm sessions are served from memory, so this is just the member upsert
+        session = await self.open_session()
+        if not session:
             await self.close()
             return
+        self.joined_live_session = True
+        
+        # Permissions are cached for the life of the socket and kept current
+        # by the permission_changed/member_removed events
+        self.is_owner = session['owner_id'] == self.user.id
+        self.can_edit = self.is_owner or session['permission'] == 'edit'
         
         # Join room group
         await self.channel_layer.group_add(
@@ -25,9 +39,6 @@ class CollaborativeSessionConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         
-        # Add user as session member
-        await self.add_session_member()
-        
         # Broadcast user joined
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -38,23 +49,55 @@ class CollaborativeSessionConsumer(AsyncWebsocketConsumer):
             }
         )
         
-        # Send current session state to new user
-        session_state = await self.get_session_state()
-        await self.send(text_data=json.dumps({
-            'type': 'session_state',
-            'state': session_state,
-        }))
+        # The live session is in memory from here on; calls pass create=False so a session
+        # ended meanwhile raises SessionEnded instead of being loaded on the event loop
+        try:
+            await self.send_initial_state()
+        except SessionEnded:
+            await self.session_ended()
+    
+    async def send_initial_state(self):
+        # Reconnecting clients only get what they missed since their last sequence number
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        catch_up = None
+        try:
+            if 'since' in params:
+                terminal_since = int(params['terminal_since'][0]) if 'terminal_since' in params else None
+                catch_up = live_sessions.catch_up(
+                    self.session_id, int(params['since'][0]), terminal_since, create=False
+                )
+        except ValueError:
+            pass
+        
+        if catch_up is not None:
+            await self.send_message(dict(catch_up, type='resume'))
+        else:
+            # Send current session state to new user
+            await self.send_message({
+                'type': 'session_state',
+                'state': live_sessions.state(self.session_id, terminal_lines=join_terminal_lines(), create=False),
+            })
         
         # Send members list
-        members = await self.get_members_list()
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'members_update',
-            'members': members,
-        }))
+            'members': live_sessions.members(self.session_id, create=False),
+        })
+    
+    async def session_ended(self):
+        """Tell a client whose session was ended while it was connected, then drop it"""
+        await self.send_message({
+            'type': 'removed_from_session',
+            'message': 'This session has ended',
+        })
+        await self.close()
     
     async def disconnect(self, close_code):
-        # Mark user as offline
-        await self.update_member_status(False)
+        if not getattr(self, 'joined_live_session', False):
+            return
+        
+        # Mark user as offline; the last member out writes the live state back
+        await self.close_session()
         
         # Broadcast user left
         await self.channel_layer.group_send(
@@ -72,243 +115,203 @@ class CollaborativeSessionConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type')
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_message(text_data, bytes_data)
+        
+        # Update session activity timestamp (written with the next flush)
+        live_sessions.touch(self.session_id)
         
-        # Update session activity timestamp
-        await self.update_session_activity()
+        try:
+            await self.handle_message(data)
+        except SessionEnded:
+            await self.session_ended()
+    
+    async def handle_message(self, data):
+        message_type = data.get('type')
         
-        if message_type == 'code_change':
+        if message_type in ('op', 'code_change'):
             # Check if user has edit permission
-            has_permission = await self.check_edit_permission()
-            if not has_permission:
-                await self.send(text_data=json.dumps({
+            if not self.can_edit:
+                await self.send_message({
                     'type': 'error',
                     'message': 'You do not have permission to edit'
-                }))
+                })
+                return
+            
+            # Sequence the edit; legacy clients still send the whole document
+            try:
+                client_id = str(data.get('client_id') or '')[:64] or None
+                if message_type == 'op':
+                    base_seq = data.get('base_seq', 0)
+                    if not isinstance(base_seq, int):
+                        raise InvalidOperation('base_seq must be an integer')
+                    seq, ops = live_sessions.submit_ops(
+                        self.session_id, self.user, base_seq, data.get('ops'), client_id, create=False
+                    )
+                else:
+                    seq, ops = live_sessions.submit_text(
+                        self.session_id, self.user, data.get('code'), client_id, create=False
+                    )
+            except (InvalidOperation, StaleBaseError) as e:
+                state = live_sessions.state(self.session_id, create=False)
+                await self.send_message({
+                    'type': 'resync',
+                    'message': str(e),
+                    'code': state['code'],
+                    'seq': state['seq'],
+                })
+                return
+            
+            if seq is None:
+                # Fully cancelled out by concurrent edits
                 return
             
-            # Broadcast code change to all members
+            # Broadcast only the edit to all members
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
-                    'type': 'code_change_broadcast',
-                    'code': data.get('code'),
+                    'type': 'code_op_broadcast',
+                    'seq': seq,
+                    'ops': ops,
                     'user_id': self.user.id,
                     'username': self.user.username,
+                    'client_id': client_id,
+                    'origin': self.channel_name,
                 }
             )
-            
-            # Save to session state
-            await self.update_session_state({'code': data.get('code')})
         
         elif message_type == 'cursor_position':
-            # Broadcast cursor position
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'cursor_position_broadcast',
-                    'position': data.get('position'),
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                }
+            # Coalesced with other presence updates into one frame per tick
+            await presence.publish(
+                self.channel_layer, self.room_group_name, 'cursor', self.user.id,
+                username=self.user.username,
+                position=data.get('position'),
             )
         
         elif message_type == 'terminal_output':
+            # Save to session state (written with the next flush)
+            terminal_total = live_sessions.append_terminal_output(self.session_id, data.get('output'), create=False)
+            
             # Broadcast terminal output
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'terminal_output_broadcast',
                     'output': data.get('output'),
+                    'terminal_total': terminal_total,
                     'user_id': self.user.id,
                 }
             )
-            
-            # Save to session state
-            await self.append_terminal_output(data.get('output'))
     
     # WebSocket event handlers
     async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'user_joined',
             'user_id': event['user_id'],
             'username': event['username'],
-        }))
+        })
     
     async def user_left(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'user_left',
             'user_id': event['user_id'],
             'username': event['username'],
-        }))
+        })
     
-    async def code_change_broadcast(self, event):
-        # Don't send back to the user who made the change
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'code_change',
-                'code': event['code'],
-                'user_id': event['user_id'],
-                'username': event['username'],
-            }))
-    
-    async def cursor_position_broadcast(self, event):
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_position',
-                'position': event['position'],
-                'user_id': event['user_id'],
-                'username': event['username'],
-            }))
+    async def code_op_broadcast(self, event):
+        # The sender only needs to know its edit was sequenced
+        if event['origin'] == self.channel_name:
+            await self.send_message({
+                'type': 'ack',
+                'seq': event['seq'],
+            })
+            return
+        await self.send_message({
+            'type': 'op',
+            'seq': event['seq'],
+            'ops': event['ops'],
+            'user_id': event['user_id'],
+            'username': event['username'],
+            'client_id': event['client_id'],
+        })
+    
+    async def presence_frame(self, event):
+        # Encoded at most once per protocol for the whole group
+        await self.send_frame(event)
     
     async def terminal_output_broadcast(self, event):
         if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'terminal_output',
                 'output': event['output'],
-            }))
+                'terminal_total': event['terminal_total'],
+            })
     
     async def permission_changed(self, event):
-        if event['user_id'] == self.user.id:
-            await self.send(text_data=json.dumps({
+        if str(event['user_id']) == str(self.user.id):
+            self.can_edit = self.is_owner or event['permission'] == 'edit'
+            live_sessions.set_permission(self.session_id, self.user.id, event['permission'])
+            await self.send_message({
                 'type': 'permission_changed',
                 'permission': event['permission'],
-            }))
+            })
     
     async def member_removed(self, event):
-        if event['user_id'] == self.user.id:
-            await self.send(text_data=json.dumps({
+        if str(event['user_id']) == str(self.user.id):
+            self.can_edit = False
+            await self.send_message({
                 'type': 'removed_from_session',
                 'message': 'You have been removed from this session',
-            }))
+            })
             await self.close()
     
     # Database operations
     @database_sync_to_async
-    def get_session(self):
-        from .models import SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id, is_active=True)
-            return {
-                'session_type': session.session_type,
-                'owner_id': session.user.id,
-                'is_expired': session.is_expired(),
-            }
-        except SharedCode.DoesNotExist:
-            return None
-    
-    @database_sync_to_async
-    def get_session_state(self):
-        from .models import SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            return session.session_state
-        except SharedCode.DoesNotExist:
-            return {}
-    
-    @database_sync_to_async
-    def update_session_state(self, updates):
-        from .models import SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            session.session_state.update(updates)
-            session.save(update_fields=['session_state', 'updated_at'])
-        except SharedCode.DoesNotExist:
-            pass
-    
-    @database_sync_to_async
-    def append_terminal_output(self, output):
-        from .models import SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            if 'terminal_output' not in session.session_state:
-                session.session_state['terminal_output'] = []
-            session.session_state['terminal_output'].append(output)
-            # Keep only last 1000 lines
-            if len(session.session_state['terminal_output']) > 1000:
-                session.session_state['terminal_output'] = session.session_state['terminal_output'][-1000:]
-            session.save(update_fields=['session_state', 'updated_at'])
-        except SharedCode.DoesNotExist:
-            pass
-    
-    @database_sync_to_async
-    def add_session_member(self):
+    def open_session(self):
+        """Validate the session and add the user as an online member; None if they cannot join"""
         from .models import SharedCode, SessionMember
         try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            member, created = SessionMember.objects.get_or_create(
-                session=session,
-                user=self.user,
-                defaults={'permission': 'view', 'is_online': True}
-            )
-            if not created:
-                member.is_online = True
-                member.last_active = timezone.now()
-                member.save(update_fields=['is_online', 'last_active'])
+            live = live_sessions.get(self.session_id)
         except SharedCode.DoesNotExist:
-            pass
-    
-    @database_sync_to_async
-    def update_member_status(self, is_online):
-        from .models import SessionMember
-        try:
-            member = SessionMember.objects.get(
-                session__share_id=self.session_id,
-                user=self.user
-            )
-            member.is_online = is_online
+            return None
+        if live.meta['session_type'] != 'collaborative' or not live.meta['is_active']:
+            if not live.members:
+                live_sessions.discard(self.session_id)
+            return None
+        
+        member, created = SessionMember.objects.get_or_create(
+            session_id=live.pk,
+            user=self.user,
+            defaults={'permission': 'view', 'is_online': True}
+        )
+        if not created:
+            member.is_online = True
             member.last_active = timezone.now()
             member.save(update_fields=['is_online', 'last_active'])
-        except SessionMember.DoesNotExist:
-            pass
+        
+        is_owner = live.meta['owner_id'] == self.user.id
+        live_sessions.join(self.session_id, member={
+            'user_id': self.user.id,
+            'username': self.user.username,
+            'permission': member.permission,
+            'is_owner': is_owner,
+            'is_online': True,
+            'last_active': member.last_active.isoformat(),
+        })
+        return {'owner_id': live.meta['owner_id'], 'permission': member.permission}
     
     @database_sync_to_async
-    def check_edit_permission(self):
-        from .models import SessionMember, SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            # Owner always has edit permission
-            if session.user == self.user:
-                return True
-            
-            member = SessionMember.objects.get(
-                session=session,
-                user=self.user
+    def close_session(self):
+        from .models import SessionMember
+        live = live_sessions.get(self.session_id, create=False)
+        live_sessions.leave(self.session_id, self.user.id)
+        if live is not None:
+            SessionMember.objects.filter(session_id=live.pk, user=self.user).update(
+                is_online=False, last_active=timezone.now()
             )
-            return member.permission == 'edit'
-        except (SharedCode.DoesNotExist, SessionMember.DoesNotExist):
-            return False
-    
-    @database_sync_to_async
-    def get_members_list(self):
-        from .models import SessionMember, SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            members = SessionMember.objects.filter(session=session, is_online=True)
-            return [{
-                'user_id': m.user.id,
-                'username': m.user.username,
-                'permission': m.permission,
-                'is_owner': m.user == session.user,
-                'last_active': m.last_active.isoformat(),
-            } for m in members]
-        except SharedCode.DoesNotExist:
-            return []
-    
-    @database_sync_to_async
-    def update_session_activity(self):
-        """Update the last_activity timestamp for the session"""
-        from .models import SharedCode
-        try:
-            session = SharedCode.objects.get(share_id=self.session_id)
-            session.update_activity()
-        except SharedCode.DoesNotExist:
-            pass
 
 
-class ServerChannelConsumer(AsyncWebsocketConsumer):
+class ServerChannelConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """WebSocket consumer for server channels (Discord-like real-time messaging)"""
     
     async def connect(self):
@@ -331,26 +334,18 @@ class ServerChannelConsumer(AsyncWebsocketConsumer):
         await self.accept()
         
         # Notify others that user is online
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'status': 'online'
-            }
+        await presence.publish(
+            self.channel_layer, self.room_group_name, 'status', self.user.id,
+            username=self.user.username,
+            status='online',
         )
     
     async def disconnect(self, close_code):
         # Notify others that user is offline
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'status': 'offline'
-            }
+        await presence.publish(
+            self.channel_layer, self.room_group_name, 'status', self.user.id,
+            username=self.user.username,
+            status='offline',
         )
         
         # Leave channel group
@@ -359,54 +354,36 @@ class ServerChannelConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_message(text_data, bytes_data)
         message_type = data.get('type')
         
         if message_type == 'new_message':
             # Check if user is muted
             is_muted = await self.check_if_muted()
             if is_muted:
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'error',
                     'message': 'You are muted in this server'
-                }))
+                })
                 return
             
             # Save message to database
             message = await self.save_message(data.get('content'), data.get('reply_to'))
             
-            # Broadcast message to all channel members
+            # Broadcast message to all channel members, encoded once per protocol for all of them
+            frame = encode_frame({'type': 'new_message', 'message': message})
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'message_broadcast',
-                    'message': message
-                }
+                dict(frame, type='message_broadcast')
             )
         
-        elif message_type == 'typing_start':
-            # User started typing
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'is_typing': True
-                }
-            )
-        
-        elif message_type == 'typing_end':
-            # User stopped typing
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'is_typing': False
-                }
+        elif message_type in ('typing_start', 'typing_end'):
+            # Only the latest typing state per user goes out with each tick
+            await presence.publish(
+                self.channel_layer, self.room_group_name, 'typing', self.user.id,
+                username=self.user.username,
+                is_typing=message_type == 'typing_start',
             )
         
         elif message_type == 'react':
@@ -431,41 +408,22 @@ class ServerChannelConsumer(AsyncWebsocketConsumer):
     
     # WebSocket event handlers
     async def message_broadcast(self, event):
-        """Broadcast new message to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'new_message',
-            'message': event['message']
-        }))
-    
-    async def user_status(self, event):
-        """Broadcast user status change"""
-        await self.send(text_data=json.dumps({
-            'type': 'user_status',
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'status': event['status']
-        }))
+        """Broadcast new message to WebSocket (wrapped with encode_frame by the sender)"""
+        await self.send_frame(event)
     
-    async def typing_indicator(self, event):
-        """Broadcast typing indicator"""
-        # Don't send to self
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'user_id': event['user_id'],
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
+    async def presence_frame(self, event):
+        """Relay a coalesced status/typing frame, encoded once per protocol for the group"""
+        await self.send_frame(event)
     
     async def reaction_added(self, event):
         """Broadcast reaction"""
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'reaction',
             'message_id': event['message_id'],
             'user_id': event['user_id'],
             'username': event['username'],
             'emoji': event['emoji']
-        }))
+        })
     
     # Database operations
     @database_sync_to_async
@@ -551,3 +509,188 @@ class ServerChannelConsumer(AsyncWebsocketConsumer):
             return True
         except ServerMessage.DoesNotExist:
             return False
+
+
+class GatewayConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
+    """Per-user socket for every server, DM, friend and presence event (see gateway.py)"""
+    
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.session_id = None
+        self.seq = 0
+        self.replay = deque(maxlen=gateway.replay_size())  # (seq, event, data) for resuming
+        self.subscriptions = set()
+        self.channel_servers = {}  # channel_id -> server pk, checked on first typing event
+        self.connection_refreshed_at = 0  # loop time the connection's expiry was last extended
+        await self.accept()
+    
+    async def disconnect(self, close_code):
+        if self.session_id is None:
+            return
+        await database_sync_to_async(gateway.save_session)(self.session_id, self.user.id, self.seq, self.replay)
+        for group in self.subscriptions:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        await self.set_online(False)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_message(text_data, bytes_data)
+        message_type = data.get('type')
+        
+        if message_type == 'heartbeat':
+            await self.send_message({'type': 'heartbeat_ack', 'seq': self.seq})
+            await self.refresh_connection()
+        
+        elif message_type in ('identify', 'resume') and self.session_id is not None:
+            await self.send_message({'type': 'error', 'message': 'Session already started'})
+        
+        elif message_type == 'identify':
+            payload = await self.subscribe_all()
+            self.session_id = gateway.new_session_id()
+            await self.send_message(dict(payload, type='ready', session_id=self.session_id, seq=self.seq))
+            await self.set_online(True)
+        
+        elif message_type == 'resume':
+            await self.resume(data.get('session_id'), data.get('seq'))
+        
+        elif self.session_id is None:
+            await self.send_message({'type': 'error', 'message': 'Identify first'})
+        
+        elif message_type == 'typing':
+            server_pk = await self.channel_server(data.get('channel_id'))
+            if server_pk is None:
+                await self.send_message({'type': 'error', 'message': 'Unknown channel'})
+                return
+            await presence.publish(
+                self.channel_layer, gateway.server_group(server_pk), 'typing', self.user.id,
+                username=self.user.username,
+                channel_id=str(data['channel_id']),
+                is_typing=bool(data.get('is_typing', True)),
+            )
+        
+        else:
+            await self.send_message({'type': 'error', 'message': f'Unknown message type {message_type!r}'})
+    
+    async def resume(self, session_id, client_seq):
+        # Another user's session id is neither resumed nor used up
+        session = await database_sync_to_async(gateway.pop_session)(str(session_id), self.user.id) if session_id else None
+        valid = (
+            session is not None
+            and isinstance(client_seq, int) and 0 <= client_seq <= session['seq']
+            # Everything after client_seq must still be buffered
+            and (client_seq == session['seq'] or (session['events'] and session['events'][0][0] <= client_seq + 1))
+        )
+        if not valid:
+            await self.send_message({'type': 'invalid_session'})
+            return
+        
+        # Subscribe before reading what was missed so nothing falls in between
+        await self.subscribe_all()
+        missed = await database_sync_to_async(gateway.missed_events)(self.user, session['disconnected_at'])
+        if missed is None:
+            for group in self.subscriptions:
+                await self.channel_layer.group_discard(group, self.channel_name)
+            self.subscriptions.clear()
+            await self.send_message({'type': 'invalid_session'})
+            return
+        
+        self.session_id = str(session_id)
+        self.seq = session['seq']
+        self.replay.extend(tuple(event) for event in session['events'])
+        for seq, event, data in self.replay:
+            if seq > client_seq:
+                await self.send_message({'type': 'dispatch', 'seq': seq, 'event': event, 'data': data})
+        for event, data in missed:
+            await self.send_dispatch(event, data)
+        await self.send_message({
+            'type': 'resumed', 'session_id': self.session_id, 'seq': self.seq,
+            'heartbeat_interval': gateway.heartbeat_interval(),
+        })
+        await self.set_online(True)
+    
+    async def refresh_connection(self):
+        """Extend the connection's expiry, at most once per heartbeat interval"""
+        now = asyncio.get_running_loop().time()
+        if self.session_id is None or now - self.connection_refreshed_at < gateway.heartbeat_interval():
+            return
+        self.connection_refreshed_at = now
+        await database_sync_to_async(gateway.refresh_connection)(self.channel_name)
+    
+    async def send_dispatch(self, event, data):
+        self.seq += 1
+        self.replay.append((self.seq, event, data))
+        await self.send_message({'type': 'dispatch', 'seq': self.seq, 'event': event, 'data': data})
+    
+    async def subscribe(self, groups):
+        for group in groups:
+            if group not in self.subscriptions:
+                await self.channel_layer.group_add(group, self.channel_name)
+                self.subscriptions.add(group)
+    
+    async def subscribe_all(self):
+        """Join every group of the user; returns the ready payload"""
+        groups, payload = await database_sync_to_async(gateway.ready_state)(self.user)
+        await self.subscribe(groups)
+        return payload
+    
+    async def set_online(self, online):
+        changed = await database_sync_to_async(gateway.set_online)(self.user, self.channel_name, online)
+        self.connection_refreshed_at = asyncio.get_running_loop().time()
+        if changed:
+            await presence.publish(
+                self.channel_layer, gateway.presence_group(self.user.id), 'status', self.user.id,
+                username=self.user.username,
+                status='online' if online else 'offline',
+            )
+    
+    # Group event handlers
+    async def gateway_dispatch(self, event):
+        if self.session_id is not None:
+            await self.send_dispatch(event['event'], event['data'])
+    
+    async def gateway_subscribe(self, event):
+        await self.subscribe(event['groups'])
+        if event.get('event') and self.session_id is not None:
+            await self.send_dispatch(event['event'], event['data'])
+    
+    async def gateway_unsubscribe(self, event):
+        for group in event['groups']:
+            if group in self.subscriptions:
+                await self.channel_layer.group_discard(group, self.channel_name)
+                self.subscriptions.discard(group)
+        # Channels of servers left must be checked again
+        self.channel_servers = {
+            channel_id: server_pk for channel_id, server_pk in self.channel_servers.items()
+            if gateway.server_group(server_pk) in self.subscriptions
+        }
+        if event.get('event') and self.session_id is not None:
+            await self.send_dispatch(event['event'], event['data'])
+    
+    async def presence_frame(self, event):
+        # Typing and status, encoded once per protocol for the whole group
+        await self.send_frame(event)
+    
+    # Database operations
+    async def channel_server(self, channel_id):
+        """Server pk of a channel in one of the user's servers, or None"""
+        channel_id = str(channel_id)
+        if channel_id not in self.channel_servers:
+            server_pk = await self.lookup_channel_server(channel_id)
+            if server_pk is None:
+                return None
+            self.channel_servers[channel_id] = server_pk
+        return self.channel_servers[channel_id]
+    
+    @database_sync_to_async
+    def lookup_channel_server(self, channel_id):
+        from django.core.exceptions import ValidationError
+        from .models import ServerChannel
+        try:
+            return ServerChannel.objects.filter(
+                channel_id=channel_id, server__members__user=self.user
+            ).values_list('server_id', flat=True).first()
+        except ValidationError:
+            return None
@@ -0,0 +1,192 @@
+"""
+Hit-log counters for hot integer fields (SharedCode.view_count, fork_count, ...).
+
+`counters.incr(Model, pk, 'field')` appends a CounterHit row instead of
+updating the counted row, so concurrent hits never contend for it or lose
+each other the way a read-modify-write save() does. `flush()` applies the
+logged hits as `UPDATE ... SET field = field + n`, grouping rows that
+received the same increment into one query, and deletes them in the same
+transaction: a flush that fails leaves its hits for the next one, and a
+process that dies loses nothing.
+
+`counters.incr_bucket(Model, {...}, 'field')` does the same for bucket rows
+identified by a unique key (e.g. per-day stats), creating missing rows first.
+
+Requests never flush: a process that logged hits applies the log from a
+background thread every COUNTER_FLUSH_INTERVAL seconds (flushing.py), and
+the `flush_counters` and `refresh_shared_code_rankings` commands apply it
+too (use cron where no process outlives its request, as on Vercel). With
+an interval of 0 hits skip the log and are applied with their request.
+
+`counters.pending()` is the number of hits this process logged since its
+last flush, kept in memory so showing a fresh count costs no query.
+"""
+import json
+import operator
+import threading
+from collections import defaultdict
+from functools import reduce
+
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Q
+
+from .flushing import PeriodicFlusher
+
+
+def _label(model):
+    return model._meta.label
+
+
+def _bucket_key(key):
+    return json.dumps(key, sort_keys=True, cls=DjangoJSONEncoder)
+
+
+class CounterService:
+    """Logs counter increments and applies them in batches"""
+
+    def __init__(self):
+        self._recorded = defaultdict(int)  # (model label, pk, field) -> hits logged since the last flush
+        self._lock = threading.Lock()
+        self._flusher = PeriodicFlusher('counter-flusher', self._flush_recorded, lambda: self.flush_interval)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'COUNTER_FLUSH_INTERVAL', 10)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'COUNTER_FLUSH_BATCH_SIZE', 5000)
+
+    def hit(self, model, pk, field, amount=1):
+        """Unsaved hit adding `amount` to `field` of row `pk`"""
+        from .models import CounterHit
+        return CounterHit(model=_label(model), object_id=pk, field=field, amount=amount)
+
+    def bucket_hit(self, model, key, field, amount=1):
+        """Unsaved hit adding `amount` to `field` of the row matching the unique lookup `key`"""
+        from .models import CounterHit
+        return CounterHit(model=_label(model), bucket=_bucket_key(key), field=field, amount=amount)
+
+    def record(self, *hits):
+        """Log hits with one INSERT, or apply them right away when the flush interval is 0"""
+        from .models import CounterHit
+        if self.flush_interval <= 0:
+            with transaction.atomic():
+                self._apply(*self._group(
+                    (hit.model, hit.object_id, hit.bucket, hit.field, hit.amount) for hit in hits
+                ))
+            return
+        CounterHit.objects.bulk_create(hits)
+        with self._lock:
+            for hit in hits:
+                if not hit.bucket:
+                    self._recorded[(hit.model, hit.object_id, hit.field)] += hit.amount
+        self._flusher.start()
+
+    def incr(self, model, pk, field, amount=1):
+        self.record(self.hit(model, pk, field, amount))
+
+    def incr_bucket(self, model, key, field, amount=1):
+        self.record(self.bucket_hit(model, key, field, amount))
+
+    def pending(self, model, pk, field):
+        """Increments this process logged for a row since its last flush (no query)"""
+        with self._lock:
+            return self._recorded.get((_label(model), pk, field), 0)
+
+    def _flush_recorded(self):
+        # Background flushes only run in processes that logged something
+        with self._lock:
+            recorded = bool(self._recorded)
+        if recorded:
+            self.flush()
+
+    def flush(self):
+        """Apply all logged hits, `batch_size` per transaction; returns the number of hits applied"""
+        with self._lock:
+            recorded, self._recorded = self._recorded, defaultdict(int)
+        applied = 0
+        try:
+            while True:
+                count = self._flush_batch()
+                applied += count
+                if count < self.batch_size:
+                    return applied
+        except Exception:
+            # Whatever was not applied is still logged, so it still shows as pending
+            with self._lock:
+                for key, amount in recorded.items():
+                    self._recorded[key] += amount
+            raise
+
+    def _flush_batch(self):
+        from .models import CounterHit
+
+        with transaction.atomic():
+            # Concurrent flushers skip each other's rows instead of applying them twice
+            hits = list(
+                CounterHit.objects.select_for_update(skip_locked=True).order_by('id')
+                .values_list('id', 'model', 'object_id', 'bucket', 'field', 'amount')[:self.batch_size]
+            )
+            if not hits:
+                return 0
+            self._apply(*self._group(hit[1:] for hit in hits))
+            CounterHit.objects.filter(id__in=[hit[0] for hit in hits]).delete()
+        return len(hits)
+
+    def _group(self, hits):
+        # (label, pk, bucket, field, amount) tuples -> summed plain and bucket deltas
+        plain = defaultdict(int)  # (model, field, pk) -> delta
+        buckets = defaultdict(int)  # (model, field, bucket JSON) -> delta
+        for label, pk, bucket, field, amount in hits:
+            model = apps.get_model(label)
+            if bucket:
+                buckets[(model, field, bucket)] += amount
+            else:
+                plain[(model, field, pk)] += amount
+        return plain, buckets
+
+    def _apply(self, plain, buckets):
+        # Rows that got the same increment on the same field share one UPDATE
+        groups = defaultdict(list)
+        for (model, field, pk), delta in plain.items():
+            if delta:
+                groups[(model, field, delta)].append(pk)
+        for (model, field, delta), pks in groups.items():
+            model.objects.filter(pk__in=pks).update(**{field: F(field) + delta})
+        if buckets:
+            self._flush_buckets(buckets)
+
+    def _flush_buckets(self, buckets):
+        # Make sure every bucket row exists, then add deltas like plain counters
+        keys_by_model = defaultdict(set)
+        groups = defaultdict(list)
+        for (model, field, bucket), delta in buckets.items():
+            keys_by_model[model].add(bucket)
+            if delta:
+                groups[(model, field, delta)].append(json.loads(bucket))
+
+        for model, bucket_keys in keys_by_model.items():
+            keys = self._live_keys(model, [json.loads(bucket) for bucket in bucket_keys])
+            model.objects.bulk_create([model(**key) for key in keys], ignore_conflicts=True)
+        for (model, field, delta), keys in groups.items():
+            for start in range(0, len(keys), 100):
+                condition = reduce(operator.or_, (Q(**key) for key in keys[start:start + 100]))
+                model.objects.filter(condition).update(**{field: F(field) + delta})
+
+    def _live_keys(self, model, keys):
+        # Bucket rows of a deleted parent would fail the whole batch, so they are dropped
+        for field in model._meta.concrete_fields:
+            if not field.many_to_one:
+                continue
+            ids = {key[field.attname] for key in keys if field.attname in key}
+            if ids:
+                existing = set(field.related_model._base_manager.filter(pk__in=ids).values_list('pk', flat=True))
+                keys = [key for key in keys if field.attname not in key or key[field.attname] in existing]
+        return keys
+
+
+counters = CounterService()
@@ -0,0 +1,217 @@
+"""
+Write-behind buffer and rollups for Cloud IDE execution logs.
+
+execute_code hands its log entry to `log_buffer.record()` and returns; entries
+are written with one bulk_create per batch from a background thread (or with
+the request when IDE_EXEC_LOG_FLUSH_INTERVAL is 0, as on Vercel). The
+`rollup_execution_logs` management command aggregates raw logs into
+IDEExecutionDailyStats and prunes raw rows past the retention limits. Days
+still being recomputed are never pruned, so a day's stats are final once it
+leaves the rollup window.
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .flushing import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionLogBuffer:
+    """Thread-safe in-process buffer of pending IDEExecutionLog rows"""
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flusher = PeriodicFlusher('ide-exec-log-flusher', self.flush, lambda: self.flush_interval)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'IDE_EXEC_LOG_BATCH_SIZE', 50)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'IDE_EXEC_LOG_FLUSH_INTERVAL', 5)
+
+    def record(self, project_id, file_path, code, output, error, execution_time, was_successful):
+        """Queue one execution log; the file is resolved from its path at flush time"""
+        entry = {
+            'project_id': project_id,
+            'file_path': file_path,
+            'code_snippet': code[:1000],  # Store first 1000 chars
+            'output': output[:5000],  # Store first 5000 chars
+            'error': error[:5000],
+            'execution_time': execution_time,
+            'was_successful': was_successful,
+            'executed_at': timezone.now(),
+        }
+        if self.flush_interval <= 0:
+            with self._lock:
+                self._pending.append(entry)
+            self.flush()
+            return
+        with self._lock:
+            self._pending.append(entry)
+            full = len(self._pending) >= self.batch_size
+        self._flusher.start()
+        if full:
+            self._flusher.wake()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write all pending logs; returns the number of rows created"""
+        from .models import IDEExecutionLog, IDEFile
+
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+
+        try:
+            # One query resolves the files for every project in the batch
+            project_ids = {entry['project_id'] for entry in batch}
+            paths = {entry['file_path'] for entry in batch if entry['file_path']}
+            files = {}
+            if paths:
+                for file_id, project_id, path in IDEFile.objects.filter(
+                    project_id__in=project_ids, path__in=paths
+                ).values_list('id', 'project_id', 'path'):
+                    files[(project_id, path)] = file_id
+
+            logs = [
+                IDEExecutionLog(
+                    file_id=files.get((entry['project_id'], entry['file_path'])),
+                    **{key: value for key, value in entry.items() if key != 'file_path'}
+                )
+                for entry in batch
+            ]
+            IDEExecutionLog.objects.bulk_create(logs, batch_size=self.batch_size)
+            return len(logs)
+        except Exception:
+            logger.exception('Failed to flush %d IDE execution logs', len(batch))
+            self._requeue(batch)
+            return 0
+
+    def _requeue(self, batch):
+        # Logs of deleted projects can never be written; the rest wait for the next flush
+        from .models import IDEProject
+
+        try:
+            live = set(IDEProject.objects.filter(
+                pk__in={entry['project_id'] for entry in batch}
+            ).values_list('pk', flat=True))
+            batch = [entry for entry in batch if entry['project_id'] in live]
+        except Exception:
+            pass  # Database unreachable: keep everything
+        with self._lock:
+            self._pending[:0] = batch
+
+
+log_buffer = ExecutionLogBuffer()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def rollup_daily_stats(since):
+    """Recompute IDEExecutionDailyStats for every project/day from `since` onwards"""
+    from .models import IDEExecutionLog, IDEExecutionDailyStats
+
+    buckets = {}
+    rows = IDEExecutionLog.objects.filter(executed_at__gte=since).values_list(
+        'project_id', 'executed_at', 'execution_time', 'was_successful'
+    )
+    for project_id, executed_at, execution_time, was_successful in rows.iterator():
+        day = timezone.localdate(executed_at)
+        bucket = buckets.setdefault((project_id, day), {'times': [], 'failed': 0})
+        bucket['times'].append(execution_time)
+        if not was_successful:
+            bucket['failed'] += 1
+
+    stats = []
+    for (project_id, day), bucket in buckets.items():
+        times = sorted(bucket['times'])
+        stats.append(IDEExecutionDailyStats(
+            project_id=project_id,
+            date=day,
+            total_runs=len(times),
+            failed_runs=bucket['failed'],
+            avg_time=sum(times) / len(times),
+            p50_time=percentile(times, 0.50),
+            p95_time=percentile(times, 0.95),
+            updated_at=timezone.now(),
+        ))
+
+    IDEExecutionDailyStats.objects.bulk_create(
+        stats,
+        update_conflicts=True,
+        unique_fields=['project', 'date'],
+        update_fields=['total_runs', 'failed_runs', 'avg_time', 'p50_time', 'p95_time', 'updated_at'],
+    )
+    return len(stats)
+
+
+def prune_execution_logs(keep_last=None, keep_days=None, batch_size=1000, before=None):
+    """
+    Delete raw logs older than `keep_days` or beyond the newest `keep_last` per
+    project. Only logs older than `before` are touched: pass the start of the
+    window rollup_daily_stats recomputes, so no day is rebuilt from a pruned set.
+    """
+    from .models import IDEExecutionLog
+
+    if keep_last is None:
+        keep_last = getattr(settings, 'IDE_EXEC_LOG_KEEP_LAST', 500)
+    if keep_days is None:
+        keep_days = getattr(settings, 'IDE_EXEC_LOG_KEEP_DAYS', 30)
+    logs = IDEExecutionLog.objects.all()
+    if before is not None:
+        logs = logs.filter(executed_at__lt=before)
+
+    deleted = 0
+    cutoff = timezone.now() - timedelta(days=keep_days)
+    deleted += _delete_in_batches(logs.filter(executed_at__lt=cutoff), batch_size)
+
+    # Only projects over the limit need a per-project cutoff
+    keep_last = max(keep_last, 1)
+    over_limit = list(
+        IDEExecutionLog.objects.values('project_id')
+        .annotate(total=Count('id'))
+        .filter(total__gt=keep_last)
+        .values_list('project_id', flat=True)
+    )
+    for project_id in over_limit:
+        boundary = (
+            IDEExecutionLog.objects.filter(project_id=project_id)
+            .order_by('-executed_at', '-id')
+            .values_list('executed_at', 'id')[keep_last - 1]
+        )
+        deleted += _delete_in_batches(
+            logs.filter(project_id=project_id, executed_at__lt=boundary[0]),
+            batch_size
+        )
+    return deleted
+
+
+def _delete_in_batches(queryset, batch_size):
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by().values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            count, _ = queryset.model.objects.filter(id__in=ids).delete()
+        deleted += count
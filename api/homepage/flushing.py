@@ -0,0 +1,53 @@
+"""
+Background flushing for the in-process write-behind buffers: IDE execution
+logs (execution_logs.py), live collaborative sessions (collab.py) and IDE
+documents (ide_collab.py).
+
+`PeriodicFlusher(name, flush, interval)` runs `flush()` on a daemon thread
+every `interval()` seconds, or sooner after `wake()`, and once more at
+interpreter exit. Whatever is pending when a process is killed is lost, so
+a buffer's `flush()` must put back what it failed to write for the next run
+rather than drop it. Counters do not use this: they are logged to the
+database (see counters.py).
+"""
+import atexit
+import logging
+import threading
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicFlusher:
+    def __init__(self, name, flush, interval):
+        self.name = name
+        self._flush = flush
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(flush)
+
+    def start(self):
+        """Start the thread unless it is already running"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Flush now instead of at the end of the interval"""
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval())
+            self._wakeup.clear()
+            try:
+                self._flush()
+            except Exception:
+                logger.exception('%s failed to flush', self.name)
+            finally:
+                # The thread owns its own DB connection
+                connection.close()
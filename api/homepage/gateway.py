@@ -0,0 +1,375 @@
+"""
+Per-user gateway: one WebSocket (`ws/gateway/`) carrying every server,
+DM, friend and presence event for the signed-in user.
+
+A connection sends `identify` (or `resume`) and gets a `ready` frame with
+the user's servers, channels, friends and unread badges. Server-side the
+consumer joins one group per server the user is a member of, one for the
+user, and one presence group per friend; membership and friendship signals
+add and drop those subscriptions while the socket is open.
+
+Durable events arrive as numbered dispatches:
+
+    {"type": "dispatch", "seq": 12, "event": "message_create", "data": {...}}
+
+  message_create, reaction_add, channel_create  (gateway_server_<server pk>)
+  dm_create, friend_update, server_join, server_leave  (gateway_user_<user id>)
+
+Typing and online status travel as coalesced `presence` frames (see
+presence.py) and are not numbered.
+
+When a socket drops, its session (sequence number and the last
+GATEWAY_REPLAY_SIZE dispatches) is kept in the database (GatewaySession) for
+GATEWAY_RESUME_TIMEOUT seconds, so any worker can resume it. `{"type": "resume", "session_id", "seq"}` on
+a new socket replays the dispatches the client had not seen, then the
+channel messages and DMs written while it was away, and ends with
+`resumed`. Other events missed in between (reactions, friend changes) are
+not replayed. If the session expired or too much was missed the client gets
+`invalid_session` and should identify again and reload over HTTP. Messages
+written while the new socket subscribes may be delivered twice; clients
+de-duplicate by message id. Events are sent once the write that caused
+them commits.
+
+Every identified socket has a GatewayConnection row, and a user is online
+while one of theirs has not expired. Rows expire GATEWAY_CONNECTION_TIMEOUT
+seconds after the last `heartbeat` (clients send one every
+`heartbeat_interval` seconds, given in `ready` and `resumed`), so the connections of a
+crashed worker stop counting on their own. The `expire_gateway_state`
+command deletes expired rows and marks their users offline.
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .wire import encode_frame
+
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    return f'gateway_user_{user_id}'
+
+
+def server_group(server_pk):
+    return f'gateway_server_{server_pk}'
+
+
+def presence_group(user_id):
+    return f'gateway_presence_{user_id}'
+
+
+def replay_size():
+    return getattr(settings, 'GATEWAY_REPLAY_SIZE', 500)
+
+
+def resume_timeout():
+    return getattr(settings, 'GATEWAY_RESUME_TIMEOUT', 300)
+
+
+def connection_timeout():
+    return getattr(settings, 'GATEWAY_CONNECTION_TIMEOUT', 120)
+
+
+def heartbeat_interval():
+    """Seconds between client heartbeats; a few may be lost before a connection expires"""
+    return max(connection_timeout() // 3, 1)
+
+
+def _group_send(group, message):
+    # Called from model signals: nothing is sent for a write that rolls back, or
+    # before clients could read it back, and a broken channel layer must not fail it
+    def send():
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        try:
+            async_to_sync(layer.group_send)(group, message)
+        except Exception:
+            logger.exception('Failed to send %s to %s', message.get('type'), group)
+    transaction.on_commit(send)
+
+
+def dispatch(group, event, data):
+    """Send a numbered event to every gateway subscribed to `group`"""
+    _group_send(group, {'type': 'gateway_dispatch', 'event': event, 'data': data})
+
+
+def subscribe(user_id, groups, event=None, data=None):
+    """Add groups to the user's open gateways, optionally followed by an event"""
+    _group_send(user_group(user_id), {'type': 'gateway_subscribe', 'groups': groups, 'event': event, 'data': data})
+
+
+def unsubscribe(user_id, groups, event=None, data=None):
+    """Drop groups from the user's open gateways, optionally followed by an event"""
+    _group_send(user_group(user_id), {'type': 'gateway_unsubscribe', 'groups': groups, 'event': event, 'data': data})
+
+
+# Event payloads
+
+# Shaped like the HTTP message lists, so clients render them the same way
+
+def server_message_data(message):
+    sender = message.sender
+    reply_to = message.reply_to if message.reply_to_id else None
+    return {
+        'channel_id': str(message.channel.channel_id),
+        'message': {
+            'message_id': str(message.message_id),
+            'sender': {
+                'id': sender.id,
+                'username': sender.username,
+                'profile_picture': sender.profile.get_profile_picture_url() if hasattr(sender, 'profile') else None,
+            },
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'is_edited': message.is_edited,
+            'reactions': [],
+            'reply_to': {
+                'message_id': str(reply_to.message_id),
+                'sender_username': reply_to.sender.username,
+                'content': reply_to.content[:100],
+            } if reply_to else None,
+        },
+    }
+
+
+def direct_message_data(message):
+    sender = message.sender
+    return {
+        'message': {
+            'id': message.id,
+            'sender_id': sender.id,
+            'sender_username': sender.username,
+            'sender_profile_picture': sender.profile.profile_picture_url if hasattr(sender, 'profile') else None,
+            'recipient_id': message.recipient_id,
+            'message': message.message,
+            'created_at': message.created_at.isoformat(),
+        },
+    }
+
+
+def publish_server_message(message):
+    dispatch(server_group(message.channel.server_id), 'message_create', server_message_data(message))
+
+
+def publish_direct_message(message):
+    data = direct_message_data(message)
+    for user_id in {message.sender_id, message.recipient_id}:
+        dispatch(user_group(user_id), 'dm_create', data)
+
+
+def publish_reaction(reaction):
+    from .models import ServerChannel
+
+    message = reaction.message
+    channel_id, server_pk = ServerChannel.objects.values_list('channel_id', 'server_id').get(pk=message.channel_id)
+    dispatch(server_group(server_pk), 'reaction_add', {
+        'channel_id': str(channel_id),
+        'message_id': str(message.message_id),
+        'user_id': reaction.user_id,
+        'emoji': reaction.emoji,
+    })
+
+
+def publish_channel(channel):
+    dispatch(server_group(channel.server_id), 'channel_create', {
+        'channel_id': str(channel.channel_id),
+        'name': channel.name,
+        'channel_type': channel.channel_type,
+    })
+
+
+def publish_membership(member, joined):
+    from .models import Server
+
+    # None while the server itself is being deleted
+    server_id = Server.objects.filter(pk=member.server_id).values_list('server_id', flat=True).first()
+    data = {'server_id': str(server_id) if server_id else None}
+    if joined:
+        subscribe(member.user_id, [server_group(member.server_id)], 'server_join', data)
+    else:
+        unsubscribe(member.user_id, [server_group(member.server_id)], 'server_leave', data)
+
+
+def publish_friendship(friendship, deleted=False):
+    status = 'removed' if deleted else friendship.status
+    pairs = ((friendship.from_user_id, friendship.to_user), (friendship.to_user_id, friendship.from_user))
+    for user_id, other in pairs:
+        data = {'user_id': other.id, 'username': other.username, 'status': status}
+        if status == 'accepted':
+            subscribe(user_id, [presence_group(other.id)], 'friend_update', data)
+        elif status in ('removed', 'blocked'):
+            unsubscribe(user_id, [presence_group(other.id)], 'friend_update', data)
+        else:
+            dispatch(user_group(user_id), 'friend_update', data)
+
+
+# Ready state and resuming
+
+def ready_state(user):
+    """(groups to join, ready payload) for a user's new session"""
+    from .models import Friendship, ServerChannel, ServerMember, UserStatus
+    from .read_states import unread_badges
+
+    servers = {
+        pk: {'server_id': str(server_id), 'name': name, 'icon_url': icon_url, 'channels': []}
+        for pk, server_id, name, icon_url in ServerMember.objects.filter(user=user).values_list(
+            'server_id', 'server__server_id', 'server__name', 'server__icon_url'
+        )
+    }
+    for channel in ServerChannel.objects.filter(server_id__in=list(servers)).values(
+        'server_id', 'channel_id', 'name', 'channel_type'
+    ).order_by('position', 'created_at'):
+        servers[channel.pop('server_id')]['channels'].append(dict(channel, channel_id=str(channel['channel_id'])))
+
+    friend_ids = [
+        to_id if from_id == user.id else from_id
+        for from_id, to_id in Friendship.objects.filter(
+            Q(from_user=user) | Q(to_user=user), status='accepted'
+        ).values_list('from_user_id', 'to_user_id')
+    ]
+    online = set(UserStatus.objects.filter(user_id__in=friend_ids, is_online=True).values_list('user_id', flat=True))
+
+    groups = [user_group(user.id)] + [server_group(pk) for pk in servers] + [presence_group(pk) for pk in friend_ids]
+    payload = {
+        'user': {'id': user.id, 'username': user.username},
+        'servers': list(servers.values()),
+        'friends': [{'id': pk, 'is_online': pk in online} for pk in friend_ids],
+        'unread': unread_badges(user),
+        'heartbeat_interval': heartbeat_interval(),
+    }
+    return groups, payload
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def save_session(session_id, user_id, seq, events):
+    """Keep a dropped session resumable: its sequence and recent (seq, event, data) dispatches"""
+    from .models import GatewaySession
+
+    now = timezone.now()
+    GatewaySession.objects.update_or_create(session_id=session_id, defaults={
+        'user_id': user_id,
+        'seq': seq,
+        'events': [list(event) for event in events][-replay_size():],
+        'disconnected_at': now,
+        'expires_at': now + timedelta(seconds=resume_timeout()),
+    })
+
+
+def pop_session(session_id, user_id):
+    """The user's saved session, removed so it is resumed at most once; None if it expired or is not theirs"""
+    from .models import GatewaySession
+
+    session = GatewaySession.objects.filter(
+        session_id=session_id, user_id=user_id, expires_at__gt=timezone.now()
+    ).values('pk', 'user_id', 'seq', 'events', 'disconnected_at').first()
+    # Only the worker whose delete removes the row resumes it
+    if session is None or not GatewaySession.objects.filter(pk=session['pk']).delete()[0]:
+        return None
+    return session
+
+
+def missed_events(user, since):
+    """
+    [(event, data)] for channel messages and DMs written after `since`, oldest
+    first, or None if there are more than GATEWAY_REPLAY_SIZE of them.
+    """
+    from .models import DirectMessage, ServerMember, ServerMessage
+
+    limit = replay_size()
+    messages = list(
+        ServerMessage.objects.filter(
+            channel__server_id__in=ServerMember.objects.filter(user=user).values('server_id'),
+            timestamp__gt=since,
+        ).select_related('channel', 'sender__profile', 'reply_to__sender').order_by('timestamp', 'id')[:limit + 1]
+    )
+    direct = list(
+        DirectMessage.objects.filter(
+            Q(sender=user) | Q(recipient=user), created_at__gt=since
+        ).select_related('sender__profile').order_by('created_at', 'id')[:limit + 1]
+    )
+    if len(messages) + len(direct) > limit:
+        return None
+    events = [(message.timestamp, 'message_create', server_message_data(message)) for message in messages]
+    events += [(message.created_at, 'dm_create', direct_message_data(message)) for message in direct]
+    events.sort(key=lambda event: event[0])
+    return [(event, data) for _, event, data in events]
+
+
+def _publish_status(user, online):
+    # Outside a consumer there is no coalescer; a status change is a frame of its own
+    update = {'kind': 'status', 'user_id': user.id, 'username': user.username,
+              'status': 'online' if online else 'offline'}
+    _group_send(presence_group(user.id),
+                dict(encode_frame({'type': 'presence', 'updates': [update]}), type='presence_frame'))
+
+
+def _sync_status(user, now):
+    """Make UserStatus match the user's live connections; True if it changed. Call in a transaction."""
+    from .models import GatewayConnection, UserStatus
+
+    # Locking the status row serializes the user's sockets opening and closing
+    status, _ = UserStatus.objects.select_for_update().get_or_create(user=user)
+    online = GatewayConnection.objects.filter(user=user, expires_at__gt=now).exists()
+    if status.is_online == online:
+        return False
+    status.update_status(is_online=online)
+    return True
+
+
+def set_online(user, connection_id, online):
+    """Record a gateway socket opening or closing; returns True when the user's status changed"""
+    from .models import GatewayConnection
+
+    now = timezone.now()
+    with transaction.atomic():
+        if online:
+            GatewayConnection.objects.update_or_create(channel_name=connection_id, defaults={
+                'user': user, 'expires_at': now + timedelta(seconds=connection_timeout()),
+            })
+        else:
+            GatewayConnection.objects.filter(channel_name=connection_id).delete()
+        return _sync_status(user, now)
+
+
+def refresh_connection(connection_id):
+    """Keep an open socket's connection alive after a heartbeat"""
+    from .models import GatewayConnection
+
+    GatewayConnection.objects.filter(channel_name=connection_id).update(
+        expires_at=timezone.now() + timedelta(seconds=connection_timeout())
+    )
+
+
+def expire_gateway_state():
+    """
+    Delete expired sessions and connections, and mark users whose last
+    connection expired offline. Returns (sessions, connections, users offline).
+    """
+    from django.contrib.auth.models import User
+    from .models import GatewayConnection, GatewaySession
+
+    now = timezone.now()
+    sessions, _ = GatewaySession.objects.filter(expires_at__lte=now).delete()
+    expired = GatewayConnection.objects.filter(expires_at__lte=now)
+    user_ids = set(expired.values_list('user_id', flat=True))
+    connections, _ = expired.delete()
+
+    offline = 0
+    for user in User.objects.filter(pk__in=user_ids):
+        with transaction.atomic():
+            changed = _sync_status(user, now)
+        if changed:
+            _publish_status(user, False)
+            offline += 1
+    return sessions, connections, offline
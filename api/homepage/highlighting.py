@@ -0,0 +1,30 @@
+"""
+Server-side syntax highlighting for shared code pages.
+Pygments is listed in requirements.txt but still optional; without it
+highlight_code() returns '' and templates fall back to the plain, escaped
+source. Snippets saved that way are highlighted later by the
+`backfill_shared_code_highlighting` command.
+"""
+try:
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    _has_pygments = True
+except ImportError:
+    _has_pygments = False
+
+
+def highlight_code(code, language='python'):
+    """Highlighted HTML (inline styles, no wrapper) whose text content equals `code`"""
+    if not _has_pygments or not code:
+        return ''
+    try:
+        lexer = get_lexer_by_name(language, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        return ''
+    formatter = HtmlFormatter(nowrap=True, noclasses=True, style='monokai')
+    html = highlight(code, lexer, formatter)
+    if html.endswith('\n') and not code.endswith('\n'):
+        html = html[:-1]  # Pygments always ends with a newline
+    return html
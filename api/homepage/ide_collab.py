@@ -0,0 +1,210 @@
+"""
+Multi-file collaborative editing for IDE projects.
+
+Members of an IDE project (the owner and invited collaborators) open files
+over the `ws/ide/collaboration/<project_id>/` socket and send edits as the
+same insert/delete operations used by collaborative sessions (see collab.py),
+one sequence per file:
+
+    {"type": "change", "file_path": "main.py", "base_seq": 3, "ops": [...], "client_id": "..."}
+
+`ide_documents` keeps the authoritative text of every open file in memory,
+transforms late edits against the ops committed since their base and applies
+them. A background thread writes changed files every COLLAB_FLUSH_INTERVAL
+seconds through `save_files_batch`, one bulk UPDATE per project however many
+keystrokes arrived, and the last member leaving flushes and evicts the project.
+"""
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from .collab import InvalidOperation, StaleBaseError, apply_ops, diff_ops, oplog_size, transform, validate_ops
+from .flushing import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+
+class LiveFile:
+    """Authoritative in-memory text of one open project file"""
+
+    def __init__(self, code):
+        self.code = code
+        self.seq = 0
+        self.log = deque(maxlen=oplog_size())  # (seq, ops) for transforming late edits
+        self.dirty = False
+
+
+class LiveProject:
+    def __init__(self, pk):
+        self.pk = pk
+        self.files = {}  # path -> LiveFile
+        self.members = 0
+        self.lock = threading.Lock()
+
+
+class IDEDocumentStore:
+    """
+    Per-process registry of IDE projects being edited together.
+
+    Files are loaded on first open and only change in memory until flushed.
+    Sequence numbers restart when a project is evicted, so clients re-open
+    their files after reconnecting. All members of a project must be served
+    by the same process, as with the in-memory channel layer.
+    """
+
+    def __init__(self):
+        self._projects = {}
+        self._lock = threading.Lock()
+        self._flusher = PeriodicFlusher('ide-document-flusher', self.flush, lambda: self.flush_interval)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'COLLAB_FLUSH_INTERVAL', 2)
+
+    def get(self, project_id, create=True):
+        """The live project for `project_id`, registering it if needed"""
+        from .models import IDEProject
+
+        key = str(project_id)
+        with self._lock:
+            live = self._projects.get(key)
+        if live is not None or not create:
+            return live
+
+        pk = IDEProject.objects.values_list('pk', flat=True).get(project_id=project_id)
+        with self._lock:
+            live = self._projects.setdefault(key, LiveProject(pk))
+        self._flusher.start()
+        return live
+
+    def join(self, project_id):
+        live = self.get(project_id)
+        with live.lock:
+            live.members += 1
+        return live
+
+    def leave(self, project_id):
+        """Drop a connection; the last one out flushes the project and evicts it"""
+        live = self.get(project_id, create=False)
+        if live is None:
+            return
+        with live.lock:
+            live.members -= 1
+            empty = live.members <= 0
+        if empty:
+            self.flush(project_id)
+            with self._lock:
+                if live.members <= 0 and self._projects.get(str(project_id)) is live:
+                    del self._projects[str(project_id)]
+
+    def _file(self, live, path):
+        # Caller holds live.lock
+        try:
+            return live.files[path]
+        except KeyError:
+            raise InvalidOperation('File is not open') from None
+
+    def open_file(self, project_id, path):
+        """(content, seq) of a project file, loading it on first open; raises IDEFile.DoesNotExist"""
+        from .models import IDEFile
+
+        live = self.get(project_id)
+        with live.lock:
+            if path in live.files:
+                return live.files[path].code, live.files[path].seq
+        content = IDEFile.objects.values_list('content', flat=True).get(project_id=live.pk, path=path)
+        with live.lock:
+            # Another member may have opened it meanwhile
+            doc = live.files.setdefault(path, LiveFile(content))
+            return doc.code, doc.seq
+
+    def is_open(self, project_id, path):
+        live = self.get(project_id, create=False)
+        if live is None:
+            return False
+        with live.lock:
+            return path in live.files
+
+    def close_file(self, project_id, path):
+        """Forget an open file, or every open file under a directory, without writing it"""
+        live = self.get(project_id, create=False)
+        if live is not None:
+            with live.lock:
+                for open_path in list(live.files):
+                    if open_path == path or open_path.startswith(path + '/'):
+                        del live.files[open_path]
+
+    def submit_ops(self, project_id, path, base_seq, ops):
+        """
+        Sequence operations made against `base_seq` of an open file.
+
+        Returns (seq, ops) with the ops rewritten to apply at the new head, or
+        (None, []) if nothing remains after transforming. Raises
+        InvalidOperation or StaleBaseError; the client should re-open the file then.
+        """
+        ops = validate_ops(ops)
+        if not isinstance(base_seq, int):
+            raise InvalidOperation('base_seq must be an integer')
+        live = self.get(project_id)
+        with live.lock:
+            doc = self._file(live, path)
+            if base_seq > doc.seq:
+                raise StaleBaseError('Base sequence is ahead of the file')
+            concurrent = [log_ops for log_seq, log_ops in doc.log if log_seq > base_seq]
+            if len(concurrent) != doc.seq - base_seq:
+                raise StaleBaseError('Operations since the base sequence are no longer available')
+
+            for committed in concurrent:
+                ops, _ = transform(ops, committed)
+            if not ops:
+                return None, []
+            doc.code = apply_ops(doc.code, ops)
+            doc.seq += 1
+            doc.log.append((doc.seq, ops))
+            doc.dirty = True
+            return doc.seq, ops
+
+    def submit_text(self, project_id, path, code):
+        """Sequence a full-text update of an open file as a diff against its head"""
+        if not isinstance(code, str):
+            raise InvalidOperation('content must be a string')
+        live = self.get(project_id)
+        with live.lock:
+            doc = self._file(live, path)
+            base_seq, ops = doc.seq, diff_ops(doc.code, code)
+        return self.submit_ops(project_id, path, base_seq, ops)
+
+    def flush(self, project_id=None):
+        """Write changed files of every project (or just `project_id`); returns the number of files written"""
+        from .ide_views import save_files_batch
+
+        with self._lock:
+            if project_id is None:
+                projects = list(self._projects.values())
+            else:
+                projects = [live for live in [self._projects.get(str(project_id))] if live]
+
+        written = 0
+        for live in projects:
+            with live.lock:
+                files = {path: doc.code for path, doc in live.files.items() if doc.dirty}
+                for path in files:
+                    live.files[path].dirty = False
+            if not files:
+                continue
+            try:
+                # Files deleted in the meantime are not brought back
+                created, updated = save_files_batch(live.pk, files, create=False)
+                written += len(updated)
+            except Exception:
+                logger.exception('Failed to flush %d file(s) of IDE project %s', len(files), live.pk)
+                with live.lock:
+                    for path in files:
+                        if path in live.files:
+                            live.files[path].dirty = True
+        return written
+
+
+ide_documents = IDEDocumentStore()
@@ -1,15 +1,18 @@
 """
 WebSocket consumers for Cloud IDE real-time features
 """
-import json
 import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import IDEProject, IDETerminalSession
+from .models import IDEProject, IDEFile, IDETerminalSession
+from .collab import InvalidOperation, StaleBaseError
+from .ide_collab import ide_documents
+from .presence import presence
+from .wire import WireDecodeError, WireProtocolMixin
 
 
-class IDETerminalConsumer(AsyncWebsocketConsumer):
+class IDETerminalConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time terminal output in IDE
     """
@@ -39,11 +42,11 @@ class IDETerminalConsumer(AsyncWebsocketConsumer):
         await self.accept()
         
         # Send welcome message
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'system',
             'message': 'Terminal connected',
             'timestamp': self.get_timestamp()
-        }))
+        })
     
     async def disconnect(self, close_code):
         # Leave room group
@@ -53,20 +56,20 @@ class IDETerminalConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receive message from WebSocket
         """
         try:
-            data = json.loads(text_data)
+            data = self.decode_message(text_data, bytes_data)
             message_type = data.get('type', 'message')
             
             if message_type == 'ping':
                 # Respond to ping with pong
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'pong',
                     'timestamp': self.get_timestamp()
-                }))
+                })
             
             elif message_type == 'output':
                 # Broadcast terminal output to all connected clients
@@ -84,36 +87,36 @@ class IDETerminalConsumer(AsyncWebsocketConsumer):
             elif message_type == 'command':
                 # Handle command execution (future feature)
                 command = data.get('command', '')
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'info',
                     'message': f'Command received: {command}',
                     'timestamp': self.get_timestamp()
-                }))
+                })
         
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+        except WireDecodeError:
+            await self.send_message({
                 'type': 'error',
-                'message': 'Invalid JSON',
+                'message': 'Invalid message',
                 'timestamp': self.get_timestamp()
-            }))
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': str(e),
                 'timestamp': self.get_timestamp()
-            }))
+            })
     
     async def terminal_output(self, event):
         """
         Receive terminal output from room group
         """
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'output',
             'output': event['output'],
             'error': event['error'],
             'user': event['user'],
             'timestamp': event['timestamp']
-        }))
+        })
     
     @database_sync_to_async
     def check_project_access(self):
@@ -135,10 +138,13 @@ class IDETerminalConsumer(AsyncWebsocketConsumer):
         return timezone.now().isoformat()
 
 
-class IDECollaborationConsumer(AsyncWebsocketConsumer):
+class IDECollaborationConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     """
-    WebSocket consumer for real-time collaborative editing
-    Future feature: Multiple users editing same project
+    WebSocket consumer for real-time collaborative editing of IDE projects.
+    
+    The owner and invited collaborators open files and send sequenced edit
+    ops; ide_documents applies them to the shared in-memory copy and writes
+    them back to IDEFile in batches (see ide_collab.py).
     """
     
     async def connect(self):
@@ -151,11 +157,15 @@ class IDECollaborationConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
-        # Verify project access
-        has_access = await self.check_project_access()
-        if not has_access:
+        # Verify project access (owner or collaborator)
+        self.permission = await self.check_project_access()
+        if not self.permission:
             await self.close()
             return
+        self.can_edit = self.permission in ('owner', 'edit')
+        
+        await self.join_documents()
+        self.joined = True
         
         # Join room group
         await self.channel_layer.group_add(
@@ -176,7 +186,8 @@ class IDECollaborationConsumer(AsyncWebsocketConsumer):
         )
     
     async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_name'):
+        if getattr(self, 'joined', False):
+            self.joined = False
             # Notify others of user leaving
             await self.channel_layer.group_send(
                 self.room_group_name,
@@ -192,100 +203,167 @@ class IDECollaborationConsumer(AsyncWebsocketConsumer):
                 self.room_group_name,
                 self.channel_name
             )
+            
+            # The last member out writes the project's open files
+            await self.leave_documents()
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receive collaborative editing events
         """
         try:
-            data = json.loads(text_data)
+            data = self.decode_message(text_data, bytes_data)
             event_type = data.get('type', 'change')
             
-            if event_type == 'change':
-                # Broadcast code changes to other users
+            if event_type == 'open':
+                await self.open_file(data.get('file_path', ''))
+            
+            elif event_type == 'change':
+                if not self.can_edit:
+                    await self.send_message({
+                        'type': 'error',
+                        'message': 'You do not have edit permission'
+                    })
+                    return
+                
+                file_path = data.get('file_path', '')
+                client_id = data.get('client_id')
+                try:
+                    seq, ops = await self.submit_ops(file_path, data.get('base_seq'), data.get('ops'))
+                except (InvalidOperation, StaleBaseError) as e:
+                    # Hand the client the current file to rebase its unsent edits on
+                    await self.open_file(file_path, resync=str(e))
+                    return
+                
+                if seq is None:
+                    # Fully cancelled by concurrent edits; nothing to broadcast
+                    await self.send_message({'type': 'ack', 'file_path': file_path, 'seq': None})
+                    return
+                
                 await self.channel_layer.group_send(
                     self.room_group_name,
                     {
                         'type': 'code_change',
-                        'file_path': data.get('file_path', ''),
-                        'changes': data.get('changes', []),
+                        'file_path': file_path,
+                        'seq': seq,
+                        'ops': ops,
                         'user': self.user.username,
+                        'client_id': client_id,
+                        'origin': self.channel_name,
                         'timestamp': self.get_timestamp()
                     }
                 )
             
             elif event_type == 'cursor':
-                # Broadcast cursor position
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'cursor_position',
-                        'file_path': data.get('file_path', ''),
-                        'position': data.get('position', {}),
-                        'user': self.user.username,
-                        'timestamp': self.get_timestamp()
-                    }
+                # Coalesced with other presence updates into one frame per tick
+                await presence.publish(
+                    self.channel_layer, self.room_group_name, 'cursor', self.user.id,
+                    user=self.user.username,
+                    file_path=data.get('file_path', ''),
+                    position=data.get('position', {}),
+                    timestamp=self.get_timestamp(),
                 )
         
-        except json.JSONDecodeError:
+        except WireDecodeError:
             pass
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
+    
+    async def open_file(self, file_path, resync=None):
+        """Send the current content and sequence of a file, loading it if needed"""
+        try:
+            content, seq = await self.load_file(file_path)
+        except IDEFile.DoesNotExist:
+            await self.send_message({
+                'type': 'error',
+                'file_path': file_path,
+                'message': 'File not found'
+            })
+            return
+        
+        message = {
+            'type': 'resync' if resync else 'file_state',
+            'file_path': file_path,
+            'content': content,
+            'seq': seq
+        }
+        if resync:
+            message['message'] = resync
+        await self.send_message(message)
     
     async def user_joined(self, event):
         """Handle user joined event"""
         if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'user_joined',
                 'username': event['username'],
                 'timestamp': event['timestamp']
-            }))
+            })
     
     async def user_left(self, event):
         """Handle user left event"""
         if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'user_left',
                 'username': event['username'],
                 'timestamp': event['timestamp']
-            }))
+            })
     
     async def code_change(self, event):
-        """Handle code change event"""
-        if event['user'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'code_change',
+        """Relay a sequenced edit; the sender only gets an acknowledgement"""
+        if event['origin'] == self.channel_name:
+            await self.send_message({
+                'type': 'ack',
                 'file_path': event['file_path'],
-                'changes': event['changes'],
-                'user': event['user'],
-                'timestamp': event['timestamp']
-            }))
+                'seq': event['seq']
+            })
+            return
+        await self.send_message({
+            'type': 'code_change',
+            'file_path': event['file_path'],
+            'seq': event['seq'],
+            'ops': event['ops'],
+            'user': event['user'],
+            'client_id': event['client_id'],
+            'timestamp': event['timestamp']
+        })
     
-    async def cursor_position(self, event):
-        """Handle cursor position event"""
-        if event['user'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_position',
-                'file_path': event['file_path'],
-                'position': event['position'],
-                'user': event['user'],
-                'timestamp': event['timestamp']
-            }))
+    async def presence_frame(self, event):
+        """Relay a coalesced cursor frame, encoded once per protocol for the group"""
+        await self.send_frame(event)
+    
+    async def collaborator_removed(self, event):
+        """Close the socket of a collaborator whose access was revoked"""
+        if str(event['user_id']) == str(self.user.id) and self.permission != 'owner':
+            await self.close()
     
     @database_sync_to_async
     def check_project_access(self):
-        """Check if user has access to the project"""
+        """The user's permission on the project ('owner', 'edit', 'view') or None"""
         try:
-            project = IDEProject.objects.get(
-                project_id=self.project_id,
-                user=self.user
-            )
-            return True
+            project = IDEProject.objects.only('id', 'user_id').get(project_id=self.project_id)
         except IDEProject.DoesNotExist:
-            return False
+            return None
+        return project.permission_for(self.user)
+    
+    @database_sync_to_async
+    def join_documents(self):
+        ide_documents.join(self.project_id)
+    
+    @database_sync_to_async
+    def leave_documents(self):
+        ide_documents.leave(self.project_id)
+    
+    @database_sync_to_async
+    def load_file(self, file_path):
+        return ide_documents.open_file(self.project_id, file_path)
+    
+    @database_sync_to_async
+    def submit_ops(self, file_path, base_seq, ops):
+        return ide_documents.submit_ops(self.project_id, file_path, base_seq, ops)
     
     def get_timestamp(self):
         """Get current timestamp"""
@@ -2,10 +2,11 @@
 Views for Cloud IDE functionality for paid users
 """
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST, require_http_methods
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 from django.conf import settings
@@ -20,8 +21,11 @@ from pathlib import Path
 
 from .models import (
     IDEProject, IDEDirectory, IDEFile, IDEExecutionLog, 
-    IDETerminalSession, UserProfile
+    IDETerminalSession, IDEExecutionDailyStats, IDEProjectCollaborator, UserProfile
 )
+from .execution_logs import log_buffer
+from .ide_collab import ide_documents
+from .pagination import keyset_page, approximate_count
 
 
 # ==================== IDE MAIN VIEW ====================
@@ -667,11 +671,104 @@ class APIResponse:
     }
 
 
+def get_accessible_project(request, project_id, edit=False):
+    """Project owned by or shared with the user (with edit permission if `edit`); 404 otherwise"""
+    project = get_object_or_404(IDEProject, project_id=project_id)
+    permission = project.permission_for(request.user)
+    if permission is None or (edit and permission == 'view'):
+        raise Http404('Project not found')
+    return project
+
+
+def _directories_for(project_pk, paths):
+    """IDEDirectory for the parent of each nested path, created as save_file does"""
+    directories = {}
+    for path in paths:
+        path_parts = path.split('/')
+        if len(path_parts) > 1:
+            dir_path = '/'.join(path_parts[:-1])
+            if dir_path not in directories:
+                directories[dir_path], _ = IDEDirectory.objects.get_or_create(
+                    project_id=project_pk,
+                    path=dir_path,
+                    defaults={'name': path_parts[-2]}
+                )
+    return directories
+
+
+def save_files_batch(project_pk, files, create=True):
+    """
+    Write {path: content} for one project: a single bulk UPDATE for existing
+    files plus a bulk INSERT for new ones (skipped unless `create`).
+    Returns (created_paths, updated_paths).
+    """
+    if not files:
+        return [], []
+    now = timezone.now()
+    with transaction.atomic():
+        existing = list(IDEFile.objects.filter(project_id=project_pk, path__in=list(files)).only('id', 'name', 'path'))
+        for file in existing:
+            file.content = files[file.path]
+            file.refresh_metadata()
+            file.updated_at = now
+        IDEFile.objects.bulk_update(existing, ['content', 'size', 'updated_at'])
+        updated = [file.path for file in existing]
+
+        created = []
+        if create:
+            new_paths = sorted(set(files) - set(updated))
+            directories = _directories_for(project_pk, new_paths)
+            new_files = []
+            for path in new_paths:
+                file = IDEFile(
+                    project_id=project_pk,
+                    directory=directories.get(path.rpartition('/')[0]),
+                    name=path.split('/')[-1],
+                    path=path,
+                    content=files[path],
+                )
+                file.refresh_metadata()
+                new_files.append(file)
+            IDEFile.objects.bulk_create(new_files)
+            created = new_paths
+    return created, updated
+
+
+def _sync_live_files(project_id, files):
+    """Apply saved contents to files open for collaborative editing and broadcast the edits"""
+    from channels.layers import get_channel_layer
+    from asgiref.sync import async_to_sync
+    
+    for path, content in files.items():
+        if not ide_documents.is_open(project_id, path):
+            continue
+        try:
+            seq, ops = ide_documents.submit_text(project_id, path, content)
+        except Exception:
+            # Closed meanwhile; members re-open it from the database
+            continue
+        if seq is None:
+            continue
+        async_to_sync(get_channel_layer().group_send)(
+            f'ide_collab_{project_id}',
+            {
+                'type': 'code_change',
+                'file_path': path,
+                'seq': seq,
+                'ops': ops,
+                'user': None,
+                'client_id': None,
+                'origin': None,
+                'timestamp': timezone.now().isoformat(),
+            }
+        )
+
+
 @login_required
 def get_project(request, project_id):
     """Get project details"""
     try:
-        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        project = get_accessible_project(request, project_id)
         project.update_access_time()
         
         return JsonResponse({
@@ -685,6 +782,8 @@ def get_project(request, project_id):
             }
         })
         
+    except Http404:
+        return JsonResponse({'status': 'error', 'message': 'Project not found'}, status=404)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
@@ -707,13 +806,108 @@ def delete_project(request, project_id):
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
+# ==================== COLLABORATORS ====================
+
+def _collaborator_data(collaborator):
+    return {
+        'user_id': collaborator.user_id,
+        'username': collaborator.user.username,
+        'permission': collaborator.permission,
+        'created_at': collaborator.created_at.isoformat()
+    }
+
+
+@login_required
+@require_http_methods(['GET', 'POST'])
+def project_collaborators(request, project_id):
+    """List a project's collaborators, or (owner only) invite one: {"username", "permission"}"""
+    try:
+        project = get_accessible_project(request, project_id)
+        
+        if request.method == 'GET':
+            collaborators = project.collaborators.select_related('user')
+            return JsonResponse({
+                'status': 'success',
+                'owner': project.user.username,
+                'collaborators': [_collaborator_data(c) for c in collaborators]
+            })
+        
+        if project.user_id != request.user.id:
+            return JsonResponse({'status': 'error', 'message': 'Only the owner can invite collaborators'}, status=403)
+        
+        data = json.loads(request.body)
+        username = data.get('username', '').strip()
+        permission = data.get('permission', 'edit')
+        if permission not in ['view', 'edit']:
+            return JsonResponse({'status': 'error', 'message': 'Invalid permission'}, status=400)
+        
+        from django.contrib.auth.models import User
+        try:
+            invitee = User.objects.get(username=username)
+        except User.DoesNotExist:
+            return JsonResponse({'status': 'error', 'message': 'User not found'}, status=404)
+        if invitee.id == project.user_id:
+            return JsonResponse({'status': 'error', 'message': 'The owner already has access'}, status=400)
+        
+        collaborator, created = IDEProjectCollaborator.objects.update_or_create(
+            project=project,
+            user=invitee,
+            defaults={'permission': permission, 'invited_by': request.user}
+        )
+        
+        return JsonResponse({
+            'status': 'success',
+            'message': f'{invitee.username} {"invited" if created else "updated"}',
+            'collaborator': _collaborator_data(collaborator)
+        })
+        
+    except Http404:
+        return JsonResponse({'status': 'error', 'message': 'Project not found'}, status=404)
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+@login_required
+@require_POST
+def remove_collaborator(request, project_id):
+    """Revoke a collaborator's access (owner only) and drop their open editing socket"""
+    try:
+        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        data = json.loads(request.body)
+        
+        deleted, _ = IDEProjectCollaborator.objects.filter(project=project, user_id=data.get('user_id')).delete()
+        if not deleted:
+            return JsonResponse({'status': 'error', 'message': 'Collaborator not found'}, status=404)
+        
+        # Notify via WebSocket
+        from channels.layers import get_channel_layer
+        from asgiref.sync import async_to_sync
+        
+        async_to_sync(get_channel_layer().group_send)(
+            f'ide_collab_{project_id}',
+            {
+                'type': 'collaborator_removed',
+                'user_id': data.get('user_id'),
+            }
+        )
+        
+        return JsonResponse({'status': 'success', 'message': 'Collaborator removed'})
+        
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
 # ==================== FILE MANAGEMENT ====================
 
 @login_required
 def get_project_files(request, project_id):
     """Get all files and directories in a project"""
     try:
-        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        project = get_accessible_project(request, project_id)
         
         # Get all files
         files = IDEFile.objects.filter(project=project).order_by('path')
@@ -766,6 +960,8 @@ def get_project_files(request, project_id):
             'project_name': project.name
         })
         
+    except Http404:
+        return JsonResponse({'status': 'error', 'message': 'Project not found'}, status=404)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
@@ -774,7 +970,7 @@ def get_project_files(request, project_id):
 def get_file_content(request, project_id, file_path):
     """Get content of a specific file"""
     try:
-        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        project = get_accessible_project(request, project_id)
         file = get_object_or_404(IDEFile, project=project, path=file_path)
         
         return JsonResponse({
@@ -789,6 +985,8 @@ def get_file_content(request, project_id, file_path):
             }
         })
         
+    except Http404:
+        return JsonResponse({'status': 'error', 'message': 'File not found'}, status=404)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
@@ -807,7 +1005,7 @@ def save_file(request, project_id):
         if not file_path:
             return JsonResponse({'status': 'error', 'message': 'File path required'}, status=400)
         
-        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        project = get_accessible_project(request, project_id, edit=True)
         
         # Extract filename and directory path
         path_parts = file_path.split('/')
@@ -840,6 +1038,7 @@ def save_file(request, project_id):
                     'directory': directory
                 }
             )
+            _sync_live_files(project_id, {file.path: content})
             
             return JsonResponse({
                 'status': 'success',
@@ -860,7 +1059,7 @@ def save_file(request, project_id):
                 'message': f'Failed to save file: {str(file_error)}'
             }, status=500)
         
-    except IDEProject.DoesNotExist:
+    except (IDEProject.DoesNotExist, Http404):
         return JsonResponse({'status': 'error', 'message': 'Project not found'}, status=404)
     except json.JSONDecodeError as e:
         return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
@@ -871,6 +1070,45 @@ def save_file(request, project_id):
         return JsonResponse({'status': 'error', 'message': f'Server error: {str(e)}'}, status=500)
 
 
+@login_required
+@ensure_csrf_cookie
+@require_POST
+@rate_limit_per_user(max_requests=100, window=60)
+def save_files(request, project_id):
+    """Create or update several files in one request: {"files": [{"path", "content"}, ...]}"""
+    try:
+        data = json.loads(request.body)
+        entries = data.get('files')
+        if not isinstance(entries, list) or not entries:
+            return JsonResponse({'status': 'error', 'message': 'Files required'}, status=400)
+        
+        files = {}
+        for entry in entries:
+            file_path = str(entry.get('path', '')).strip() if isinstance(entry, dict) else ''
+            content = entry.get('content', '') if isinstance(entry, dict) else None
+            if not file_path or not isinstance(content, str):
+                return JsonResponse({'status': 'error', 'message': 'Each file needs a path and content'}, status=400)
+            files[file_path] = content
+        
+        project = get_accessible_project(request, project_id, edit=True)
+        created, updated = save_files_batch(project.pk, files)
+        _sync_live_files(project_id, files)
+        
+        return JsonResponse({
+            'status': 'success',
+            'message': f'Saved {len(files)} file(s)',
+            'created': created,
+            'updated': updated
+        })
+        
+    except Http404:
+        return JsonResponse({'status': 'error', 'message': 'Project not found'}, status=404)
+    except json.JSONDecodeError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
 @login_required
 @ensure_csrf_cookie
 @require_POST
@@ -955,6 +1193,7 @@ def delete_file(request, project_id):
         
         file_name = file.name
         file.delete()
+        ide_documents.close_file(project_id, file_path)
         
         return JsonResponse({
             'status': 'success',
@@ -984,6 +1223,10 @@ def rename_file(request, project_id):
         
         project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
         
+        # Write pending collaborative edits under the old paths first
+        ide_documents.flush(project_id)
+        ide_documents.close_file(project_id, old_path)
+        
         # Calculate new path
         path_parts = old_path.split('/')
         path_parts[-1] = new_name
@@ -1423,13 +1666,13 @@ finally:
                 # Remove plot markers from output
                 output_text = re.sub(plot_pattern, '', output_text, flags=re.DOTALL)
                 
-                # Log execution
-                IDEExecutionLog.objects.create(
-                    project=project,
-                    file=IDEFile.objects.filter(project=project, path=file_path).first(),
-                    code_snippet=code[:1000],  # Store first 1000 chars
-                    output=output_text[:5000],  # Store first 5000 chars
-                    error=stderr[:5000],
+                # Log execution (written in batches off the request path)
+                log_buffer.record(
+                    project_id=project.id,
+                    file_path=file_path,
+                    code=code,
+                    output=output_text,
+                    error=stderr,
                     execution_time=execution_time,
                     was_successful=process.returncode == 0
                 )
@@ -1466,14 +1709,23 @@ finally:
 
 @login_required
 def get_execution_history(request, project_id):
-    """Get execution history for a project"""
+    """Get execution history for a project, newest first (?cursor=&limit=)"""
     try:
         project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
         
-        limit = min(int(request.GET.get('limit', 50)), 100)
-        offset = int(request.GET.get('offset', 0))
+        try:
+            limit = max(1, min(int(request.GET.get('limit', 50)), 100))
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid limit'}, status=400)
         
-        logs = IDEExecutionLog.objects.filter(project=project)[offset:offset+limit]
+        logs = IDEExecutionLog.objects.filter(project=project).select_related('file').only(
+            'id', 'code_snippet', 'output', 'error', 'execution_time',
+            'was_successful', 'executed_at', 'file__path'
+        )
+        try:
+            logs, next_cursor = keyset_page(logs, request.GET.get('cursor'), limit)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
         
         history_data = []
         for log in logs:
@@ -1488,10 +1740,42 @@ def get_execution_history(request, project_id):
                 'file_path': log.file.path if log.file else None
             })
         
-        return JsonResponse({
+        response = {
             'status': 'success',
             'history': history_data,
-            'total': IDEExecutionLog.objects.filter(project=project).count()
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if request.GET.get('include_total'):
+            response['total'] = approximate_count(
+                f'ide_exec_total:{project.id}',
+                IDEExecutionLog.objects.filter(project=project)
+            )
+        return JsonResponse(response)
+        
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+@login_required
+def get_execution_stats(request, project_id):
+    """Get per-day execution counts and timings for a project (?days=, at most 365)"""
+    try:
+        days = max(1, min(int(request.GET.get('days', 30)), 365))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'days must be an integer'}, status=400)
+    
+    try:
+        project = get_object_or_404(IDEProject, project_id=project_id, user=request.user)
+        
+        from datetime import timedelta
+        since = timezone.localdate() - timedelta(days=days - 1)
+        
+        stats = IDEExecutionDailyStats.objects.filter(project=project, date__gte=since)
+        
+        return JsonResponse({
+            'status': 'success',
+            'stats': [day.to_dict() for day in stats]
         })
         
     except Exception as e:
@@ -1511,16 +1795,30 @@ def get_terminal_session(request, project_id):
             project=project,
             is_active=True,
             defaults={
-                'history': [],
                 'environment_vars': {}
             }
         )
         
+        # Tail-only read: newest entries, or the page older than ?before=<seq>
+        try:
+            limit = max(1, min(int(request.GET.get('limit', 50)), IDETerminalSession.HISTORY_LIMIT))
+            before = request.GET.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'limit and before must be integers'}, status=400)
+        
+        entries = terminal.get_history(before=before, limit=limit + 1)
+        has_more = len(entries) > limit
+        if has_more:
+            entries = entries[1:]
+        
         return JsonResponse({
             'status': 'success',
             'session': {
                 'id': str(terminal.session_id),
-                'history': terminal.history[-50:],  # Last 50 entries
+                'history': [entry.to_dict() for entry in entries],
+                'last_seq': terminal.last_seq,
+                'has_more': has_more,
                 'created_at': terminal.created_at.isoformat()
             }
         })
@@ -1542,8 +1840,7 @@ def clear_terminal(request, project_id):
         ).first()
         
         if terminal:
-            terminal.history = []
-            terminal.save()
+            terminal.clear_history()
         
         return JsonResponse({
             'status': 'success',
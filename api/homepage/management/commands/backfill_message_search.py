@@ -0,0 +1,46 @@
+"""
+Management command to index messages written before message search existed.
+Creates search documents for server and direct messages that have none, in
+batches of increasing primary key so it can be stopped and run again.
+
+Usage:
+    python manage.py backfill_message_search
+    python manage.py backfill_message_search --batch-size 5000
+"""
+
+from django.core.management.base import BaseCommand
+from homepage.models import DirectMessage, MessageSearchDocument, ServerMessage
+from homepage.search import direct_message_document, server_message_document
+
+
+class Command(BaseCommand):
+    help = 'Create missing message search documents in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Messages indexed per query (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(options['batch_size'], 1)
+
+        indexed = self.backfill(ServerMessage.objects.select_related('channel'), server_message_document, batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} server message(s).'))
+
+        indexed = self.backfill(DirectMessage.objects.all(), direct_message_document, batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} direct message(s).'))
+
+    def backfill(self, messages, document_for, batch_size):
+        indexed, last_pk = 0, 0
+        messages = messages.filter(search_document__isnull=True).order_by('pk')
+        while True:
+            batch = list(messages.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return indexed
+            MessageSearchDocument.objects.bulk_create([document_for(message) for message in batch], ignore_conflicts=True)
+            indexed += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'  ...{indexed} indexed')
@@ -0,0 +1,44 @@
+"""
+Management command to create read states that predate unread tracking.
+Members get a caught-up state for every channel of their servers, and DM
+recipients a state counting the direct messages still marked unread.
+Existing states are left alone, so it is safe to run again.
+
+Usage:
+    python manage.py backfill_read_states
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+from homepage.models import DirectMessage, ReadState, ServerChannel, ServerMember
+
+
+class Command(BaseCommand):
+    help = 'Create missing channel and DM read states'
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        channels_by_server = {}
+        for channel_id, server_id in ServerChannel.objects.values_list('id', 'server_id'):
+            channels_by_server.setdefault(server_id, []).append(channel_id)
+
+        existing = set(ReadState.objects.filter(channel__isnull=False).values_list('user_id', 'channel_id'))
+        channel_states = [
+            ReadState(user_id=user_id, channel_id=channel_id, last_read_at=now)
+            for server_id, user_id in ServerMember.objects.values_list('server_id', 'user_id')
+            for channel_id in channels_by_server.get(server_id, [])
+            if (user_id, channel_id) not in existing
+        ]
+        ReadState.objects.bulk_create(channel_states, batch_size=500, ignore_conflicts=True)
+        self.stdout.write(self.style.SUCCESS(f'Created {len(channel_states)} channel read state(s).'))
+
+        existing = set(ReadState.objects.filter(peer__isnull=False).values_list('user_id', 'peer_id'))
+        unread = DirectMessage.objects.filter(is_read=False).order_by().values('recipient_id', 'sender_id').annotate(count=Count('id'))
+        dm_states = [
+            ReadState(user_id=row['recipient_id'], peer_id=row['sender_id'], unread_count=row['count'])
+            for row in unread
+            if (row['recipient_id'], row['sender_id']) not in existing
+        ]
+        ReadState.objects.bulk_create(dm_states, batch_size=500, ignore_conflicts=True)
+        self.stdout.write(self.style.SUCCESS(f'Created {len(dm_states)} DM read state(s).'))
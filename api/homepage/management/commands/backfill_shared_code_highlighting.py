@@ -0,0 +1,46 @@
+"""
+Management command to highlight shared code saved before highlighted_html
+existed (or while Pygments was not installed). Snippets with code but no
+highlighted HTML are rendered in batches of increasing primary key, so it
+can be stopped and run again.
+
+Usage:
+    python manage.py backfill_shared_code_highlighting
+    python manage.py backfill_shared_code_highlighting --batch-size 500
+"""
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from homepage.highlighting import highlight_code
+from homepage.models import SharedCode
+
+
+class Command(BaseCommand):
+    help = 'Render highlighted HTML for shared code that has none'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Snippets highlighted per query (default: 200)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(options['batch_size'], 1)
+        snippets = SharedCode.objects.filter(highlighted_html='').exclude(code_content='').order_by('pk')
+        highlighted, last_pk = 0, 0
+        while True:
+            batch = list(snippets.filter(pk__gt=last_pk).only('pk', 'code_content', 'language')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for snippet in batch:
+                snippet.highlighted_html = highlight_code(snippet.code_content, snippet.language)
+                # Bumping updated_at retires the cached plain-text page
+                snippet.updated_at = timezone.now()
+            batch = [snippet for snippet in batch if snippet.highlighted_html]
+            SharedCode.objects.bulk_update(batch, ['highlighted_html', 'updated_at'])
+            highlighted += len(batch)
+            self.stdout.write(f'  ...{highlighted} highlighted')
+        self.stdout.write(self.style.SUCCESS(f'Highlighted {highlighted} shared snippet(s).'))
@@ -0,0 +1,109 @@
+"""
+Management command to check the channel layer before scaling out workers.
+Sends messages to a channel and fans a group message out to several
+channels through the configured layer (or the Redis servers given with
+--urls, e.g. local `redis-server --port 6380` stand-ins), and shows how
+groups spread over the shards.
+
+Usage:
+    python manage.py check_channel_layer
+    python manage.py check_channel_layer --urls redis://localhost:6380,redis://localhost:6381 --messages 500
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from mywebsite.channel_layers import ShardedRedisChannelLayer
+
+RECEIVE_TIMEOUT = 5  # Seconds to wait for each message
+
+
+class Command(BaseCommand):
+    help = 'Round-trip and group fan-out check of the channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--urls',
+            default='',
+            help='Comma-separated Redis URLs to check instead of CHANNEL_LAYERS',
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=100,
+            help='Messages to send through one channel (default: 100)',
+        )
+        parser.add_argument(
+            '--receivers',
+            type=int,
+            default=3,
+            help='Channels in the fan-out group (default: 3)',
+        )
+
+    def handle(self, *args, **options):
+        urls = [url.strip() for url in options['urls'].split(',') if url.strip()]
+        layer = ShardedRedisChannelLayer(hosts=urls) if urls else get_channel_layer()
+        if layer is None:
+            raise CommandError('No channel layer is configured')
+        self.stdout.write(f'Checking {type(layer).__name__}')
+
+        try:
+            results = async_to_sync(self.run_checks)(layer, max(options['messages'], 1), max(options['receivers'], 1))
+        except asyncio.TimeoutError:
+            raise CommandError(f'No message within {RECEIVE_TIMEOUT}s; are all workers on the same layer?')
+        except CommandError:
+            raise
+        except Exception as e:
+            raise CommandError(f'Channel layer check failed: {e}')
+        finally:
+            if urls:
+                async_to_sync(layer.close_pools)()
+
+        for line in results:
+            self.stdout.write(self.style.SUCCESS(line))
+
+    async def run_checks(self, layer, messages, receivers):
+        results = []
+
+        # Point to point, in order
+        channel = await layer.new_channel()
+        started = time.perf_counter()
+        for n in range(messages):
+            await layer.send(channel, {'type': 'check.ping', 'n': n})
+        received = [
+            (await asyncio.wait_for(layer.receive(channel), RECEIVE_TIMEOUT))['n']
+            for _ in range(messages)
+        ]
+        elapsed = time.perf_counter() - started
+        if received != list(range(messages)):
+            raise CommandError('Messages arrived out of order or were lost')
+        results.append(f'Round trip: {messages} message(s) in {elapsed * 1000:.1f}ms '
+                       f'({messages / elapsed:.0f}/s)')
+
+        # Group fan-out
+        group = f'check_channel_layer_{int(time.time() * 1000)}'
+        channels = [await layer.new_channel() for _ in range(receivers)]
+        for name in channels:
+            await layer.group_add(group, name)
+        started = time.perf_counter()
+        await layer.group_send(group, {'type': 'check.fanout'})
+        try:
+            for name in channels:
+                await asyncio.wait_for(layer.receive(name), RECEIVE_TIMEOUT)
+        finally:
+            for name in channels:
+                await layer.group_discard(group, name)
+        results.append(f'Fan-out: group message reached {receivers} channel(s) '
+                       f'in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+        # How groups named like ours spread over the shards
+        if getattr(layer, 'ring_size', 1) > 1:
+            spread = Counter(layer.consistent_hash(f'code_session_{n}') for n in range(1000))
+            results.append('Shards: ' + ', '.join(
+                f'#{index} {spread[index] / 10:.1f}%' for index in range(layer.ring_size)
+            ))
+        return results
@@ -0,0 +1,25 @@
+"""
+Management command to expire gateway state left behind by dropped sockets
+and crashed workers: sessions past GATEWAY_RESUME_TIMEOUT and connections
+that stopped sending heartbeats. Users whose last connection expired are
+marked offline and their friends are told.
+
+Usage:
+    python manage.py expire_gateway_state
+
+Cron example (runs every minute):
+    * * * * * cd /path/to/project && python manage.py expire_gateway_state
+"""
+
+from django.core.management.base import BaseCommand
+from homepage.gateway import expire_gateway_state
+
+
+class Command(BaseCommand):
+    help = 'Delete expired gateway sessions and connections and mark their users offline'
+
+    def handle(self, *args, **options):
+        sessions, connections, offline = expire_gateway_state()
+        self.stdout.write(self.style.SUCCESS(
+            f'Expired {sessions} session(s) and {connections} connection(s); {offline} user(s) now offline.'
+        ))
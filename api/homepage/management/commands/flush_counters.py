@@ -0,0 +1,23 @@
+"""
+Management command to apply logged counter hits (SharedCode view and fork
+counts, daily stats). Long-running processes already apply them every
+COUNTER_FLUSH_INTERVAL seconds; run this where no process outlives its
+request (Vercel), or before reading the counters in bulk.
+
+Usage:
+    python manage.py flush_counters
+
+Cron example (runs every minute):
+    * * * * * cd /path/to/project && python manage.py flush_counters
+"""
+
+from django.core.management.base import BaseCommand
+from homepage.counters import counters
+
+
+class Command(BaseCommand):
+    help = 'Apply logged counter hits to their rows'
+
+    def handle(self, *args, **options):
+        applied = counters.flush()
+        self.stdout.write(self.style.SUCCESS(f'Applied {applied} counter hit(s).'))
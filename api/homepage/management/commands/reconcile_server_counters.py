@@ -0,0 +1,19 @@
+"""
+Management command to recompute the denormalized member and message counters
+of servers and channels from the member and message tables. Only rows whose
+counters drifted are written, so it is cheap to run on a schedule.
+
+Usage:
+    python manage.py reconcile_server_counters
+"""
+
+from django.core.management.base import BaseCommand
+from homepage.server_counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute server and channel member/message counters'
+
+    def handle(self, *args, **options):
+        channels, servers = reconcile_counters()
+        self.stdout.write(self.style.SUCCESS(f'Fixed counters of {channels} channel(s) and {servers} server(s).'))
@@ -0,0 +1,51 @@
+"""
+Management command to refresh the shared code discovery boards.
+Rewrites SharedCodeRanking (all-time, weekly and trending) from the view/fork
+counters and SharedCodeDailyStats, then prunes old daily stats.
+
+Usage:
+    python manage.py refresh_shared_code_rankings
+    python manage.py refresh_shared_code_rankings --board trending --size 50
+
+Cron example (runs every 10 minutes):
+    */10 * * * * cd /path/to/project && python manage.py refresh_shared_code_rankings
+"""
+
+from django.core.management.base import BaseCommand
+from homepage.counters import counters
+from homepage.rankings import BOARD_SCORERS, refresh_rankings, prune_daily_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the all-time, weekly and trending shared code rankings'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--board',
+            action='append',
+            choices=sorted(BOARD_SCORERS),
+            help='Board to refresh; may be repeated (default: all boards)',
+        )
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=None,
+            help='Entries per board (default: SHARED_CODE_RANKING_SIZE)',
+        )
+        parser.add_argument(
+            '--keep-days',
+            type=int,
+            default=30,
+            help='Days of daily stats to keep (default: 30)',
+        )
+
+    def handle(self, *args, **options):
+        # Apply logged views and forks first
+        counters.flush()
+
+        written = refresh_rankings(size=options['size'], boards=options['board'])
+        for board, count in written.items():
+            self.stdout.write(self.style.SUCCESS(f'Ranked {count} snippet(s) on {board}.'))
+
+        deleted = prune_daily_stats(keep_days=options['keep_days'])
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} daily stat row(s).'))
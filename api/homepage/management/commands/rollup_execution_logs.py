@@ -0,0 +1,75 @@
+"""
+Management command to roll up and prune Cloud IDE execution logs.
+Recomputes the per-day IDEExecutionDailyStats for recent days, then deletes
+raw IDEExecutionLog rows beyond the per-project retention limits
+(IDE_EXEC_LOG_KEEP_LAST / IDE_EXEC_LOG_KEEP_DAYS). Raw logs of the days being
+recomputed are kept, so pruning never shrinks a day that is rolled up again.
+
+Usage:
+    python manage.py rollup_execution_logs
+    python manage.py rollup_execution_logs --days 7 --keep-last 200
+
+Cron example (runs every hour):
+    0 * * * * cd /path/to/project && python manage.py rollup_execution_logs
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from homepage.execution_logs import log_buffer, rollup_daily_stats, prune_execution_logs
+
+
+class Command(BaseCommand):
+    help = 'Roll up IDE execution logs into daily stats and prune old raw logs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=2,
+            help='Number of recent days to recompute stats for (default: 2)',
+        )
+        parser.add_argument(
+            '--keep-last',
+            type=int,
+            default=None,
+            help='Raw logs to keep per project (default: IDE_EXEC_LOG_KEEP_LAST)',
+        )
+        parser.add_argument(
+            '--keep-days',
+            type=int,
+            default=None,
+            help='Days of raw logs to keep (default: IDE_EXEC_LOG_KEEP_DAYS)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows deleted per transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--skip-prune',
+            action='store_true',
+            help='Only recompute stats, do not delete raw logs',
+        )
+
+    def handle(self, *args, **options):
+        # Pick up anything still buffered in this process
+        log_buffer.flush()
+
+        first_day = timezone.localdate() - timedelta(days=max(options['days'], 1) - 1)
+        since = timezone.make_aware(datetime.combine(first_day, time.min))
+        rolled = rollup_daily_stats(since)
+        self.stdout.write(self.style.SUCCESS(f'Updated {rolled} daily stat row(s).'))
+
+        if options['skip_prune']:
+            return
+
+        deleted = prune_execution_logs(
+            keep_last=options['keep_last'],
+            keep_days=options['keep_days'],
+            batch_size=options['batch_size'],
+            before=since,
+        )
+        self.stdout.write(self.style.SUCCESS(f'Pruned {deleted} execution log(s).'))
@@ -0,0 +1,108 @@
+"""
+Management command to load-test the WebSocket consumers in-process.
+Creates a throwaway test database, connects N simulated clients per scenario
+(chat, collab, terminal) and reports fan-out latency, frames per second and
+DB queries per message. Runs are seeded, so results can be saved and later
+runs compared against them to catch regressions before deploying.
+
+Usage:
+    python manage.py ws_benchmark
+    python manage.py ws_benchmark --scenario chat --clients 300 --rounds 50
+    python manage.py ws_benchmark --output bench.json
+    python manage.py ws_benchmark --baseline bench.json --tolerance 0.25
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from homepage.benchmarks import SCENARIOS, run_scenario
+
+# Metric -> True if higher is worse
+GATED_METRICS = {
+    'p99_ms': True,
+    'queries_per_message': True,
+    'frames_per_sec': False,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark WebSocket fan-out latency, throughput and DB queries per message'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario',
+            action='append',
+            choices=sorted(SCENARIOS),
+            help='Scenario to run; may be repeated (default: all)',
+        )
+        parser.add_argument('--clients', type=int, default=100, help='Connected clients per scenario (default: 100)')
+        parser.add_argument('--rounds', type=int, default=20, help='Rounds of traffic (default: 20)')
+        parser.add_argument('--senders', type=int, default=5, help='Clients sending a tracked message per round (default: 5)')
+        parser.add_argument('--noise', type=int, default=20, help='Typing/cursor/ping events per round (default: 20)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for senders and noise (default: 0)')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='Fail if results regress against this earlier --output file')
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='Allowed regression against the baseline as a fraction (default: 0.25)',
+        )
+
+    def handle(self, *args, **options):
+        if options['clients'] < 2:
+            raise CommandError('At least 2 clients are needed to measure fan-out')
+
+        # Never benchmark against real data
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = []
+            for name in options['scenario'] or sorted(SCENARIOS):
+                self.stdout.write(f'Running {name} with {options["clients"]} clients...')
+                results.append(run_scenario(
+                    SCENARIOS[name](), options['clients'], options['rounds'],
+                    options['senders'], options['noise'], seed=options['seed'],
+                ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for result in results:
+            self.stdout.write(
+                f"{result['scenario']:<9} {result['messages']} msgs -> {result['deliveries']} deliveries "
+                f"({result['lost']} lost)  p50 {result['p50_ms']}ms  p99 {result['p99_ms']}ms  "
+                f"{result['frames_per_sec']} frames/s  {result['queries_per_message']} queries/msg  "
+                f"{result['flush_queries']} flush queries  connect p50 {result['connect_p50_ms']}ms"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': {key: options[key] for key in ('clients', 'rounds', 'senders', 'noise', 'seed')},
+                           'results': results}, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def compare(self, results, path, tolerance):
+        with open(path) as f:
+            baseline = {result['scenario']: result for result in json.load(f)['results']}
+
+        regressions = []
+        for result in results:
+            before = baseline.get(result['scenario'])
+            if before is None:
+                continue
+            if result['lost'] > before.get('lost', 0):
+                regressions.append(f"{result['scenario']}: {result['lost']} deliveries lost")
+            for metric, higher_is_worse in GATED_METRICS.items():
+                old, new = before.get(metric), result.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old if higher_is_worse else (old - new) / old
+                if change > tolerance:
+                    regressions.append(f"{result['scenario']}: {metric} {old} -> {new} ({change:+.0%})")
+
+        if regressions:
+            raise CommandError('Regressed against baseline:\n  ' + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against baseline.'))
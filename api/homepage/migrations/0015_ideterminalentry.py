@@ -0,0 +1,74 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.dateparse import parse_datetime
+
+
+def copy_history_to_entries(apps, schema_editor):
+    """Move each session's JSON history list into sequenced entry rows"""
+    IDETerminalSession = apps.get_model('homepage', 'IDETerminalSession')
+    IDETerminalEntry = apps.get_model('homepage', 'IDETerminalEntry')
+
+    for session in IDETerminalSession.objects.exclude(history=[]).iterator():
+        history = (session.history or [])[-100:]
+        items = {seq: item for seq, item in enumerate(history, start=1) if isinstance(item, dict)}
+        IDETerminalEntry.objects.bulk_create([
+            IDETerminalEntry(
+                session=session,
+                seq=seq,
+                command=item.get('command', ''),
+                output=item.get('output', ''),
+                error=item.get('error', ''),
+            )
+            for seq, item in items.items()
+        ])
+
+        # created_at is auto_now_add, so the original timestamps are restored afterwards
+        entries = []
+        for entry in IDETerminalEntry.objects.filter(session=session):
+            timestamp = items[entry.seq].get('timestamp')
+            created_at = parse_datetime(timestamp) if isinstance(timestamp, str) else None
+            if created_at is not None:
+                entry.created_at = created_at
+                entries.append(entry)
+        IDETerminalEntry.objects.bulk_update(entries, ['created_at'], batch_size=100)
+        session.last_seq = len(history)
+        session.save(update_fields=['last_seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0014_servercategory_serverrole_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IDETerminalEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveBigIntegerField()),
+                ('command', models.TextField(blank=True)),
+                ('output', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='homepage.ideterminalsession')),
+            ],
+            options={
+                'verbose_name_plural': 'IDE terminal entries',
+                'ordering': ['seq'],
+                'unique_together': {('session', 'seq')},
+            },
+        ),
+        migrations.AddField(
+            model_name='ideterminalsession',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(copy_history_to_entries, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='ideterminalsession',
+            name='history',
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0015_ideterminalentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IDEExecutionDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total_runs', models.IntegerField(default=0)),
+                ('failed_runs', models.IntegerField(default=0)),
+                ('avg_time', models.FloatField(default=0)),
+                ('p50_time', models.FloatField(default=0)),
+                ('p95_time', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'IDE execution daily stats',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='ideexecutionlog',
+            name='executed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='ideexecutiondailystats',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='execution_stats', to='homepage.ideproject'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ideexecutiondailystats',
+            unique_together={('project', 'date')},
+        ),
+    ]
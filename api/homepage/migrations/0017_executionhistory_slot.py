@@ -0,0 +1,49 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def assign_history_slots(apps, schema_editor):
+    """Give existing history rows ring slots (oldest first) and drop rows past capacity"""
+    ExecutionHistory = apps.get_model('homepage', 'ExecutionHistory')
+    UserProfile = apps.get_model('homepage', 'UserProfile')
+    capacity = getattr(settings, 'EXECUTION_HISTORY_CAPACITY', 100)
+
+    user_ids = ExecutionHistory.objects.values_list('user_id', flat=True).distinct()
+    for user_id in list(user_ids):
+        ids = list(
+            ExecutionHistory.objects.filter(user_id=user_id)
+            .order_by('-executed_at', '-id').values_list('id', flat=True)
+        )
+        ExecutionHistory.objects.filter(id__in=ids[capacity:]).delete()
+        kept = list(reversed(ids[:capacity]))
+        for slot, history_id in enumerate(kept):
+            ExecutionHistory.objects.filter(id=history_id).update(slot=slot)
+        UserProfile.objects.filter(user_id=user_id).update(history_cursor=len(kept))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0016_ideexecutiondailystats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='executionhistory',
+            name='slot',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='history_cursor',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(assign_history_slots, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='executionhistory',
+            unique_together={('user', 'slot')},
+        ),
+    ]
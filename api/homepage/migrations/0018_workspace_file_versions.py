@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0017_executionhistory_slot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pythoncodesession',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='pythoncodesession',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userfiles',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='userfiles',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
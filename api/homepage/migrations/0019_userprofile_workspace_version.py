@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0018_workspace_file_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='workspace_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
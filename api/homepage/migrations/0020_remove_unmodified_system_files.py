@@ -0,0 +1,40 @@
+# Generated by Django 5.2.6 on 2026-10-19 04:10
+
+from django.db import migrations
+
+
+SYSTEM_FILE_TEMPLATES = {
+    'text.txt': (
+        "Hello {username}!\nThis is your personal text file.\n"
+        "You can modify this content and it will be saved to your account."
+    ),
+    'tester.csv': "name,age,city,user\nJohn,25,NYC,{username}\nJane,30,LA,guest\nBob,35,Chicago,{username}",
+    'binary.dat': "Personal binary data for {username}",
+}
+
+
+def remove_unmodified_system_files(apps, schema_editor):
+    """Drop per-user copies of system files that still match the shared default"""
+    UserFiles = apps.get_model('homepage', 'UserFiles')
+
+    rows = UserFiles.objects.filter(
+        is_system_file=True, filename__in=SYSTEM_FILE_TEMPLATES
+    ).values_list('id', 'filename', 'content', 'user__username')
+
+    unmodified = [
+        file_id for file_id, filename, content, username in rows.iterator()
+        if content == SYSTEM_FILE_TEMPLATES[filename].format(username=username)
+    ]
+    for start in range(0, len(unmodified), 1000):
+        UserFiles.objects.filter(id__in=unmodified[start:start + 1000]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0019_userprofile_workspace_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_unmodified_system_files, migrations.RunPython.noop),
+    ]
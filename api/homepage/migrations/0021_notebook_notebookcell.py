@@ -0,0 +1,109 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:48
+
+import hashlib
+import json
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def move_notebook_blobs(apps, schema_editor):
+    """Split legacy _notebook_data.json rows into Notebook and NotebookCell rows"""
+    PythonCodeSession = apps.get_model('homepage', 'PythonCodeSession')
+    Notebook = apps.get_model('homepage', 'Notebook')
+    NotebookCell = apps.get_model('homepage', 'NotebookCell')
+
+    blobs = PythonCodeSession.objects.filter(filename='_notebook_data.json')
+    for blob in blobs.iterator():
+        try:
+            notebooks = json.loads(blob.code_content)
+        except json.JSONDecodeError:
+            continue
+        if not notebooks:
+            continue
+        if not isinstance(notebooks, dict) or isinstance(notebooks.get('cells'), list):
+            notebooks = {'default': notebooks}
+
+        for name, document in notebooks.items():
+            has_cells = isinstance(document, dict) and isinstance(document.get('cells'), list)
+            cells = document['cells'] if has_cells else []
+            notebook = Notebook.objects.create(
+                user_id=blob.user_id,
+                name=str(name)[:255],
+                metadata={k: v for k, v in document.items() if k != 'cells'} if has_cells else document,
+                has_cells=has_cells,
+                cell_count=len(cells),
+                version=1,
+            )
+            NotebookCell.objects.bulk_create([
+                NotebookCell(
+                    notebook=notebook,
+                    position=position,
+                    data=cell,
+                    content_hash=hashlib.sha256(
+                        json.dumps(cell, sort_keys=True, separators=(',', ':')).encode('utf-8')
+                    ).hexdigest(),
+                )
+                for position, cell in enumerate(cells)
+            ])
+    blobs.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0020_remove_unmodified_system_files'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notebook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('metadata', models.JSONField(default=dict)),
+                ('has_cells', models.BooleanField(default=True)),
+                ('cell_count', models.PositiveIntegerField(default=0)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='NotebookCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('data', models.JSONField(default=dict)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.AddField(
+            model_name='notebook',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notebooks', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='notebookcell',
+            name='notebook',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cells', to='homepage.notebook'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='notebook',
+            unique_together={('user', 'name')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='notebookcell',
+            unique_together={('notebook', 'position')},
+        ),
+        migrations.RunPython(move_notebook_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0021_notebook_notebookcell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sharedcode',
+            name='highlighted_html',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:53
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0022_sharedcode_highlighted_html'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedCodeDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.IntegerField(default=0)),
+                ('forks', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Shared code daily stats',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SharedCodeRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(choices=[('all_time', 'All Time'), ('weekly', 'This Week'), ('trending', 'Trending')], max_length=20)),
+                ('rank', models.PositiveIntegerField()),
+                ('score', models.FloatField(default=0)),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['board', 'rank'],
+            },
+        ),
+        migrations.AddField(
+            model_name='sharedcodedailystats',
+            name='shared_code',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='homepage.sharedcode'),
+        ),
+        migrations.AddField(
+            model_name='sharedcoderanking',
+            name='shared_code',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='homepage.sharedcode'),
+        ),
+        migrations.AddIndex(
+            model_name='sharedcodedailystats',
+            index=models.Index(fields=['date'], name='homepage_sh_date_222644_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharedcodedailystats',
+            unique_together={('shared_code', 'date')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharedcoderanking',
+            unique_together={('board', 'rank')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-19 04:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0025_ideprojectcollaborator'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='servermessage',
+            name='homepage_se_channel_2a5d93_idx',
+        ),
+        migrations.AddIndex(
+            model_name='servermessage',
+            index=models.Index(fields=['channel', 'timestamp', 'id'], name='homepage_se_channel_ceddc1_idx'),
+        ),
+    ]
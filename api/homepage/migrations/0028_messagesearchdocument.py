@@ -0,0 +1,123 @@
+# Generated by Django 5.2.6 on 2026-10-19 04:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+SQLITE_INDEX = [
+    # External-content FTS5 table over the documents, synced by triggers. Schema
+    # changes that make Django rebuild the table on SQLite drop the triggers;
+    # such migrations must create them again.
+    "CREATE VIRTUAL TABLE homepage_messagesearch_fts USING fts5("
+    "content, content='homepage_messagesearchdocument', content_rowid='id', "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER homepage_messagesearch_ai AFTER INSERT ON homepage_messagesearchdocument BEGIN "
+    "INSERT INTO homepage_messagesearch_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER homepage_messagesearch_ad AFTER DELETE ON homepage_messagesearchdocument BEGIN "
+    "INSERT INTO homepage_messagesearch_fts(homepage_messagesearch_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER homepage_messagesearch_au AFTER UPDATE OF content ON homepage_messagesearchdocument BEGIN "
+    "INSERT INTO homepage_messagesearch_fts(homepage_messagesearch_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO homepage_messagesearch_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS homepage_messagesearch_au",
+    "DROP TRIGGER IF EXISTS homepage_messagesearch_ad",
+    "DROP TRIGGER IF EXISTS homepage_messagesearch_ai",
+    "DROP TABLE IF EXISTS homepage_messagesearch_fts",
+]
+POSTGRES_INDEX = [
+    "ALTER TABLE homepage_messagesearchdocument ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+    "CREATE INDEX homepage_messagesearch_vector_idx ON homepage_messagesearchdocument USING GIN (search_vector)",
+]
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS homepage_messagesearch_vector_idx",
+    "ALTER TABLE homepage_messagesearchdocument DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def create_fulltext_index(apps, schema_editor):
+    """Database-specific full-text index over MessageSearchDocument.content (see homepage/search.py)"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for sql in POSTGRES_INDEX:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_INDEX[0])
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to icontains
+            return
+        for sql in SQLITE_INDEX[1:]:
+            schema_editor.execute(sql)
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for sql in POSTGRES_DROP if vendor == 'postgresql' else SQLITE_DROP if vendor == 'sqlite' else []:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0027_readstate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='channel',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='homepage.serverchannel'),
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='direct_message',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='homepage.directmessage'),
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='recipient',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='server',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='homepage.server'),
+        ),
+        migrations.AddField(
+            model_name='messagesearchdocument',
+            name='server_message',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='homepage.servermessage'),
+        ),
+        migrations.AddIndex(
+            model_name='messagesearchdocument',
+            index=models.Index(fields=['server', 'created_at'], name='homepage_me_server__d06271_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagesearchdocument',
+            index=models.Index(fields=['sender', 'created_at'], name='homepage_me_sender__ec3d5c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagesearchdocument',
+            index=models.Index(fields=['recipient', 'created_at'], name='homepage_me_recipie_f0b178_idx'),
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
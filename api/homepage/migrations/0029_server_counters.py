@@ -0,0 +1,75 @@
+# Generated by Django 5.2.6 on 2026-10-19 04:47
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing(apps, schema_editor):
+    """Fill the new counters from existing members and messages"""
+    Server = apps.get_model('homepage', 'Server')
+    ServerChannel = apps.get_model('homepage', 'ServerChannel')
+    ServerMember = apps.get_model('homepage', 'ServerMember')
+    ServerMessage = apps.get_model('homepage', 'ServerMessage')
+
+    def count(queryset, field):
+        return Coalesce(Subquery(
+            queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('pk')).values('n')
+        ), 0)
+
+    ServerChannel.objects.update(
+        message_count=count(ServerMessage.objects.all(), 'channel_id'),
+        last_message_at=Subquery(
+            ServerMessage.objects.filter(channel_id=OuterRef('pk')).order_by('-timestamp').values('timestamp')[:1]
+        ),
+    )
+    Server.objects.update(
+        member_count=count(ServerMember.objects.all(), 'server_id'),
+        message_count=count(ServerMessage.objects.all(), 'channel__server_id'),
+        last_message_at=Subquery(
+            ServerChannel.objects.filter(server_id=OuterRef('pk'), last_message_at__isnull=False)
+            .order_by('-last_message_at').values('last_message_at')[:1]
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0028_messagesearchdocument'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='server',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='server',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='serverchannel',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='serverchannel',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='server',
+            index=models.Index(fields=['is_public', '-member_count'], name='homepage_se_is_publ_b88316_idx'),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-19 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0029_server_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterHit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.BigIntegerField(blank=True, null=True)),
+                ('bucket', models.CharField(blank=True, default='', max_length=255)),
+                ('field', models.CharField(max_length=50)),
+                ('amount', models.IntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='counterhit',
+            index=models.Index(fields=['model', 'object_id', 'field'], name='homepage_co_model_59bcb4_idx'),
+        ),
+    ]
@@ -1,9 +1,31 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 import uuid
 
-class UserProfile(models.Model):
+
+class CounterFieldsMixin:
+    """
+    For models whose COUNTER_FIELDS are only ever changed with F() updates: a
+    full save() of an existing instance leaves them out, so a stale instance
+    cannot write old counts back.
+    """
+    COUNTER_FIELDS = ()
+    
+    def without_counter_fields(self, kwargs):
+        """save() kwargs limited to the non-counter fields when no update_fields were given"""
+        if not self._state.adding and not kwargs.get('update_fields') and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        return kwargs
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **self.without_counter_fields(kwargs))
+
+
+class UserProfile(CounterFieldsMixin, models.Model):
     THEME_CHOICES = [
         ('default', 'Default (Green Matrix)'),
         ('greydom', 'Greydom (Dark Grey-Blue)'),
@@ -25,6 +47,11 @@ class UserProfile(models.Model):
     twitter_username = models.CharField(max_length=100, blank=True, default='')
     website = models.URLField(max_length=200, blank=True, default='')
     
+    # Total playground runs recorded; the next ExecutionHistory slot is this modulo capacity
+    history_cursor = models.PositiveBigIntegerField(default=0)
+    # Bumped whenever the user's playground files change; used as the load_user_data ETag
+    workspace_version = models.PositiveBigIntegerField(default=0)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -35,6 +62,8 @@ class UserProfile(models.Model):
             models.Index(fields=['-created_at']),
         ]
     
+    COUNTER_FIELDS = ('history_cursor', 'workspace_version')
+    
     def __str__(self):
         return f"{self.user.username}'s Profile"
     
@@ -49,6 +78,8 @@ class PythonCodeSession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     filename = models.CharField(max_length=255, default='main.py')
     code_content = models.TextField(blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, default='')  # sha256 of code_content
+    version = models.PositiveIntegerField(default=0)  # Bumped on every content change
     is_auto_save = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -76,6 +107,8 @@ class UserFiles(models.Model):
         ('binary', 'Binary File'),
         ('python', 'Python File'),
     ], default='text')
+    content_hash = models.CharField(max_length=64, blank=True, default='')  # sha256 of content
+    version = models.PositiveIntegerField(default=0)  # Bumped on every content change
     is_system_file = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -93,9 +126,53 @@ class UserFiles(models.Model):
         return f"{self.user.username} - {self.filename}"
 
 
+class Notebook(models.Model):
+    """A playground notebook; its cells are stored as separate rows"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notebooks')
+    name = models.CharField(max_length=255)
+    metadata = models.JSONField(default=dict)  # Notebook document without its cell list
+    has_cells = models.BooleanField(default=True)  # False if the document had no cell list
+    cell_count = models.PositiveIntegerField(default=0)
+    version = models.PositiveIntegerField(default=0)  # Bumped on every change
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['name']
+        unique_together = ['user', 'name']
+    
+    def __str__(self):
+        return f"{self.user.username} - {self.name}"
+    
+    def to_document(self):
+        """Rebuild the notebook document as the client sent it"""
+        if not self.has_cells:
+            return self.metadata
+        document = dict(self.metadata)
+        document['cells'] = list(self.cells.values_list('data', flat=True))
+        return document
+
+
+class NotebookCell(models.Model):
+    """One cell of a Notebook, keyed by its position"""
+    notebook = models.ForeignKey(Notebook, on_delete=models.CASCADE, related_name='cells')
+    position = models.PositiveIntegerField()
+    data = models.JSONField(default=dict)  # The cell as sent by the client (source, outputs, ...)
+    content_hash = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['position']
+        unique_together = ['notebook', 'position']
+    
+    def __str__(self):
+        return f"{self.notebook} [{self.position}]"
+
+
 class ExecutionHistory(models.Model):
-    """Store execution history for code runs"""
+    """Store execution history for code runs, as a fixed-size ring of slots per user"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='execution_history')
+    slot = models.PositiveIntegerField(null=True)  # Position in the user's history ring
     code_snippet = models.TextField()
     output = models.TextField(blank=True)
     error = models.TextField(blank=True)
@@ -106,6 +183,7 @@ class ExecutionHistory(models.Model):
     
     class Meta:
         ordering = ['-executed_at']
+        unique_together = ['user', 'slot']
         indexes = [
             models.Index(fields=['user', '-executed_at']),
             models.Index(fields=['user', 'was_successful']),
@@ -115,9 +193,44 @@ class ExecutionHistory(models.Model):
     
     def __str__(self):
         return f"{self.user.username} - {self.filename} at {self.executed_at.strftime('%Y-%m-%d %H:%M:%S')}"
+    
+    @classmethod
+    def record(cls, user, code, output='', error='', execution_time=0, filename='untitled.py', was_successful=True):
+        """Write a run into the user's next ring slot, overwriting the oldest entry once full"""
+        from django.conf import settings
+        capacity = getattr(settings, 'EXECUTION_HISTORY_CAPACITY', 100)
+        
+        with transaction.atomic():
+            # The UPDATE locks the profile row, so concurrent saves claim different slots
+            if not UserProfile.objects.filter(user=user).update(history_cursor=models.F('history_cursor') + 1):
+                UserProfile.objects.create(user=user, history_cursor=1)
+            cursor = UserProfile.objects.values_list('history_cursor', flat=True).get(user=user)
+            
+            entry = cls(
+                user=user,
+                slot=(cursor - 1) % capacity,
+                code_snippet=code[:getattr(settings, 'EXECUTION_HISTORY_MAX_CODE', 10000)],
+                output=output[:getattr(settings, 'EXECUTION_HISTORY_MAX_OUTPUT', 5000)],
+                error=error[:getattr(settings, 'EXECUTION_HISTORY_MAX_OUTPUT', 5000)],
+                execution_time=execution_time,
+                filename=filename[:255],
+                was_successful=was_successful
+            )
+            cls.objects.bulk_create(
+                [entry],
+                update_conflicts=True,
+                unique_fields=['user', 'slot'],
+                update_fields=[
+                    'code_snippet', 'output', 'error', 'execution_time',
+                    'filename', 'was_successful', 'executed_at'
+                ]
+            )
+            # Slots left over from a larger EXECUTION_HISTORY_CAPACITY
+            cls.objects.filter(user=user, slot__gte=capacity).delete()
+        return entry
 
 
-class SharedCode(models.Model):
+class SharedCode(CounterFieldsMixin, models.Model):
     """Allow users to share their code with unique URLs"""
     SESSION_TYPE_CHOICES = [
         ('simple', 'Simple Share (Read-only)'),
@@ -135,6 +248,7 @@ class SharedCode(models.Model):
     is_active = models.BooleanField(default=True)
     view_count = models.IntegerField(default=0)
     fork_count = models.IntegerField(default=0)
+    highlighted_html = models.TextField(blank=True, default='')  # Rendered once from code_content on save
     
     # Collaborative session fields
     imported_files = models.JSONField(default=dict, blank=True)  # {filename: content} for owner's imported .py files
@@ -156,16 +270,39 @@ class SharedCode(models.Model):
             models.Index(fields=['session_type', 'is_active']),
         ]
     
+    COUNTER_FIELDS = ('view_count', 'fork_count')
+    
     def __str__(self):
         return f"{self.title} by {self.user.username}"
     
+    def save(self, *args, **kwargs):
+        kwargs = self.without_counter_fields(kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'code_content' in update_fields:
+            from .highlighting import highlight_code
+            self.highlighted_html = highlight_code(self.code_content, self.language)
+            if update_fields is not None and 'highlighted_html' not in update_fields:
+                kwargs['update_fields'] = list(update_fields) + ['highlighted_html']
+        super().save(*args, **kwargs)
+    
     def increment_view_count(self):
-        self.view_count += 1
-        self.save(update_fields=['view_count'])
+        """Count a view; logged now and applied in batches by the counter service"""
+        from .counters import counters
+        counters.record(
+            counters.hit(SharedCode, self.pk, 'view_count'),
+            counters.bucket_hit(SharedCodeDailyStats, {'shared_code_id': self.pk, 'date': timezone.localdate()}, 'views'),
+        )
+        # Show views this process logged but has not applied yet too
+        self.view_count += counters.pending(SharedCode, self.pk, 'view_count')
     
     def increment_fork_count(self):
-        self.fork_count += 1
-        self.save(update_fields=['fork_count'])
+        """Count a fork; logged now and applied in batches by the counter service"""
+        from .counters import counters
+        counters.record(
+            counters.hit(SharedCode, self.pk, 'fork_count'),
+            counters.bucket_hit(SharedCodeDailyStats, {'shared_code_id': self.pk, 'date': timezone.localdate()}, 'forks'),
+        )
+        self.fork_count += counters.pending(SharedCode, self.pk, 'fork_count')
     
     def is_owner(self, user):
         return self.user == user
@@ -195,6 +332,65 @@ class SharedCode(models.Model):
         return False
 
 
+class SharedCodeDailyStats(models.Model):
+    """Per-day view and fork counts for a shared snippet, used for weekly/trending rankings"""
+    shared_code = models.ForeignKey(SharedCode, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    views = models.IntegerField(default=0)
+    forks = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-date']
+        unique_together = ['shared_code', 'date']
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+        verbose_name_plural = 'Shared code daily stats'
+    
+    def __str__(self):
+        return f"{self.shared_code.title} - {self.date}"
+
+
+class SharedCodeRanking(models.Model):
+    """Precomputed discovery feed entry; rebuilt by refresh_shared_code_rankings"""
+    BOARD_CHOICES = [
+        ('all_time', 'All Time'),
+        ('weekly', 'This Week'),
+        ('trending', 'Trending'),
+    ]
+    
+    board = models.CharField(max_length=20, choices=BOARD_CHOICES)
+    rank = models.PositiveIntegerField()
+    shared_code = models.ForeignKey(SharedCode, on_delete=models.CASCADE, related_name='rankings')
+    score = models.FloatField(default=0)
+    computed_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['board', 'rank']
+        unique_together = ['board', 'rank']
+    
+    def __str__(self):
+        return f"{self.board} #{self.rank}: {self.shared_code.title}"
+
+
+class CounterHit(models.Model):
+    """A counter increment waiting to be applied by the counter service (see homepage/counters.py)"""
+    model = models.CharField(max_length=100)  # app_label.ModelName
+    object_id = models.BigIntegerField(null=True, blank=True)  # Row of a plain counter
+    bucket = models.CharField(max_length=255, blank=True, default='')  # Unique key of a bucket row, as JSON
+    field = models.CharField(max_length=50)
+    amount = models.IntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'object_id', 'field']),
+        ]
+    
+    def __str__(self):
+        return f"{self.model}.{self.field} +{self.amount}"
+
+
 class SessionMember(models.Model):
     """Track members in collaborative sessions"""
     PERMISSION_CHOICES = [
@@ -221,6 +417,22 @@ class SessionMember(models.Model):
         return f"{self.user.username} in {self.session.title} ({self.permission})"
 
 
+class CollabOperation(models.Model):
+    """One sequenced batch of edit operations in a collaborative session (see homepage/collab.py)"""
+    session = models.ForeignKey(SharedCode, on_delete=models.CASCADE, related_name='operations')
+    seq = models.PositiveIntegerField()
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    ops = models.JSONField(default=list)  # [{'type': 'insert'|'delete', 'pos', 'text'|'length'}]
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['session', 'seq']
+        unique_together = ['session', 'seq']
+    
+    def __str__(self):
+        return f"Op {self.seq} in {self.session_id}"
+
+
 class Friendship(models.Model):
     """Manage friendships between users"""
     STATUS_CHOICES = [
@@ -315,6 +527,34 @@ class UserStatus(models.Model):
         self.save()
 
 
+class GatewaySession(models.Model):
+    """A dropped gateway session that can be resumed until expires_at (see homepage/gateway.py)"""
+    session_id = models.CharField(max_length=32, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='gateway_sessions')
+    seq = models.PositiveIntegerField(default=0)
+    events = models.JSONField(default=list)  # [[seq, event, data], ...] not yet seen by the client
+    disconnected_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def __str__(self):
+        return f"{self.user.username} gateway session {self.session_id}"
+
+
+class GatewayConnection(models.Model):
+    """An open gateway socket; keeps its user online until expires_at unless heartbeats extend it"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='gateway_connections')
+    channel_name = models.CharField(max_length=255, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} on {self.channel_name}"
+
+
 # ==================== IDE MODELS FOR PAID USERS ====================
 
 class IDEProject(models.Model):
@@ -344,6 +584,14 @@ class IDEProject(models.Model):
         """Update last accessed timestamp"""
         self.last_accessed = timezone.now()
         self.save(update_fields=['last_accessed'])
+    
+    def permission_for(self, user):
+        """'owner', the collaborator permission ('edit'/'view'), or None if the user has no access"""
+        if not user.is_authenticated:
+            return None
+        if self.user_id == user.id:
+            return 'owner'
+        return self.collaborators.filter(user=user).values_list('permission', flat=True).first()
 
 
 class IDEDirectory(models.Model):
@@ -412,6 +660,11 @@ class IDEFile(models.Model):
         return f"{self.project.name}/{self.path}"
     
     def save(self, *args, **kwargs):
+        self.refresh_metadata()
+        super().save(*args, **kwargs)
+    
+    def refresh_metadata(self):
+        """Recompute size and file type from content and name (bulk writes skip save())"""
         # Update file size
         self.size = len(self.content.encode('utf-8'))
         
@@ -429,8 +682,6 @@ class IDEFile(models.Model):
                 'js': 'javascript',
             }
             self.file_type = type_mapping.get(ext, 'other')
-        
-        super().save(*args, **kwargs)
     
     def get_full_path(self):
         """Get full file path"""
@@ -439,6 +690,27 @@ class IDEFile(models.Model):
         return self.name
 
 
+class IDEProjectCollaborator(models.Model):
+    """Users invited by the owner to work on an IDE project"""
+    PERMISSION_CHOICES = [
+        ('view', 'View Only'),
+        ('edit', 'Can Edit'),
+    ]
+    
+    project = models.ForeignKey(IDEProject, on_delete=models.CASCADE, related_name='collaborators')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ide_collaborations')
+    permission = models.CharField(max_length=10, choices=PERMISSION_CHOICES, default='edit')
+    invited_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        unique_together = ['project', 'user']
+    
+    def __str__(self):
+        return f"{self.user.username} on {self.project.name} ({self.permission})"
+
+
 class IDEExecutionLog(models.Model):
     """Execution logs for IDE code runs"""
     project = models.ForeignKey(IDEProject, on_delete=models.CASCADE, related_name='execution_logs')
@@ -448,7 +720,7 @@ class IDEExecutionLog(models.Model):
     error = models.TextField(blank=True)
     execution_time = models.FloatField(default=0)  # milliseconds
     was_successful = models.BooleanField(default=True)
-    executed_at = models.DateTimeField(auto_now_add=True)
+    executed_at = models.DateTimeField(default=timezone.now)  # Set at run time, logs are written in batches
     
     class Meta:
         ordering = ['-executed_at']
@@ -461,38 +733,124 @@ class IDEExecutionLog(models.Model):
         return f"{self.project.name} - {self.executed_at.strftime('%Y-%m-%d %H:%M:%S')}"
 
 
+class IDEExecutionDailyStats(models.Model):
+    """Per-project, per-day rollup of IDE execution logs"""
+    project = models.ForeignKey(IDEProject, on_delete=models.CASCADE, related_name='execution_stats')
+    date = models.DateField()
+    total_runs = models.IntegerField(default=0)
+    failed_runs = models.IntegerField(default=0)
+    avg_time = models.FloatField(default=0)  # milliseconds
+    p50_time = models.FloatField(default=0)
+    p95_time = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date']
+        unique_together = ['project', 'date']
+        verbose_name_plural = 'IDE execution daily stats'
+    
+    def __str__(self):
+        return f"{self.project.name} - {self.date} ({self.total_runs} runs)"
+    
+    def to_dict(self):
+        return {
+            'date': self.date.isoformat(),
+            'total_runs': self.total_runs,
+            'failed_runs': self.failed_runs,
+            'avg_time': self.avg_time,
+            'p50_time': self.p50_time,
+            'p95_time': self.p95_time
+        }
+
+
 class IDETerminalSession(models.Model):
     """Terminal sessions for IDE"""
+    HISTORY_LIMIT = 100  # Entries kept per session
+    COMPACT_INTERVAL = 25  # Compact old entries every N appends
+
     project = models.ForeignKey(IDEProject, on_delete=models.CASCADE, related_name='terminal_sessions')
     session_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     is_active = models.BooleanField(default=True)
-    history = models.JSONField(default=list)  # List of command/output pairs
+    last_seq = models.PositiveBigIntegerField(default=0)  # Sequence number of the newest history entry
     environment_vars = models.JSONField(default=dict)  # Custom environment variables
     created_at = models.DateTimeField(auto_now_add=True)
     last_active = models.DateTimeField(auto_now=True)
-    
+
     class Meta:
         ordering = ['-last_active']
         indexes = [
             models.Index(fields=['project', 'is_active']),
             models.Index(fields=['session_id']),
         ]
-    
+
     def __str__(self):
         return f"{self.project.name} - Terminal {self.session_id}"
-    
+
     def add_to_history(self, command, output, error=''):
-        """Add command and output to history"""
-        self.history.append({
-            'command': command,
-            'output': output,
-            'error': error,
-            'timestamp': timezone.now().isoformat()
-        })
-        # Keep only last 100 entries
-        if len(self.history) > 100:
-            self.history = self.history[-100:]
-        self.save(update_fields=['history', 'last_active'])
+        """Append a command and its output to history without rewriting older entries"""
+        with transaction.atomic():
+            # The UPDATE locks the session row, so concurrent appends get distinct sequence numbers
+            IDETerminalSession.objects.filter(pk=self.pk).update(
+                last_seq=models.F('last_seq') + 1,
+                last_active=timezone.now()
+            )
+            self.last_seq = IDETerminalSession.objects.values_list('last_seq', flat=True).get(pk=self.pk)
+            entry = IDETerminalEntry.objects.create(
+                session=self,
+                seq=self.last_seq,
+                command=command,
+                output=output,
+                error=error
+            )
+
+        if self.last_seq % self.COMPACT_INTERVAL == 0:
+            self.compact_history()
+        return entry
+
+    def get_history(self, before=None, limit=50):
+        """Get the newest history entries, optionally only those older than sequence `before`"""
+        entries = self.entries.filter(seq__gt=self.last_seq - self.HISTORY_LIMIT)
+        if before is not None:
+            entries = entries.filter(seq__lt=before)
+        entries = list(entries.order_by('-seq')[:limit])
+        entries.reverse()
+        return entries
+
+    def compact_history(self):
+        """Delete entries that have fallen out of the history window"""
+        deleted, _ = self.entries.filter(seq__lte=self.last_seq - self.HISTORY_LIMIT).delete()
+        return deleted
+
+    def clear_history(self):
+        """Remove all history entries (sequence numbers keep increasing)"""
+        self.entries.all().delete()
+
+
+class IDETerminalEntry(models.Model):
+    """A single command/output pair in a terminal session's history"""
+    session = models.ForeignKey(IDETerminalSession, on_delete=models.CASCADE, related_name='entries')
+    seq = models.PositiveBigIntegerField()
+    command = models.TextField(blank=True)
+    output = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['seq']
+        unique_together = ['session', 'seq']
+        verbose_name_plural = 'IDE terminal entries'
+
+    def __str__(self):
+        return f"Terminal {self.session.session_id} #{self.seq}"
+
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'command': self.command,
+            'output': self.output,
+            'error': self.error,
+            'timestamp': self.created_at.isoformat()
+        }
 
 
 # ==================== ACHIEVEMENT SYSTEM ====================
@@ -558,7 +916,7 @@ class UserAchievement(models.Model):
 # SERVER SYSTEM (Discord-like)
 # ============================================
 
-class Server(models.Model):
+class Server(CounterFieldsMixin, models.Model):
     """Discord-like servers for community collaboration"""
     server_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     name = models.CharField(max_length=100)
@@ -570,6 +928,11 @@ class Server(models.Model):
     is_public = models.BooleanField(default=True)  # Public servers can be discovered
     invite_code = models.CharField(max_length=20, unique=True, blank=True)  # For inviting users
     
+    # Denormalized counters (see server_counters.py)
+    member_count = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -580,8 +943,11 @@ class Server(models.Model):
             models.Index(fields=['invite_code']),
             models.Index(fields=['is_public']),
             models.Index(fields=['-created_at']),
+            models.Index(fields=['is_public', '-member_count']),
         ]
     
+    COUNTER_FIELDS = ('member_count', 'message_count', 'last_message_at')
+    
     def __str__(self):
         return f"{self.name} (Owner: {self.owner.username})"
     
@@ -597,7 +963,7 @@ class Server(models.Model):
                 return code
     
     def get_member_count(self):
-        return self.members.count()
+        return self.member_count
     
     def get_icon_url(self):
         if self.icon_url:
@@ -645,6 +1011,14 @@ class ServerMember(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.server.name} ({self.role})"
     
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        from .server_counters import record_join
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            record_join(self)
+    
     def display_name(self):
         return self.nickname if self.nickname else self.user.username
 
@@ -699,7 +1073,7 @@ class ServerRole(models.Model):
         return f"{self.name} ({self.server.name})"
 
 
-class ServerChannel(models.Model):
+class ServerChannel(CounterFieldsMixin, models.Model):
     """Text and voice channels within servers"""
     CHANNEL_TYPE_CHOICES = [
         ('text', 'Text Channel'),
@@ -723,6 +1097,10 @@ class ServerChannel(models.Model):
     is_private = models.BooleanField(default=False)  # Only certain roles can see
     allowed_roles = models.ManyToManyField(ServerRole, blank=True, related_name='accessible_channels')
     
+    # Denormalized counters (see server_counters.py)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -733,11 +1111,13 @@ class ServerChannel(models.Model):
             models.Index(fields=['server', 'channel_type']),
         ]
     
+    COUNTER_FIELDS = ('message_count', 'last_message_at')
+    
     def __str__(self):
         return f"#{self.name} ({self.server.name})"
     
     def get_message_count(self):
-        return self.messages.count()
+        return self.message_count
 
 
 class ServerMessage(models.Model):
@@ -762,13 +1142,22 @@ class ServerMessage(models.Model):
     class Meta:
         ordering = ['timestamp']
         indexes = [
-            models.Index(fields=['channel', 'timestamp']),
+            models.Index(fields=['channel', 'timestamp', 'id']),
             models.Index(fields=['sender']),
             models.Index(fields=['is_pinned']),
         ]
     
     def __str__(self):
         return f"{self.sender.username} in {self.channel.name}: {self.content[:50]}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        # The message and its channel/server counters commit together
+        from .server_counters import record_message
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            record_message(self)
 
 
 class ServerMessageReaction(models.Model):
@@ -789,6 +1178,66 @@ class ServerMessageReaction(models.Model):
         return f"{self.user.username} reacted {self.emoji} to message {self.message.message_id}"
 
 
+class ReadState(models.Model):
+    """
+    How far a user has read a server channel or a DM conversation.
+    
+    Exactly one of channel/peer is set. Unread and mention counts are kept up
+    to date as messages arrive (see read_states.py) so sidebar badges never
+    count messages.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    channel = models.ForeignKey(ServerChannel, null=True, blank=True, on_delete=models.CASCADE, related_name='read_states')
+    peer = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='+')  # DM conversation partner
+    
+    last_read_id = models.BigIntegerField(default=0)  # pk of the last ServerMessage/DirectMessage read
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    mention_count = models.PositiveIntegerField(default=0)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = [['user', 'channel'], ['user', 'peer']]
+        indexes = [
+            models.Index(fields=['user', 'unread_count']),
+        ]
+    
+    def __str__(self):
+        target = f"#{self.channel_id}" if self.channel_id else f"DM {self.peer_id}"
+        return f"{self.user_id} read state for {target}: {self.unread_count} unread"
+
+
+class MessageSearchDocument(models.Model):
+    """
+    Search index entry for one server or direct message (see search.py).
+    
+    Written alongside the message with the fields search results are
+    filtered on; the full-text index over `content` is maintained by the
+    database (an FTS5 table on SQLite, a tsvector column on PostgreSQL).
+    """
+    server_message = models.OneToOneField(ServerMessage, null=True, blank=True, on_delete=models.CASCADE, related_name='search_document')
+    direct_message = models.OneToOneField(DirectMessage, null=True, blank=True, on_delete=models.CASCADE, related_name='search_document')
+    
+    server = models.ForeignKey(Server, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    channel = models.ForeignKey(ServerChannel, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    recipient = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='+')  # DMs only
+    
+    content = models.TextField()
+    created_at = models.DateTimeField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['server', 'created_at']),
+            models.Index(fields=['sender', 'created_at']),
+            models.Index(fields=['recipient', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"Search document for {'server' if self.server_message_id else 'direct'} message: {self.content[:30]}"
+
+
 class ServerInvite(models.Model):
     """Server invite links with tracking"""
     invite_code = models.CharField(max_length=20, unique=True)
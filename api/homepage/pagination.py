@@ -0,0 +1,86 @@
+"""
+Keyset (cursor) pagination helpers for newest-first history endpoints.
+"""
+import base64
+import json
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(timestamp, pk):
+    """Encode an opaque cursor pointing just after the row (timestamp, pk)"""
+    raw = json.dumps([timestamp.isoformat(), pk]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor; raises ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None:
+            raise ValueError('Invalid cursor')
+        return timestamp, int(pk)
+    except (TypeError, ValueError, UnicodeError, json.JSONDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def keyset_page(queryset, cursor=None, limit=50, time_field='executed_at'):
+    """
+    Return (rows, next_cursor) for one newest-first page of `queryset`.
+
+    Rows are ordered by (time_field, id) descending and the page starts after
+    `cursor`, so every page costs one indexed range scan regardless of depth.
+    """
+    queryset = queryset.order_by(f'-{time_field}', '-id')
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f'{time_field}__lt': timestamp}) |
+            Q(**{time_field: timestamp, 'id__lt': pk})
+        )
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, time_field), last.pk)
+    return rows, next_cursor
+
+
+def approximate_count(cache_key, queryset, timeout=60):
+    """Count rows, caching the result for `timeout` seconds"""
+    total = cache.get(cache_key)
+    if total is None:
+        total = queryset.count()
+        cache.set(cache_key, total, timeout)
+    return total
+
+
+def keyset_slice(queryset, limit, before=None, after=None, time_field='timestamp'):
+    """
+    Return (rows, has_more) for up to `limit` rows next to a (timestamp, pk) anchor.
+
+    With `after`, rows newer than it in ascending order; otherwise rows older
+    than `before` (or the newest rows) in descending order. Either way the
+    rows nearest the anchor come first and the query is one indexed range scan.
+    """
+    if after is not None:
+        timestamp, pk = after
+        queryset = queryset.filter(
+            Q(**{f'{time_field}__gt': timestamp}) | Q(**{time_field: timestamp, 'id__gt': pk})
+        ).order_by(time_field, 'id')
+    else:
+        queryset = queryset.order_by(f'-{time_field}', '-id')
+        if before is not None:
+            timestamp, pk = before
+            queryset = queryset.filter(
+                Q(**{f'{time_field}__lt': timestamp}) | Q(**{time_field: timestamp, 'id__lt': pk})
+            )
+
+    rows = list(queryset[:limit + 1])
+    return rows[:limit], len(rows) > limit
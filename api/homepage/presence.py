@@ -0,0 +1,70 @@
+"""
+Coalesced presence updates (cursors, typing, online status) for WebSocket groups.
+
+Consumers hand ephemeral updates to `presence.publish()` instead of sending a
+group message each. Per group, only the latest update per (kind, user) is
+kept, and at most PRESENCE_TICK_RATE frames per second are sent as a single
+
+    {"type": "presence", "updates": [{"kind": "cursor", "user_id": 1, ...}, ...]}
+
+frame. The frame goes through the group wrapped with wire.encode_frame(),
+so each worker encodes it at most once per wire protocol in use and
+recipients relay the shared bytes. Clients ignore their own updates.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .wire import encode_frame
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceCoalescer:
+    """Per-process, per-group buffer of the latest presence update per sender"""
+
+    def __init__(self):
+        self._pending = {}    # group -> {(kind, user_id): update}
+        self._scheduled = {}  # group -> pending flush task
+        self._last_sent = {}  # group -> loop time of the last frame
+
+    @property
+    def tick_rate(self):
+        return max(getattr(settings, 'PRESENCE_TICK_RATE', 10), 1)
+
+    async def publish(self, channel_layer, group, kind, user_id, **data):
+        """Queue an update; sent at once if the group is idle, else with the next tick"""
+        update = {'kind': kind, 'user_id': user_id}
+        update.update(data)
+        self._pending.setdefault(group, {})[(kind, user_id)] = update
+        if group in self._scheduled:
+            return
+
+        loop = asyncio.get_running_loop()
+        delay = self._last_sent.get(group, float('-inf')) + 1 / self.tick_rate - loop.time()
+        if delay <= 0:
+            await self.flush(channel_layer, group)
+        else:
+            self._scheduled[group] = loop.create_task(self._flush_later(channel_layer, group, delay))
+
+    async def flush(self, channel_layer, group):
+        """Send everything pending for `group` as one frame"""
+        self._scheduled.pop(group, None)
+        updates = self._pending.pop(group, None)
+        if not updates:
+            self._last_sent.pop(group, None)
+            return
+        self._last_sent[group] = asyncio.get_running_loop().time()
+        frame = encode_frame({'type': 'presence', 'updates': list(updates.values())})
+        await channel_layer.group_send(group, dict(frame, type='presence_frame'))
+
+    async def _flush_later(self, channel_layer, group, delay):
+        try:
+            await asyncio.sleep(delay)
+            await self.flush(channel_layer, group)
+        except Exception:
+            logger.exception('Failed to send presence frame to %s', group)
+
+
+presence = PresenceCoalescer()
@@ -0,0 +1,104 @@
+"""
+Precomputed discovery boards for public shared code.
+
+`refresh_rankings()` (run by the `refresh_shared_code_rankings` command)
+scores eligible snippets from their view/fork counters and per-day stats and
+rewrites SharedCodeRanking, so the feed endpoint only reads a small table.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+FORK_WEIGHT = 3  # A fork says more about a snippet than a view
+WEEKLY_DAYS = 7
+TRENDING_DAYS = 14
+TRENDING_HALF_LIFE_DAYS = 2
+
+
+def eligible_shared_code():
+    """Snippets that may appear on a board: public, active, simple and not expired"""
+    from .models import SharedCode
+
+    return SharedCode.objects.filter(
+        is_public=True, is_active=True, session_type='simple'
+    ).filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+
+
+def all_time_scores(limit):
+    return list(
+        eligible_shared_code()
+        .annotate(score=F('view_count') + FORK_WEIGHT * F('fork_count'))
+        .order_by('-score', '-created_at')
+        .values_list('pk', 'score')[:limit]
+    )
+
+
+def _daily_scores(days, half_life=None):
+    from .models import SharedCodeDailyStats
+
+    today = timezone.localdate()
+    scores = defaultdict(float)
+    rows = SharedCodeDailyStats.objects.filter(
+        date__gt=today - timedelta(days=days),
+        shared_code__in=eligible_shared_code(),
+    ).values_list('shared_code_id', 'date', 'views', 'forks')
+    for pk, day, views, forks in rows.iterator():
+        score = views + FORK_WEIGHT * forks
+        if half_life:
+            score *= 0.5 ** ((today - day).days / half_life)
+        scores[pk] += score
+    return scores
+
+
+def _top(scores, limit):
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+    return [(pk, score) for pk, score in ranked[:limit] if score > 0]
+
+
+def weekly_scores(limit):
+    return _top(_daily_scores(WEEKLY_DAYS), limit)
+
+
+def trending_scores(limit):
+    return _top(_daily_scores(TRENDING_DAYS, half_life=TRENDING_HALF_LIFE_DAYS), limit)
+
+
+BOARD_SCORERS = {
+    'all_time': all_time_scores,
+    'weekly': weekly_scores,
+    'trending': trending_scores,
+}
+
+
+def refresh_rankings(size=None, boards=None):
+    """Recompute the given boards (default: all); returns {board: rows written}"""
+    from .models import SharedCodeRanking
+
+    if size is None:
+        size = getattr(settings, 'SHARED_CODE_RANKING_SIZE', 100)
+
+    written = {}
+    now = timezone.now()
+    for board in boards or BOARD_SCORERS:
+        scores = BOARD_SCORERS[board](size)
+        with transaction.atomic():
+            SharedCodeRanking.objects.filter(board=board).delete()
+            SharedCodeRanking.objects.bulk_create([
+                SharedCodeRanking(board=board, rank=rank, shared_code_id=pk, score=score, computed_at=now)
+                for rank, (pk, score) in enumerate(scores, start=1)
+            ])
+        written[board] = len(scores)
+    return written
+
+
+def prune_daily_stats(keep_days=30):
+    """Delete per-day stats older than any board looks at"""
+    from .models import SharedCodeDailyStats
+
+    cutoff = timezone.localdate() - timedelta(days=max(keep_days, TRENDING_DAYS))
+    deleted, _ = SharedCodeDailyStats.objects.filter(date__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,188 @@
+"""
+Read markers and unread/mention badges for server channels and DMs.
+
+ReadState counters are maintained as messages arrive (see signals.py)
+instead of counting messages whenever the sidebar asks:
+
+  - a channel message adds one unread to every other member's state for the
+    channel, and one mention to the members it @mentions (everyone, for
+    @everyone/@here from an owner or admin), in a single UPDATE
+  - a direct message adds one unread to the recipient's state for the sender
+
+Members get a state for every channel of a server when they join and for
+channels created later, starting out caught up. `ack_channel` and
+`ack_direct_messages` move the marker; `unread_badges` reads every badge of
+a user in one query.
+"""
+import re
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+from django.utils import timezone
+
+from .models import DirectMessage, ReadState, ServerChannel, ServerMember, ServerMessage
+
+MENTION_RE = re.compile(r'@([\w.@+-]+)')
+EVERYONE = {'everyone', 'here'}
+ACK_ATTEMPTS = 5  # Recounts before an ack gives up on a channel that keeps changing
+
+
+def mentioned_names(content):
+    """Usernames (and everyone/here) @mentioned in a message"""
+    return {name.rstrip('.') for name in MENTION_RE.findall(content)}
+
+
+def mentions(message):
+    """(user ids, everyone) mentioned by a channel message"""
+    names = mentioned_names(message.content)
+    if not names:
+        return set(), False
+    everyone = bool(names & EVERYONE) and ServerMember.objects.filter(
+        server_id=message.channel.server_id, user_id=message.sender_id, role__in=['owner', 'admin']
+    ).exists()
+    user_ids = set(User.objects.filter(username__in=names - EVERYONE).values_list('id', flat=True))
+    return user_ids, everyone
+
+
+def record_channel_message(message):
+    """Count a new channel message as unread for every member but its sender"""
+    user_ids, everyone = mentions(message)
+    changes = {'unread_count': F('unread_count') + 1}
+    if everyone:
+        changes['mention_count'] = F('mention_count') + 1
+    elif user_ids:
+        changes['mention_count'] = Case(
+            When(user_id__in=user_ids, then=F('mention_count') + 1),
+            default=F('mention_count'),
+            output_field=PositiveIntegerField(),
+        )
+    ReadState.objects.filter(channel_id=message.channel_id).exclude(user_id=message.sender_id).update(**changes)
+
+
+def record_direct_message(message):
+    """Count a new direct message as unread for its recipient"""
+    states = ReadState.objects.filter(user_id=message.recipient_id, peer_id=message.sender_id)
+    if states.update(unread_count=F('unread_count') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ReadState.objects.create(user_id=message.recipient_id, peer_id=message.sender_id, unread_count=1)
+    except IntegrityError:
+        # Created by a concurrent message
+        states.update(unread_count=F('unread_count') + 1)
+
+
+def add_member_states(server_id, user_id):
+    """Caught-up states for every channel of a server a user just joined"""
+    ReadState.objects.bulk_create([
+        ReadState(user_id=user_id, channel_id=channel_id, last_read_at=timezone.now())
+        for channel_id in ServerChannel.objects.filter(server_id=server_id).values_list('id', flat=True)
+    ], ignore_conflicts=True)
+
+
+def add_channel_states(channel):
+    """Caught-up states for every member of a new channel's server"""
+    ReadState.objects.bulk_create([
+        ReadState(user_id=user_id, channel_id=channel.pk, last_read_at=timezone.now())
+        for user_id in ServerMember.objects.filter(server_id=channel.server_id).values_list('user_id', flat=True)
+    ], ignore_conflicts=True)
+
+
+def remove_member_states(server_id, user_id):
+    ReadState.objects.filter(user_id=user_id, channel__server_id=server_id).delete()
+
+
+def _unread_after(user, channel, message):
+    """(unread, mentions) for `user` among the messages after `message`, counted like record_channel_message"""
+    after = ServerMessage.objects.filter(channel=channel).filter(
+        Q(timestamp__gt=message.timestamp) | Q(timestamp=message.timestamp, id__gt=message.pk)
+    ).exclude(sender=user)
+    unread = after.count()
+    if not unread:
+        return 0, 0
+
+    # Narrow down in SQL, then match whole names in Python (so @bobby is not a mention of bob)
+    candidates = after.filter(
+        Q(content__contains=f'@{user.username}') | Q(content__contains='@everyone') | Q(content__contains='@here')
+    ).values_list('sender_id', 'content')
+    mentioned, admins = 0, None
+    for sender_id, content in candidates:
+        names = mentioned_names(content)
+        if user.username in names:
+            mentioned += 1
+        elif names & EVERYONE:
+            if admins is None:
+                admins = set(ServerMember.objects.filter(
+                    server_id=channel.server_id, role__in=['owner', 'admin']
+                ).values_list('user_id', flat=True))
+            mentioned += sender_id in admins
+    return unread, mentioned
+
+
+def ack_channel(user, channel, message=None):
+    """
+    Mark a channel read up to `message` (default: its newest message).
+    Markers never move backwards; returns the updated ReadState.
+    """
+    for _ in range(ACK_ATTEMPTS):
+        state, _ = ReadState.objects.get_or_create(user=user, channel=channel)
+        target = message or ServerMessage.objects.filter(channel=channel).order_by('-timestamp', '-id').first()
+        if target is None:
+            unread = mentioned = 0
+            last_read_id, last_read_at = state.last_read_id, state.last_read_at
+        else:
+            if state.last_read_id and state.last_read_at and (target.timestamp, target.pk) <= (state.last_read_at, state.last_read_id):
+                return state
+            unread, mentioned = _unread_after(user, channel, target)
+            last_read_id, last_read_at = target.pk, target.timestamp
+
+        # Only replace the counts read above: a message counted or another ack
+        # made meanwhile changes them, and then the recount starts over
+        updated = ReadState.objects.filter(
+            pk=state.pk, last_read_id=state.last_read_id,
+            unread_count=state.unread_count, mention_count=state.mention_count,
+        ).update(
+            last_read_id=last_read_id, last_read_at=last_read_at,
+            unread_count=unread, mention_count=mentioned, updated_at=timezone.now(),
+        )
+        if updated:
+            state.last_read_id, state.last_read_at = last_read_id, last_read_at
+            state.unread_count, state.mention_count = unread, mentioned
+            return state
+    state.refresh_from_db()
+    return state
+
+
+def ack_direct_messages(user, peer):
+    """Mark a DM conversation read; only writes when something was unread"""
+    state, created = ReadState.objects.get_or_create(user=user, peer=peer)
+    if not created and not state.unread_count:
+        return False
+    # Zero the badge first so a message arriving meanwhile is counted again
+    ReadState.objects.filter(pk=state.pk).update(unread_count=0, mention_count=0, last_read_at=timezone.now())
+    DirectMessage.objects.filter(sender=peer, recipient=user, is_read=False).update(is_read=True)
+    return True
+
+
+def unread_badges(user):
+    """Every unread channel and conversation of a user, grouped for the sidebar"""
+    rows = ReadState.objects.filter(user=user, unread_count__gt=0).values(
+        'channel__channel_id', 'channel__server__server_id', 'peer_id', 'unread_count', 'mention_count'
+    )
+    channels, servers, direct_messages = [], {}, []
+    for row in rows:
+        if row['peer_id'] is not None:
+            direct_messages.append({'user_id': row['peer_id'], 'unread': row['unread_count']})
+            continue
+        server_id = str(row['channel__server__server_id'])
+        channels.append({
+            'channel_id': str(row['channel__channel_id']),
+            'server_id': server_id,
+            'unread': row['unread_count'],
+            'mentions': row['mention_count'],
+        })
+        totals = servers.setdefault(server_id, {'server_id': server_id, 'unread': 0, 'mentions': 0})
+        totals['unread'] += row['unread_count']
+        totals['mentions'] += row['mention_count']
+    return {'channels': channels, 'servers': list(servers.values()), 'direct_messages': direct_messages}
@@ -12,4 +12,7 @@ websocket_urlpatterns = [
     
     # Server channel WebSocket (Discord-like messaging)
     re_path(r'ws/server/channel/(?P<channel_id>[0-9a-f-]+)/$', consumers.ServerChannelConsumer.as_asgi()),
+    
+    # Per-user gateway: every server, DM, friend and presence event on one socket
+    re_path(r'ws/gateway/$', consumers.GatewayConsumer.as_asgi()),
 ]
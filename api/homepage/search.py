@@ -0,0 +1,220 @@
+"""
+Full-text search over server and direct messages.
+
+Every message gets a MessageSearchDocument when it is written (signals.py),
+and `search_messages(user, query, ...)` ranks the documents the user may
+see: messages in servers they are a member of and their own DMs. The
+backend follows the database:
+
+  - SQLite: an external-content FTS5 table (porter stemming) kept in sync
+    by triggers, ranked by bm25() with snippet() highlights
+  - PostgreSQL: a generated tsvector column with a GIN index, ranked by
+    ts_rank() with ts_headline() highlights
+  - anything else, or SQLite built without FTS5: icontains, newest first
+
+Snippets are HTML: matches are wrapped in <mark> and everything else is
+escaped. Messages written before search existed are indexed with the
+`backfill_message_search` command.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+
+from .models import MessageSearchDocument, ServerMember
+
+FTS_TABLE = 'homepage_messagesearch_fts'
+SNIPPET_WORDS = 16
+
+# Highlight markers put around matches by the database, replaced after escaping
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+TERM_RE = re.compile(r'\w+\*?')
+
+
+def server_message_document(message):
+    return MessageSearchDocument(
+        server_message=message,
+        server_id=message.channel.server_id,
+        channel_id=message.channel_id,
+        sender_id=message.sender_id,
+        content=message.content,
+        created_at=message.timestamp,
+    )
+
+
+def direct_message_document(message):
+    return MessageSearchDocument(
+        direct_message=message,
+        sender_id=message.sender_id,
+        recipient_id=message.recipient_id,
+        content=message.message,
+        created_at=message.created_at,
+    )
+
+
+def index_message(message):
+    """Index a new server or direct message"""
+    if hasattr(message, 'channel_id'):
+        server_message_document(message).save()
+    else:
+        direct_message_document(message).save()
+
+
+def reindex_message(message):
+    """Refresh the document of an edited message (no write if the text is unchanged)"""
+    if hasattr(message, 'channel_id'):
+        documents, content = MessageSearchDocument.objects.filter(server_message=message), message.content
+    else:
+        documents, content = MessageSearchDocument.objects.filter(direct_message=message), message.message
+    documents.exclude(content=content).update(content=content)
+
+
+def highlight(snippet):
+    return escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def visible_documents(user, server=None, channel=None, sender=None, since=None, until=None, kind=None):
+    """Documents `user` may see, narrowed by the optional filters"""
+    documents = MessageSearchDocument.objects.filter(
+        Q(server_id__in=ServerMember.objects.filter(user=user).values('server_id'))
+        | Q(recipient=user)
+        | Q(recipient__isnull=False, sender=user)
+    )
+    if kind == 'server':
+        documents = documents.filter(server_message__isnull=False)
+    elif kind == 'direct':
+        documents = documents.filter(direct_message__isnull=False)
+    if server is not None:
+        documents = documents.filter(server=server)
+    if channel is not None:
+        documents = documents.filter(channel=channel)
+    if sender is not None:
+        documents = documents.filter(sender=sender)
+    if since is not None:
+        documents = documents.filter(created_at__gte=since)
+    if until is not None:
+        documents = documents.filter(created_at__lt=until)
+    return documents
+
+
+class SearchBackend:
+    """Ranks documents matching a query; returns [(document id, rank, snippet HTML)]"""
+
+    def search(self, documents, query, limit, offset):
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    def match_expression(self, query):
+        # Quote every term so FTS5 syntax in user input is taken literally; keep prefix stars
+        return ' '.join(
+            '"%s"%s' % (term.rstrip('*'), '*' if term.endswith('*') else '')
+            for term in TERM_RE.findall(query)
+        )
+
+    def search(self, documents, query, limit, offset):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        visible_sql, visible_params = documents.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, bm25({FTS_TABLE}), snippet({FTS_TABLE}, 0, %s, %s, '…', %s) "
+                f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({visible_sql}) "
+                f"ORDER BY bm25({FTS_TABLE}) LIMIT %s OFFSET %s",
+                [MARK_START, MARK_END, SNIPPET_WORDS, expression, *visible_params, limit, offset],
+            )
+            # bm25() is lower for better matches
+            return [(pk, -rank, highlight(snippet)) for pk, rank, snippet in cursor.fetchall()]
+
+
+class PostgresSearchBackend(SearchBackend):
+    def search(self, documents, query, limit, offset):
+        if not TERM_RE.search(query):
+            return []
+        visible_sql, visible_params = documents.values('id').query.sql_with_params()
+        options = f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={SNIPPET_WORDS}, MinWords=5, MaxFragments=2'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT d.id, ts_rank(d.search_vector, q), ts_headline('english', d.content, q, %s) "
+                "FROM homepage_messagesearchdocument d, websearch_to_tsquery('english', %s) q "
+                f"WHERE d.search_vector @@ q AND d.id IN ({visible_sql}) "
+                "ORDER BY 2 DESC, d.id DESC LIMIT %s OFFSET %s",
+                [options, query, *visible_params, limit, offset],
+            )
+            return [(pk, rank, highlight(snippet)) for pk, rank, snippet in cursor.fetchall()]
+
+
+class ContainsSearchBackend(SearchBackend):
+    """Unindexed fallback: every term must appear, newest first"""
+
+    def search(self, documents, query, limit, offset):
+        terms = [term.rstrip('*') for term in TERM_RE.findall(query)]
+        if not terms:
+            return []
+        for term in terms:
+            documents = documents.filter(content__icontains=term)
+        pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+        results = []
+        for pk, content in documents.order_by('-created_at', '-id').values_list('id', 'content')[offset:offset + limit]:
+            first = pattern.search(content)
+            start = max(first.start() - 60, 0) if first else 0
+            excerpt = pattern.sub(lambda match: MARK_START + match.group(0) + MARK_END, content[start:start + 200])
+            results.append((pk, 0.0, highlight(('…' if start else '') + excerpt)))
+        return results
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if connection.vendor == 'postgresql':
+            _backend = PostgresSearchBackend()
+        elif connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names():
+            _backend = SQLiteFTSBackend()
+        else:
+            _backend = ContainsSearchBackend()
+    return _backend
+
+
+def search_messages(user, query, limit=20, offset=0, **filters):
+    """
+    Ranked messages matching `query` that `user` may see, as dicts with a
+    highlighted snippet. Filters: server, channel, sender, since, until and
+    kind ('server' or 'direct').
+    """
+    hits = get_backend().search(visible_documents(user, **filters), query, limit, offset)
+    documents = MessageSearchDocument.objects.select_related(
+        'server_message', 'server', 'channel', 'sender'
+    ).in_bulk([pk for pk, _, _ in hits])
+
+    results = []
+    for pk, rank, snippet in hits:
+        document = documents.get(pk)
+        if document is None:
+            continue
+        result = {
+            'kind': 'server' if document.server_message_id else 'direct',
+            'sender': {'id': document.sender_id, 'username': document.sender.username},
+            'snippet': snippet,
+            'rank': round(rank, 4),
+            'timestamp': document.created_at.isoformat(),
+        }
+        if document.server_message_id:
+            result.update({
+                'message_id': str(document.server_message.message_id),
+                'server': {'server_id': str(document.server.server_id), 'name': document.server.name},
+                'channel': {'channel_id': str(document.channel.channel_id), 'name': document.channel.name},
+            })
+        else:
+            result.update({
+                'message_id': document.direct_message_id,
+                'recipient_id': document.recipient_id,
+            })
+        results.append(result)
+    return results
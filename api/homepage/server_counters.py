@@ -0,0 +1,124 @@
+"""
+Denormalized member and message counters for servers and channels.
+
+Server.member_count, Server.message_count, ServerChannel.message_count and
+the last_message_at of both are kept up to date with F() updates instead of
+COUNT queries on every server list, server page and discovery request:
+
+  - ServerMessage.save() and ServerMember.save() bump them in the same
+    transaction as the insert
+  - post_delete signals (signals.py) take them back down; Django runs those
+    inside the delete's transaction. Rows deleted because their channel or
+    server is (`deleted_with()`) are skipped: a deleted channel recounts its
+    server once instead, and a deleted server has nothing left to count
+
+Rows written without save() (bulk_create, raw SQL) are not counted;
+`reconcile_counters()` and the `reconcile_server_counters` command recompute
+everything from the source tables.
+"""
+from django.db.models import Count, F, OuterRef, QuerySet, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Server, ServerChannel, ServerMember, ServerMessage
+
+
+def _decrement(field):
+    # Never below zero, even if the counter had already drifted
+    return Greatest(F(field) - 1, Value(0))
+
+
+def _latest_message_at():
+    return Subquery(
+        ServerMessage.objects.filter(channel_id=OuterRef('pk')).order_by('-timestamp').values('timestamp')[:1]
+    )
+
+
+def _latest_channel_message_at():
+    return Subquery(
+        ServerChannel.objects.filter(server_id=OuterRef('pk'), last_message_at__isnull=False)
+        .order_by('-last_message_at').values('last_message_at')[:1]
+    )
+
+
+def _count(queryset, field):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('pk')).values('count')
+    ), 0)
+
+
+def record_message(message):
+    """Count a new channel message"""
+    ServerChannel.objects.filter(pk=message.channel_id).update(
+        message_count=F('message_count') + 1, last_message_at=message.timestamp
+    )
+    Server.objects.filter(channels__pk=message.channel_id).update(
+        message_count=F('message_count') + 1, last_message_at=message.timestamp
+    )
+
+
+def forget_message(message):
+    """Uncount a deleted channel message; last_message_at falls back to the newest one left"""
+    ServerChannel.objects.filter(pk=message.channel_id).update(
+        message_count=_decrement('message_count'), last_message_at=_latest_message_at()
+    )
+    Server.objects.filter(channels__pk=message.channel_id).update(
+        message_count=_decrement('message_count'), last_message_at=_latest_channel_message_at()
+    )
+
+
+def deleted_with(origin, *models):
+    """Whether a delete started from an instance or queryset of one of `models` (the signals' `origin`)"""
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return issubclass(model, models)
+
+
+def forget_channel(channel):
+    """Recount the server of a deleted channel, whose messages were not uncounted one by one"""
+    Server.objects.filter(pk=channel.server_id).update(
+        message_count=_count(ServerMessage.objects.all(), 'channel__server_id'),
+        last_message_at=_latest_channel_message_at(),
+    )
+
+
+def record_join(member):
+    Server.objects.filter(pk=member.server_id).update(member_count=F('member_count') + 1)
+
+
+def record_leave(member):
+    Server.objects.filter(pk=member.server_id).update(member_count=_decrement('member_count'))
+
+
+def reconcile_counters():
+    """
+    Recompute every counter from the member and message tables.
+    Returns (channels fixed, servers fixed).
+    """
+    channels = ServerChannel.objects.annotate(
+        actual_count=_count(ServerMessage.objects.all(), 'channel_id'),
+        actual_last=_latest_message_at(),
+    )
+    channels_fixed = 0
+    for channel in channels.only('pk', 'message_count', 'last_message_at'):
+        if (channel.message_count, channel.last_message_at) != (channel.actual_count, channel.actual_last):
+            ServerChannel.objects.filter(pk=channel.pk).update(
+                message_count=channel.actual_count, last_message_at=channel.actual_last
+            )
+            channels_fixed += 1
+
+    servers = Server.objects.annotate(
+        actual_members=_count(ServerMember.objects.all(), 'server_id'),
+        actual_messages=_count(ServerMessage.objects.all(), 'channel__server_id'),
+        actual_last=_latest_channel_message_at(),
+    )
+    servers_fixed = 0
+    for server in servers.only('pk', 'member_count', 'message_count', 'last_message_at'):
+        current = (server.member_count, server.message_count, server.last_message_at)
+        actual = (server.actual_members, server.actual_messages, server.actual_last)
+        if current != actual:
+            Server.objects.filter(pk=server.pk).update(
+                member_count=server.actual_members,
+                message_count=server.actual_messages,
+                last_message_at=server.actual_last,
+            )
+            servers_fixed += 1
+    return channels_fixed, servers_fixed
@@ -6,12 +6,18 @@ from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST, require_GET
 from django.contrib.auth.models import User
-from django.db.models import Q, Count
+from django.db.models import Q, Count, Case, When, IntegerField, Max, Min
+from django.core.exceptions import ValidationError
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from .models import (
     Server, ServerMember, ServerChannel, ServerMessage, 
     ServerMessageReaction, ServerInvite, UserProfile
 )
+from .pagination import decode_cursor, encode_cursor, keyset_slice
+from .read_states import ack_channel as ack_channel_state, unread_badges
+from .search import search_messages as search_message_index
+from datetime import datetime, time
 import json
 import uuid
 
@@ -23,7 +29,6 @@ def list_user_servers(request):
         servers = Server.objects.filter(
             members__user=request.user
         ).annotate(
-            member_count=Count('members'),
             channel_count=Count('channels')
         ).select_related('owner').order_by('-updated_at')
         
@@ -216,7 +221,8 @@ def get_server_details(request, server_id):
             'name': channel.name,
             'description': channel.description,
             'channel_type': channel.channel_type,
-            'message_count': channel.get_message_count()
+            'message_count': channel.message_count,
+            'last_message_at': channel.last_message_at.isoformat() if channel.last_message_at else None
         } for channel in channels]
         
         # Get members
@@ -237,10 +243,12 @@ def get_server_details(request, server_id):
                 'name': server.name,
                 'description': server.description,
                 'icon_url': server.get_icon_url(),
-                'owner_id': server.owner.id,
+                'owner_id': server.owner_id,
                 'invite_code': server.invite_code if membership.role in ['owner', 'admin'] else None,
                 'is_public': server.is_public,
-                'member_count': server.get_member_count(),
+                'member_count': server.member_count,
+                'message_count': server.message_count,
+                'last_message_at': server.last_message_at.isoformat() if server.last_message_at else None,
                 'created_at': server.created_at.isoformat()
             },
             'channels': channel_list,
@@ -335,47 +343,88 @@ def create_channel(request, server_id):
 
 @login_required
 def get_channel_messages(request, channel_id):
-    """Get messages from a channel"""
+    """
+    Get a page of messages from a channel, in chronological order.
+    
+    Without an anchor this is the newest page. ?before=<cursor> and
+    ?after=<cursor> page towards older/newer messages using the
+    older_cursor/newer_cursor of a previous page, and ?around=<message_id>
+    centres the page on one message.
+    """
     try:
         channel = get_object_or_404(ServerChannel, channel_id=channel_id)
         
         # Check if user is a member of the server
-        membership = ServerMember.objects.filter(
-            server=channel.server,
+        is_member = ServerMember.objects.filter(
+            server_id=channel.server_id,
             user=request.user
-        ).first()
+        ).exists()
         
-        if not membership:
+        if not is_member:
             return JsonResponse({
                 'success': False,
                 'error': 'You are not a member of this server'
             }, status=403)
         
         # Get pagination parameters
-        limit = min(int(request.GET.get('limit', 50)), 100)
-        offset = int(request.GET.get('offset', 0))
+        try:
+            limit = max(1, min(int(request.GET.get('limit', 50)), 100))
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid limit'}, status=400)
         
-        # Get messages
         messages = ServerMessage.objects.filter(
             channel=channel
         ).select_related(
             'sender', 'sender__profile', 'reply_to', 'reply_to__sender'
-        ).prefetch_related('reactions')[offset:offset+limit]
+        )
+        
+        try:
+            before = decode_cursor(request.GET['before']) if request.GET.get('before') else None
+            after = decode_cursor(request.GET['after']) if request.GET.get('after') else None
+        except ValueError as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        try:
+            around = uuid.UUID(request.GET['around']) if request.GET.get('around') else None
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid message id'}, status=400)
+        
+        if around is not None:
+            anchor = ServerMessage.objects.filter(
+                channel=channel, message_id=around
+            ).values_list('timestamp', 'id').first()
+            if anchor is None:
+                return JsonResponse({'success': False, 'error': 'Message not found'}, status=404)
+            # The anchor itself leads the older half: rows up to and including it
+            older, has_older = keyset_slice(messages, limit - limit // 2, before=(anchor[0], anchor[1] + 1))
+            newer, has_newer = keyset_slice(messages, limit // 2, after=anchor)
+            page = older[::-1] + newer
+        elif after is not None:
+            page, has_newer = keyset_slice(messages, limit, after=after)
+            has_older = True
+        else:
+            page, has_older = keyset_slice(messages, limit, before=before)
+            page.reverse()
+            has_newer = before is not None
+        
+        # Reactions aggregated per message and emoji in one query
+        reactions = {}
+        aggregated = ServerMessageReaction.objects.filter(
+            message_id__in=[msg.id for msg in page]
+        ).values('message_id', 'emoji').annotate(
+            count=Count('id'),
+            me=Max(Case(When(user=request.user, then=1), default=0, output_field=IntegerField())),
+            first_at=Min('created_at'),
+        ).order_by('message_id', 'first_at')
+        for row in aggregated:
+            reactions.setdefault(row['message_id'], []).append({
+                'emoji': row['emoji'],
+                'count': row['count'],
+                'me': bool(row['me'])
+            })
         
         message_list = []
-        for msg in messages:
-            # Get reactions grouped by emoji
-            reactions_dict = {}
-            for reaction in msg.reactions.all():
-                if reaction.emoji not in reactions_dict:
-                    reactions_dict[reaction.emoji] = []
-                reactions_dict[reaction.emoji].append(reaction.user.username)
-            
-            reactions = [
-                {'emoji': emoji, 'count': len(users), 'users': users}
-                for emoji, users in reactions_dict.items()
-            ]
-            
+        for msg in page:
             message_data = {
                 'message_id': str(msg.message_id),
                 'sender': {
@@ -387,7 +436,7 @@ def get_channel_messages(request, channel_id):
                 'timestamp': msg.timestamp.isoformat(),
                 'is_edited': msg.is_edited,
                 'is_pinned': msg.is_pinned,
-                'reactions': reactions,
+                'reactions': reactions.get(msg.id, []),
                 'reply_to': None
             }
             
@@ -403,6 +452,10 @@ def get_channel_messages(request, channel_id):
         return JsonResponse({
             'success': True,
             'messages': message_list,
+            'older_cursor': encode_cursor(page[0].timestamp, page[0].id) if page and has_older else None,
+            'newer_cursor': encode_cursor(page[-1].timestamp, page[-1].id) if page and has_newer else None,
+            'has_older': bool(page) and has_older,
+            'has_newer': bool(page) and has_newer,
             'channel': {
                 'channel_id': str(channel.channel_id),
                 'name': channel.name,
@@ -416,6 +469,121 @@ def get_channel_messages(request, channel_id):
         }, status=500)
 
 
+@login_required
+@require_POST
+def ack_channel(request, channel_id):
+    """Mark a channel read up to a message (default: the newest one)"""
+    try:
+        channel = get_object_or_404(ServerChannel, channel_id=channel_id)
+        
+        if not ServerMember.objects.filter(server_id=channel.server_id, user=request.user).exists():
+            return JsonResponse({
+                'success': False,
+                'error': 'You are not a member of this server'
+            }, status=403)
+        
+        data = json.loads(request.body) if request.content_type == 'application/json' and request.body else {}
+        message = None
+        if data.get('message_id'):
+            message = ServerMessage.objects.filter(channel=channel, message_id=data['message_id']).first()
+            if message is None:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Message not found'
+                }, status=404)
+        
+        state = ack_channel_state(request.user, channel, message)
+        
+        return JsonResponse({
+            'success': True,
+            'unread': state.unread_count,
+            'mentions': state.mention_count
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@login_required
+@require_GET
+def get_unread_badges(request):
+    """Unread and mention counts of every channel, server and DM for the sidebar"""
+    try:
+        return JsonResponse(dict(unread_badges(request.user), success=True))
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@login_required
+@require_GET
+def search_messages(request):
+    """
+    Full-text search over the server messages and DMs the user can see.
+    
+    ?q=<terms> with optional server, channel (ids), sender (user id),
+    since/until (ISO date or datetime), kind (server/direct), limit, offset.
+    """
+    try:
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({
+                'success': False,
+                'error': 'Search query is required'
+            }, status=400)
+        
+        filters = {}
+        try:
+            if request.GET.get('server'):
+                filters['server'] = Server.objects.get(server_id=request.GET['server'])
+            if request.GET.get('channel'):
+                filters['channel'] = ServerChannel.objects.get(channel_id=request.GET['channel'])
+            if request.GET.get('sender'):
+                filters['sender'] = int(request.GET['sender'])
+            for name in ('since', 'until'):
+                if request.GET.get(name):
+                    filters[name] = _parse_search_date(request.GET[name])
+        except (Server.DoesNotExist, ServerChannel.DoesNotExist, ValidationError, ValueError) as e:
+            return JsonResponse({
+                'success': False,
+                'error': f'Invalid filter: {e}'
+            }, status=400)
+        if request.GET.get('kind') in ('server', 'direct'):
+            filters['kind'] = request.GET['kind']
+        
+        limit = max(1, min(int(request.GET.get('limit', 20)), 50))
+        offset = max(0, min(int(request.GET.get('offset', 0)), 500))
+        results = search_message_index(request.user, query, limit=limit, offset=offset, **filters)
+        
+        return JsonResponse({
+            'success': True,
+            'results': results,
+            'next_offset': offset + limit if len(results) == limit else None
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+def _parse_search_date(value):
+    """Aware datetime from an ISO datetime or date (midnight)"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'{value!r} is not a date')
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
 @login_required
 @require_POST
 def send_message(request, channel_id):
@@ -628,8 +796,6 @@ def discover_servers(request):
             is_public=True
         ).exclude(
             id__in=user_server_ids
-        ).annotate(
-            member_count=Count('members')
         ).select_related('owner').order_by('-member_count', '-created_at')[:20]
         
         server_list = [{
@@ -991,7 +1157,7 @@ def get_invite_embed_data(request, server_id):
                 'name': server.name,
                 'description': server.description,
                 'icon_url': server.get_icon_url(),
-                'member_count': server.get_member_count(),
+                'member_count': server.member_count,
                 'invite_code': server.invite_code,
                 'is_public': server.is_public
             }
@@ -1134,7 +1300,7 @@ def get_invite_info(request, invite_code):
             return JsonResponse({'status': 'error', 'message': 'Invite expired'}, status=400)
         
         server = invite.server
-        member_count = ServerMember.objects.filter(server=server).count()
+        member_count = server.member_count
         
         # Check if user is already a member
         is_member = ServerMember.objects.filter(server=server, user=request.user).exists()
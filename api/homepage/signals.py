@@ -1,7 +1,10 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile, IDEFile
+from .models import (
+    UserProfile, IDEFile, PythonCodeSession, UserFiles, ServerMessage, DirectMessage, Server, ServerMember,
+    ServerChannel, ServerMessageReaction, Friendship
+)
 from .achievements import initialize_user_achievements, award_achievement_on_file_creation
 
 @receiver(post_save, sender=User)
@@ -32,3 +35,123 @@ def check_beginner_achievement(sender, instance, created, **kwargs):
     """Award beginner achievement when user creates their first file"""
     if created:
         award_achievement_on_file_creation(instance.project.user)
+
+@receiver(post_save, sender=PythonCodeSession)
+@receiver(post_delete, sender=PythonCodeSession)
+@receiver(post_save, sender=UserFiles)
+@receiver(post_delete, sender=UserFiles)
+def invalidate_workspace_snapshot(sender, instance, **kwargs):
+    """Invalidate cached workspace snapshots when a playground file changes"""
+    from .workspace import bump_workspace_version
+    bump_workspace_version(instance.user_id)
+
+@receiver(post_save, sender=ServerMessage)
+def count_unread_channel_message(sender, instance, created, **kwargs):
+    """Bump unread and mention badges of the channel's other members"""
+    if created:
+        from .read_states import record_channel_message
+        record_channel_message(instance)
+
+@receiver(post_save, sender=ServerMessage)
+@receiver(post_save, sender=DirectMessage)
+def index_message_for_search(sender, instance, created, **kwargs):
+    """Write or refresh the message's search document"""
+    from .search import index_message, reindex_message
+    if created:
+        index_message(instance)
+    else:
+        reindex_message(instance)
+
+@receiver(post_save, sender=DirectMessage)
+def count_unread_direct_message(sender, instance, created, **kwargs):
+    """Bump the recipient's unread badge for the conversation"""
+    if created:
+        from .read_states import record_direct_message
+        record_direct_message(instance)
+
+@receiver(post_save, sender=ServerMember)
+def create_member_read_states(sender, instance, created, **kwargs):
+    """Track read state of every channel for a new member"""
+    if created:
+        from .read_states import add_member_states
+        add_member_states(instance.server_id, instance.user_id)
+
+@receiver(post_delete, sender=ServerMember)
+def delete_member_read_states(sender, instance, origin=None, **kwargs):
+    """Forget read state of a server's channels when leaving it"""
+    from .server_counters import deleted_with
+    if deleted_with(origin, Server):
+        return  # The states go with the server's channels
+    from .read_states import remove_member_states
+    remove_member_states(instance.server_id, instance.user_id)
+
+@receiver(post_delete, sender=ServerMessage)
+def uncount_server_message(sender, instance, origin=None, **kwargs):
+    """Take a deleted message off its channel and server counters"""
+    from .server_counters import deleted_with, forget_message
+    if deleted_with(origin, ServerChannel, Server):
+        return  # Recounted once by uncount_server_channel
+    forget_message(instance)
+
+@receiver(post_delete, sender=ServerChannel)
+def uncount_server_channel(sender, instance, origin=None, **kwargs):
+    """Recount the server of a deleted channel once"""
+    from .server_counters import deleted_with, forget_channel
+    if not deleted_with(origin, Server):
+        forget_channel(instance)
+
+@receiver(post_delete, sender=ServerMember)
+def uncount_server_member(sender, instance, origin=None, **kwargs):
+    """Take a former member off the server's member count"""
+    from .server_counters import deleted_with, record_leave
+    if not deleted_with(origin, Server):
+        record_leave(instance)
+
+@receiver(post_save, sender=ServerChannel)
+def create_channel_read_states(sender, instance, created, **kwargs):
+    """Track read state of a new channel for every member"""
+    if created:
+        from .read_states import add_channel_states
+        add_channel_states(instance)
+
+@receiver(post_save, sender=ServerMessage)
+@receiver(post_save, sender=DirectMessage)
+@receiver(post_save, sender=ServerMessageReaction)
+@receiver(post_save, sender=ServerChannel)
+def publish_gateway_event(sender, instance, created, **kwargs):
+    """Push new messages, reactions and channels to open gateway sockets"""
+    if not created:
+        return
+    from . import gateway
+    if sender is ServerMessage:
+        gateway.publish_server_message(instance)
+    elif sender is DirectMessage:
+        gateway.publish_direct_message(instance)
+    elif sender is ServerMessageReaction:
+        gateway.publish_reaction(instance)
+    else:
+        gateway.publish_channel(instance)
+
+@receiver(post_save, sender=ServerMember)
+def subscribe_new_member(sender, instance, created, **kwargs):
+    """Subscribe the new member's open gateways to the server"""
+    if created:
+        from .gateway import publish_membership
+        publish_membership(instance, joined=True)
+
+@receiver(post_delete, sender=ServerMember)
+def unsubscribe_former_member(sender, instance, **kwargs):
+    """Unsubscribe a former member's open gateways from the server"""
+    from .gateway import publish_membership
+    publish_membership(instance, joined=False)
+
+@receiver(post_save, sender=Friendship)
+def publish_friendship_change(sender, instance, **kwargs):
+    """Tell both users' gateways about a friend request or its answer"""
+    from .gateway import publish_friendship
+    publish_friendship(instance)
+
+@receiver(post_delete, sender=Friendship)
+def publish_friendship_removal(sender, instance, **kwargs):
+    from .gateway import publish_friendship
+    publish_friendship(instance, deleted=True)
@@ -1,3 +1,2032 @@
-from django.test import TestCase
+import json
+import os
+import unittest
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.urls import reverse
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from homepage.models import (
+    UserProfile, SessionMember, PythonCodeSession, UserFiles, Notebook, NotebookCell, SharedCode, SharedCodeDailyStats,
+    SharedCodeRanking, CollabOperation, ExecutionHistory, IDEProject, IDEFile, IDEExecutionLog, IDEExecutionDailyStats,
+    IDETerminalSession, IDEProjectCollaborator, CounterHit, Server, ServerChannel, ServerMember, ServerMessage,
+    ServerMessageReaction, ReadState, DirectMessage, Friendship, MessageSearchDocument, UserStatus, GatewayConnection
+)
+from homepage.execution_logs import log_buffer
+from homepage.counters import counters
+from homepage.routing import websocket_urlpatterns
+from homepage.presence import PresenceCoalescer
+from homepage.ide_collab import ide_documents
+from homepage import rankings, read_states, wire
+from homepage.benchmarks import SCENARIOS, run_scenario
+from homepage.search import SQLiteFTSBackend, get_backend, search_messages
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from mywebsite.channel_layers import ShardedRedisChannelLayer, channel_layers_from_env
+try:
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection as FakeAsyncConnection
+except ImportError:
+    fakeredis = None
+from homepage.collab import (
+    InvalidOperation, StaleBaseError, apply_ops, delete_op, diff_ops, document_state, insert_op,
+    live_sessions, submit_ops, submit_text, transform
+)
+
+
+class IDETerminalHistoryTestCase(TestCase):
+    """
+    Test cases for sequenced, bounded IDE terminal history
+    """
+
+    def setUp(self):
+        """Create a user, project and terminal session"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='termuser', password='securepassword123')
+        UserProfile.objects.filter(user=self.user).update(paidUser=True)
+        self.project = IDEProject.objects.create(user=self.user, name='Terminal Project')
+        self.terminal = IDETerminalSession.objects.create(project=self.project)
+
+    def test_append_assigns_sequence_and_compacts(self):
+        """Test appends get increasing sequence numbers and old entries are dropped"""
+        total = IDETerminalSession.HISTORY_LIMIT + IDETerminalSession.COMPACT_INTERVAL
+        for i in range(total):
+            self.terminal.add_to_history(f'print({i})', str(i))
+
+        self.assertEqual(self.terminal.last_seq, total)
+        self.assertEqual(self.terminal.entries.count(), IDETerminalSession.HISTORY_LIMIT)
+        self.assertEqual(self.terminal.entries.first().seq, total - IDETerminalSession.HISTORY_LIMIT + 1)
+
+    def test_terminal_endpoint_returns_tail(self):
+        """Test the terminal endpoint pages backwards with ?before=<seq>"""
+        for i in range(30):
+            self.terminal.add_to_history(f'print({i})', str(i))
+        self.client.login(username='termuser', password='securepassword123')
+        url = reverse('homepage:ide_get_terminal', args=[self.project.project_id])
+
+        data = self.client.get(url, {'limit': 10}).json()['session']
+        self.assertEqual([e['seq'] for e in data['history']], list(range(21, 31)))
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['last_seq'], 30)
+
+        data = self.client.get(url, {'limit': 10, 'before': 5}).json()['session']
+        self.assertEqual([e['seq'] for e in data['history']], [1, 2, 3, 4])
+        self.assertFalse(data['has_more'])
+
+        self.assertEqual(self.client.get(url, {'limit': 'ten'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'before': '5x'}).status_code, 400)
+
+
+@override_settings(IDE_EXEC_LOG_FLUSH_INTERVAL=3600)
+class IDEExecutionLogTestCase(TestCase):
+    """
+    Test cases for buffered execution logs, daily rollups and retention
+    """
+
+    def setUp(self):
+        """Create a user and project"""
+        self.user = User.objects.create_user(username='runner', password='securepassword123')
+        self.project = IDEProject.objects.create(user=self.user, name='Run Project')
+        self.file = IDEFile.objects.create(project=self.project, name='main.py', path='main.py')
+
+    def tearDown(self):
+        """Drop anything left in the shared buffer"""
+        log_buffer.flush()
+
+    def test_buffered_logs_flush_in_one_batch(self):
+        """Test logs are queued and written together with their files resolved"""
+        for i in range(3):
+            log_buffer.record(self.project.id, 'main.py', f'print({i})', str(i), '', 10.0 * (i + 1), True)
+        self.assertEqual(IDEExecutionLog.objects.count(), 0)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(log_buffer.flush(), 3)
+        self.assertEqual(IDEExecutionLog.objects.filter(file=self.file).count(), 3)
+
+    def test_failed_flush_requeues_logs(self):
+        """Test logs are kept for the next flush when writing them fails"""
+        log_buffer.record(self.project.id, 'main.py', 'print(1)', '1', '', 1.0, True)
+        with mock.patch.object(IDEExecutionLog.objects, 'bulk_create', side_effect=RuntimeError('boom')), \
+                self.assertLogs('homepage.execution_logs', 'ERROR'):
+            self.assertEqual(log_buffer.flush(), 0)
+        self.assertEqual(log_buffer.pending_count(), 1)
+        self.assertEqual(log_buffer.flush(), 1)
+        self.assertEqual(IDEExecutionLog.objects.get().file, self.file)
+
+    @override_settings(IDE_EXEC_LOG_FLUSH_INTERVAL=0)
+    def test_zero_interval_writes_through(self):
+        """Test logs are written with the request when buffering is off"""
+        log_buffer.record(self.project.id, 'main.py', 'print(1)', '1', '', 1.0, True)
+        self.assertEqual(log_buffer.pending_count(), 0)
+        self.assertEqual(IDEExecutionLog.objects.count(), 1)
+
+    def test_rollup_and_prune(self):
+        """Test days in the rollup window keep their raw logs and older days are pruned"""
+        now = timezone.now()
+        earlier = now - timedelta(days=3)
+        IDEExecutionLog.objects.bulk_create([
+            IDEExecutionLog(project=self.project, code_snippet='x', execution_time=float(i),
+                            was_successful=i % 10 != 0, executed_at=now - timedelta(seconds=i))
+            for i in range(1, 21)
+        ] + [
+            IDEExecutionLog(project=self.project, code_snippet='y', execution_time=1.0,
+                            executed_at=earlier - timedelta(seconds=i))
+            for i in range(10)
+        ])
+        IDEExecutionLog.objects.create(project=self.project, code_snippet='old',
+                                       executed_at=now - timedelta(days=60))
+
+        call_command('rollup_execution_logs', days=4, keep_last=5, keep_days=30, stdout=StringIO())
+        self.assertEqual(IDEExecutionLog.objects.count(), 30)
+
+        # Rollup -> prune -> rollup: the earlier day leaves the window and is pruned, today is kept whole
+        for _ in range(2):
+            call_command('rollup_execution_logs', days=1, keep_last=5, keep_days=30, stdout=StringIO())
+            stats = IDEExecutionDailyStats.objects.get(project=self.project, date=timezone.localdate(now))
+            self.assertEqual(stats.total_runs, 20)
+            self.assertEqual(stats.failed_runs, 2)
+            self.assertEqual(stats.p50_time, 10.0)
+            self.assertEqual(stats.p95_time, 19.0)
+        self.assertEqual(IDEExecutionLog.objects.count(), 20)
+        self.assertFalse(IDEExecutionLog.objects.filter(code_snippet='y').exists())
+        self.assertEqual(
+            IDEExecutionDailyStats.objects.get(project=self.project, date=timezone.localdate(earlier)).total_runs, 10
+        )
+
+
+    def test_stats_endpoint_validates_days(self):
+        """Test ?days must be an integer and is clamped to a year"""
+        IDEExecutionDailyStats.objects.create(project=self.project, date=timezone.localdate() - timedelta(days=400),
+                                              total_runs=1)
+        UserProfile.objects.filter(user=self.user).update(paidUser=True)
+        client = Client()
+        client.login(username='runner', password='securepassword123')
+        url = reverse('homepage:ide_execution_stats', args=[self.project.project_id])
+
+        self.assertEqual(client.get(url, {'days': 'abc'}).status_code, 400)
+        self.assertEqual(client.get(url, {'days': 1000}).json()['stats'], [])
+
+
+class ExecutionHistoryPaginationTestCase(TestCase):
+    """
+    Test cases for cursor pagination of execution history
+    """
+
+    def setUp(self):
+        """Create a user with history rows sharing timestamps"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='pager', password='securepassword123')
+        UserProfile.objects.filter(user=self.user).update(paidUser=True)
+        self.client.login(username='pager', password='securepassword123')
+
+        now = timezone.now()
+        ExecutionHistory.objects.bulk_create([
+            ExecutionHistory(user=self.user, code_snippet=f'print({i})', executed_at=now - timedelta(seconds=i // 2))
+            for i in range(25)
+        ])
+        self.project = IDEProject.objects.create(user=self.user, name='History Project')
+        main = IDEFile.objects.create(project=self.project, name='main.py', path='main.py')
+        IDEExecutionLog.objects.bulk_create([
+            IDEExecutionLog(project=self.project, file=main, code_snippet=str(i), executed_at=now - timedelta(seconds=i))
+            for i in range(12)
+        ])
+
+    def _walk(self, url, limit):
+        ids, cursor = [], None
+        while True:
+            params = {'limit': limit}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(url, params).json()
+            ids.extend(row['id'] for row in data['history'])
+            cursor = data['next_cursor']
+            if not data['has_more']:
+                return ids
+
+    def test_playground_history_pages_cover_every_row_once(self):
+        """Test cursors walk through ties on executed_at without gaps or repeats"""
+        ids = self._walk(reverse('homepage:get_execution_history'), 7)
+        expected = list(ExecutionHistory.objects.filter(user=self.user)
+                        .order_by('-executed_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_ide_history_includes_file_path_without_extra_queries(self):
+        """Test IDE history resolves file paths in the page query"""
+        url = reverse('homepage:ide_execution_history', args=[self.project.project_id])
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get(url, {'limit': 2})
+        with CaptureQueriesContext(connection) as large_page:
+            data = self.client.get(url, {'limit': 10}).json()
+        self.assertEqual(len(large_page), len(small_page))
+        self.assertEqual(len(data['history']), 10)
+        self.assertTrue(all(row['file_path'] == 'main.py' for row in data['history']))
+        self.assertNotIn('total', data)
+
+        data = self.client.get(url, {'include_total': 1}).json()
+        self.assertEqual(data['total'], 12)
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test a malformed cursor returns 400"""
+        response = self.client.get(reverse('homepage:get_execution_history'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_limit_is_rejected(self):
+        """Test a non-integer limit returns 400 on both history endpoints"""
+        for url in [reverse('homepage:get_execution_history'),
+                    reverse('homepage:ide_execution_history', args=[self.project.project_id])]:
+            self.assertEqual(self.client.get(url, {'limit': 'ten'}).status_code, 400)
+
+
+@override_settings(EXECUTION_HISTORY_CAPACITY=3, EXECUTION_HISTORY_MAX_OUTPUT=10)
+class ExecutionHistoryRingTestCase(TestCase):
+    """
+    Test cases for the per-user execution history ring buffer
+    """
+
+    def setUp(self):
+        """Create and log in a user"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='ringuser', password='securepassword123')
+        self.client.login(username='ringuser', password='securepassword123')
+
+    def test_saves_wrap_around_capacity(self):
+        """Test saving past capacity overwrites the oldest slots"""
+        url = reverse('homepage:save_execution_history')
+        for i in range(5):
+            response = self.client.post(url, json.dumps({'code': f'print({i})', 'output': 'x' * 50}),
+                                        content_type='application/json')
+            self.assertIsNotNone(response.json()['history_id'])
+
+        history = ExecutionHistory.objects.filter(user=self.user).order_by('slot')
+        self.assertEqual([h.code_snippet for h in history], ['print(3)', 'print(4)', 'print(2)'])
+        self.assertTrue(all(len(h.output) == 10 for h in history))
+        self.assertEqual(UserProfile.objects.get(user=self.user).history_cursor, 5)
+
+    def test_lowered_capacity_drops_extra_slots(self):
+        """Test slots past a lowered capacity are deleted on the next save"""
+        for i in range(3):
+            ExecutionHistory.record(self.user, f'print({i})')
+        with self.settings(EXECUTION_HISTORY_CAPACITY=2):
+            ExecutionHistory.record(self.user, 'print(3)')
+
+        history = ExecutionHistory.objects.filter(user=self.user).order_by('slot')
+        self.assertEqual([(h.slot, h.code_snippet) for h in history], [(0, 'print(0)'), (1, 'print(3)')])
+
+
+class WorkspaceSyncTestCase(TestCase):
+    """
+    Test cases for the diff-based playground autosave
+    """
+
+    def setUp(self):
+        """Create and log in a user"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='syncuser', password='securepassword123')
+        self.client.login(username='syncuser', password='securepassword123')
+        self.url = reverse('homepage:save_user_data')
+
+    def _save(self, payload):
+        return self.client.post(self.url, json.dumps(payload), content_type='application/json')
+
+    def test_unchanged_files_are_not_rewritten(self):
+        """Test resending identical content skips the write and keeps versions"""
+        payload = {
+            'currentCode': 'print(1)',
+            'scripts': {'python_script_util.py': 'x = 1', 'data_file_notes.txt': 'hello'}
+        }
+        data = self._save(payload).json()
+        self.assertEqual(data['stats']['created'], 3)
+        self.assertEqual(data['versions'], {
+            'currentCode': 1, 'python_script_util.py': 1, 'data_file_notes.txt': 1
+        })
+
+        with CaptureQueriesContext(connection) as queries:
+            data = self._save(payload).json()
+        self.assertEqual(data['stats']['unchanged'], 3)
+        self.assertFalse(any('INSERT' in q['sql'] and 'homepage_' in q['sql'] for q in queries.captured_queries))
+
+        data = self._save({'scripts': {'python_script_util.py': 'x = 2'}}).json()
+        self.assertEqual(data['stats']['updated'], 1)
+        self.assertEqual(data['versions']['python_script_util.py'], 2)
+        self.assertEqual(data['versions']['currentCode'], 1)
+        self.assertEqual(PythonCodeSession.objects.get(user=self.user, filename='util.py').code_content, 'x = 2')
+
+    def test_file_limit_skips_new_scripts(self):
+        """Test new scripts past the limit are skipped and get no version, so clients retry them"""
+        scripts = {f'python_script_s{i}.py': str(i) for i in range(12)}
+        data = self._save({'scripts': scripts}).json()
+        self.assertEqual(data['stats']['created'], 10)
+        self.assertEqual(data['stats']['skipped'], 2)
+        self.assertEqual(len(data['versions']), 10)
+        self.assertTrue(set(data['versions']) < set(scripts))
+        self.assertEqual(self._save({'currentCode': 'print(1)'}).status_code, 400)
+
+
+class WorkspaceSnapshotTestCase(TestCase):
+    """
+    Test cases for the cacheable load_user_data snapshot
+    """
+
+    def setUp(self):
+        """Create a user with a few playground files"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='loaduser', password='securepassword123')
+        self.client.login(username='loaduser', password='securepassword123')
+        PythonCodeSession.objects.create(user=self.user, filename='main.py', code_content='print(1)')
+        PythonCodeSession.objects.create(user=self.user, filename='util.py', code_content='x = 1')
+        Notebook.objects.create(user=self.user, name='analysis')
+        UserFiles.objects.create(user=self.user, filename='notes.txt', content='hello')
+        self.url = reverse('homepage:load_user_data')
+
+    def test_snapshot_and_not_modified(self):
+        """Test the snapshot payload, then 304 until a file changes"""
+        response = self.client.get(self.url)
+        data = response.json()
+        self.assertEqual(data['currentCode'], 'print(1)')
+        self.assertEqual(data['scripts'], {'python_script_util.py': 'x = 1', 'data_file_notes.txt': 'hello'})
+        self.assertEqual(data['notebook_names'], ['analysis'])
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post(reverse('homepage:save_user_data'), json.dumps({'currentCode': 'print(2)'}),
+                         content_type='application/json')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['currentCode'], 'print(2)')
+
+    def test_stale_profile_save_keeps_version(self):
+        """Test saving an old profile instance does not roll back the workspace version"""
+        profile = UserProfile.objects.get(user=self.user)
+        UserFiles.objects.filter(user=self.user).delete()
+        version = UserProfile.objects.get(user=self.user).workspace_version
+        profile.theme = 'cloud'
+        profile.save()
+        self.assertEqual(UserProfile.objects.get(user=self.user).workspace_version, version)
+
+
+class SystemFilesTestCase(TestCase):
+    """
+    Test cases for shared system files in the playground
+    """
+
+    def setUp(self):
+        """Create and log in a user"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='viewer', password='securepassword123')
+        self.client.login(username='viewer', password='securepassword123')
+
+    def test_page_view_does_not_seed_files(self):
+        """Test viewing the playground writes no per-user files"""
+        response = self.client.get(reverse('homepage:python_environment'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(UserFiles.objects.filter(user=self.user).exists())
+        self.assertFalse(PythonCodeSession.objects.filter(user=self.user).exists())
+
+        data = self.client.get(reverse('homepage:get_files')).json()
+        self.assertIn('Hello viewer!', data['text_content'])
+
+    def test_saved_copy_overrides_shared_file(self):
+        """Test a user's own copy of a system file is served instead of the shared one"""
+        UserFiles.objects.create(user=self.user, filename='tester.csv', content='a,b\n1,2', is_system_file=True)
+        data = self.client.get(reverse('homepage:get_files')).json()
+        self.assertEqual(data['csv_content'], 'a,b\n1,2')
+
+
+class NotebookStorageTestCase(TestCase):
+    """
+    Test cases for per-cell notebook storage
+    """
+
+    def setUp(self):
+        """Create and log in a user"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='nbuser', password='securepassword123')
+        self.client.login(username='nbuser', password='securepassword123')
+
+    def _save(self, notebooks):
+        return self.client.post(reverse('homepage:save_user_data'), json.dumps({'notebooks': notebooks}),
+                                content_type='application/json').json()
+
+    def test_only_changed_cells_are_written(self):
+        """Test editing one cell rewrites only that cell"""
+        cells = [{'cell_type': 'code', 'source': f'print({i})', 'outputs': []} for i in range(4)]
+        data = self._save({'analysis': {'cells': cells, 'metadata': {'kernel': 'python'}}})
+        self.assertEqual(data['versions']['notebooks'], {'analysis': 1})
+        before = dict(NotebookCell.objects.values_list('position', 'updated_at'))
+
+        cells[2] = {'cell_type': 'code', 'source': 'print("changed")', 'outputs': ['changed']}
+        data = self._save({'analysis': {'cells': cells[:3], 'metadata': {'kernel': 'python'}}})
+        self.assertEqual(data['versions']['notebooks'], {'analysis': 2})
+        after = dict(NotebookCell.objects.values_list('position', 'updated_at'))
+        self.assertEqual(sorted(after), [0, 1, 2])
+        self.assertEqual(after[0], before[0])
+        self.assertNotEqual(after[2], before[2])
+
+        response = self.client.get(reverse('homepage:get_notebook', args=['analysis'])).json()
+        self.assertEqual(response['notebook'], {'cells': cells[:3], 'metadata': {'kernel': 'python'}})
+
+    def test_single_document_uses_default_name(self):
+        """Test a bare notebook document is stored as the default notebook"""
+        self._save({'cells': [{'source': 'x'}]})
+        notebooks = self.client.get(reverse('homepage:list_notebooks')).json()['notebooks']
+        self.assertEqual([(nb['name'], nb['cell_count']) for nb in notebooks], [('default', 1)])
+
+
+@override_settings(COUNTER_FLUSH_INTERVAL=3600)
+class CounterServiceTestCase(TestCase):
+    """
+    Test cases for hit-log SharedCode counters
+    """
+
+    def setUp(self):
+        """Create a public shared snippet"""
+        cache.clear()
+        self.user = User.objects.create_user(username='sharer', password='securepassword123')
+        self.shared = SharedCode.objects.create(user=self.user, title='Snippet', code_content='print(1)')
+
+    def tearDown(self):
+        """Apply anything left in the hit log"""
+        counters.flush()
+
+    def test_views_are_logged_and_applied_in_one_update(self):
+        """Test page views are logged and applied as one counter update plus one daily bucket upsert"""
+        url = reverse('homepage:view_shared_code', args=[self.shared.share_id])
+        for _ in range(5):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 0)
+        self.assertEqual(CounterHit.objects.count(), 10)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(counters.flush(), 10)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "homepage_sharedcode"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 5)
+        self.assertEqual(self.shared.daily_stats.get(date=timezone.localdate()).views, 5)
+        self.assertFalse(CounterHit.objects.exists())
+
+    def test_failed_flush_keeps_hits(self):
+        """Test a flush that fails rolls back and leaves its hits for the next one"""
+        self.shared.increment_view_count()
+        with mock.patch.object(type(counters), '_flush_buckets', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                counters.flush()
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 0)
+        self.assertEqual(CounterHit.objects.count(), 2)
+
+        out = StringIO()
+        call_command('flush_counters', stdout=out)
+        self.assertIn('Applied 2 counter hit(s)', out.getvalue())
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 1)
+
+    def test_hit_is_one_insert_and_pending_is_in_memory(self):
+        """Test a view costs one INSERT and its pending count needs no query"""
+        with self.assertNumQueries(1):
+            self.shared.increment_view_count()
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.pending(SharedCode, self.shared.pk, 'view_count'), 1)
+        self.assertEqual(self.shared.view_count, 1)
+
+        counters.flush()
+        self.assertEqual(counters.pending(SharedCode, self.shared.pk, 'view_count'), 0)
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 1)
+
+    @override_settings(COUNTER_FLUSH_INTERVAL=0)
+    def test_zero_interval_applies_hits_with_the_request(self):
+        """Test hits skip the log and are applied right away when the flush interval is 0"""
+        self.shared.increment_fork_count()
+        self.shared.increment_fork_count()
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).fork_count, 2)
+        self.assertFalse(CounterHit.objects.exists())
+
+    def test_hits_of_deleted_rows_are_dropped(self):
+        """Test hits for a deleted snippet do not block the rest of the log"""
+        doomed = SharedCode.objects.create(user=self.user, title='Doomed', code_content='x')
+        doomed.increment_view_count()
+        self.shared.increment_view_count()
+        SharedCode.objects.filter(pk=doomed.pk).delete()
+        self.assertEqual(counters.flush(), 4)
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).view_count, 1)
+        self.assertEqual(SharedCodeDailyStats.objects.count(), 1)
+
+    def test_stale_save_keeps_counts(self):
+        """Test saving an old instance does not overwrite flushed counts"""
+        counters.incr(SharedCode, self.shared.pk, 'fork_count', 3)
+        counters.flush()
+        self.shared.title = 'Renamed'
+        self.shared.save()
+        self.assertEqual(SharedCode.objects.get(pk=self.shared.pk).fork_count, 3)
+
+
+class SharedCodePageCacheTestCase(TestCase):
+    """
+    Test cases for cached public shared code pages
+    """
+
+    def setUp(self):
+        """Create a public shared snippet"""
+        cache.clear()
+        self.user = User.objects.create_user(username='author', password='securepassword123')
+        self.shared = SharedCode.objects.create(user=self.user, title='Cached', code_content='x = 1\nprint(x)')
+        self.url = reverse('homepage:view_shared_code', args=[self.shared.share_id])
+
+    def tearDown(self):
+        """Drop buffered view counts"""
+        counters.flush()
+
+    def test_highlighting_is_precomputed(self):
+        """Test highlighted HTML is stored on save and keeps the source text"""
+        self.assertIn('<span', self.shared.highlighted_html)
+        self.assertEqual(strip_tags(self.shared.highlighted_html), 'x = 1\nprint(x)')
+
+    def test_anonymous_views_use_cache_and_etag(self):
+        """Test repeat anonymous views are served from cache and revalidate with 304"""
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first['Cache-Control'])
+        self.assertNotIn('s-maxage', first['Cache-Control'])
+
+        with self.assertTemplateNotUsed('homepage/shared_code.html'):
+            second = self.client.get(self.url)
+        self.assertEqual(second.content.replace(b'2 views', b'1 views'), first.content)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_edits_and_privacy_changes_invalidate(self):
+        """Test saving the snippet changes the ETag and going private hides it"""
+        etag = self.client.get(self.url)['ETag']
+
+        self.shared.code_content = 'print("edited")'
+        self.shared.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'edited')
+
+        self.shared.is_public = False
+        self.shared.save()
+        response = self.client.get(self.url)
+        self.assertTemplateUsed(response, 'homepage/shared_code_private.html')
+
+    def test_cached_page_shows_current_counts(self):
+        """Test the cached page fills in the latest view and fork counts"""
+        self.client.get(self.url)
+        counters.flush()
+        SharedCode.objects.filter(pk=self.shared.pk).update(fork_count=7)
+
+        with self.assertTemplateNotUsed('homepage/shared_code.html'):
+            response = self.client.get(self.url)
+        self.assertContains(response, '2 views', count=2)
+        self.assertContains(response, '7 forks')
+        self.assertNotContains(response, '<!--view_count-->')
+
+    def test_backfill_highlights_existing_snippets(self):
+        """Test the backfill command highlights snippets saved without highlighting"""
+        SharedCode.objects.filter(pk=self.shared.pk).update(highlighted_html='')
+        out = StringIO()
+        call_command('backfill_shared_code_highlighting', stdout=out)
+        self.assertIn('Highlighted 1 shared snippet(s).', out.getvalue())
+
+        self.shared.refresh_from_db()
+        self.assertEqual(strip_tags(self.shared.highlighted_html), 'x = 1\nprint(x)')
+
+
+@override_settings(COUNTER_FLUSH_INTERVAL=3600)
+class SharedCodeRankingTestCase(TestCase):
+    """
+    Test cases for precomputed shared code rankings and the discovery feed
+    """
+
+    def setUp(self):
+        """Create snippets with different all-time and recent activity"""
+        cache.clear()
+        self.user = User.objects.create_user(username='ranker', password='securepassword123')
+        today = timezone.localdate()
+        self.old_hit = SharedCode.objects.create(user=self.user, title='Old hit', code_content='a')
+        self.rising = SharedCode.objects.create(user=self.user, title='Rising', code_content='b')
+        self.hidden = SharedCode.objects.create(user=self.user, title='Hidden', code_content='c', is_public=False)
+        SharedCode.objects.filter(pk=self.old_hit.pk).update(view_count=500)
+        SharedCode.objects.filter(pk=self.rising.pk).update(view_count=40, fork_count=5)
+        SharedCode.objects.filter(pk=self.hidden.pk).update(view_count=9999)
+        SharedCodeDailyStats.objects.create(shared_code=self.old_hit, date=today - timedelta(days=10), views=200)
+        SharedCodeDailyStats.objects.create(shared_code=self.old_hit, date=today - timedelta(days=40), views=300)
+        SharedCodeDailyStats.objects.create(shared_code=self.rising, date=today, views=40, forks=5)
+        SharedCodeDailyStats.objects.create(shared_code=self.hidden, date=today, views=9999)
+
+    def tearDown(self):
+        """Drop buffered counts"""
+        counters.flush()
+
+    def test_refresh_ranks_each_board(self):
+        """Test boards order eligible snippets and old daily stats are pruned"""
+        call_command('refresh_shared_code_rankings', stdout=StringIO())
+
+        def board(name):
+            return list(SharedCodeRanking.objects.filter(board=name).values_list('shared_code_id', flat=True))
+
+        self.assertEqual(board('all_time'), [self.old_hit.pk, self.rising.pk])
+        self.assertEqual(board('weekly'), [self.rising.pk])
+        self.assertEqual(board('trending'), [self.rising.pk, self.old_hit.pk])
+        self.assertFalse(SharedCodeDailyStats.objects.filter(date__lt=timezone.localdate() - timedelta(days=30)).exists())
+
+    def test_all_time_orders_by_score(self):
+        """Test the all-time board ranks by views plus weighted forks, not by views alone"""
+        forked = SharedCode.objects.create(user=self.user, title='Forked', code_content='d')
+        SharedCode.objects.filter(pk=forked.pk).update(view_count=100, fork_count=200)
+
+        self.assertEqual(
+            rankings.all_time_scores(2),
+            [(forked.pk, 100 + rankings.FORK_WEIGHT * 200), (self.old_hit.pk, 500)],
+        )
+
+    def test_feed_pages_by_rank(self):
+        """Test the feed pages through a board and hides snippets made private since the refresh"""
+        call_command('refresh_shared_code_rankings', stdout=StringIO())
+        url = reverse('homepage:shared_code_feed')
+
+        data = self.client.get(url, {'board': 'all_time', 'limit': 1}).json()
+        self.assertEqual([item['title'] for item in data['items']], ['Old hit'])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['items'][0]['url'], reverse('homepage:view_shared_code', args=[self.old_hit.share_id]))
+
+        data = self.client.get(url, {'board': 'all_time', 'after': data['next_after']}).json()
+        self.assertEqual([item['title'] for item in data['items']], ['Rising'])
+        self.assertFalse(data['has_more'])
+
+        SharedCode.objects.filter(pk=self.rising.pk).update(is_public=False)
+        data = self.client.get(url, {'board': 'trending'}).json()
+        self.assertEqual([item['title'] for item in data['items']], ['Old hit'])
+        self.assertEqual(self.client.get(url, {'board': 'nope'}).status_code, 400)
+
+
+@override_settings(COLLAB_FLUSH_INTERVAL=3600)
+class CollabOperationTestCase(TestCase):
+    """
+    Test cases for operational-transform edits in collaborative sessions
+    """
+
+    def setUp(self):
+        """Create a collaborative session with some code"""
+        self.user = User.objects.create_user(username='collab', password='securepassword123')
+        self.session = SharedCode.objects.create(
+            user=self.user, title='Pairing', code_content='', session_type='collaborative',
+            session_state={'code': 'print(1)\n', 'terminal_output': []}
+        )
+
+    def tearDown(self):
+        """Forget the live session"""
+        live_sessions.discard(self.session.share_id)
+
+    def test_transform_converges(self):
+        """Test concurrent inserts and deletes give the same text in either order"""
+        base = 'abcdefgh'
+        cases = [
+            ([insert_op(2, 'X')], [insert_op(2, 'Y')]),
+            ([delete_op(1, 4)], [insert_op(3, 'Z')]),
+            ([delete_op(1, 4)], [delete_op(3, 4)]),
+            (diff_ops(base, 'abXYgh'), diff_ops(base, 'abcdQefgh')),
+        ]
+        for ours, theirs in cases:
+            ours_after, theirs_after = transform(ours, theirs)
+            self.assertEqual(
+                apply_ops(apply_ops(base, theirs), ours_after),
+                apply_ops(apply_ops(base, ours), theirs_after)
+            )
+
+    def test_concurrent_submissions_are_sequenced(self):
+        """Test an edit made against an older base is transformed onto the head"""
+        seq, _ = submit_ops(self.session.share_id, self.user, 0, [insert_op(0, '# a\n')])
+        self.assertEqual(seq, 1)
+        seq, ops = submit_ops(self.session.share_id, self.user, 0, [insert_op(8, '  # b')])
+        self.assertEqual(seq, 2)
+        self.assertEqual(ops, [insert_op(12, '  # b')])
+        self.assertEqual(document_state(self.session), ('# a\nprint(1)  # b\n', 2))
+
+    def test_invalid_and_stale_edits_are_rejected(self):
+        """Test out-of-range ops and bases ahead of the session raise"""
+        with self.assertRaises(InvalidOperation):
+            submit_ops(self.session.share_id, self.user, 0, [delete_op(5, 50)])
+        with self.assertRaises(StaleBaseError):
+            submit_ops(self.session.share_id, self.user, 3, [insert_op(0, 'x')])
+
+    @override_settings(COLLAB_OPLOG_SIZE=3)
+    def test_edits_are_written_behind(self):
+        """Test edits and terminal output stay in memory until one flush writes them"""
+        live_sessions.join(self.session.share_id)
+        with self.assertNumQueries(0):
+            for i in range(7):
+                submit_text(self.session.share_id, self.user, f'print({i + 2})\n')
+                live_sessions.append_terminal_output(self.session.share_id, f'{i + 2}')
+                live_sessions.touch(self.session.share_id)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.session_state['code'], 'print(1)\n')
+
+        with self.assertRaises(StaleBaseError):
+            submit_ops(self.session.share_id, self.user, 1, [insert_op(0, 'x')])
+
+        self.assertEqual(live_sessions.flush(), 1)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.session_state['code'], 'print(8)\n')
+        self.assertEqual(self.session.session_state['seq'], 7)
+        self.assertEqual(len(self.session.session_state['terminal_output']), 7)
+        self.assertEqual(
+            list(CollabOperation.objects.filter(session=self.session).values_list('seq', flat=True)),
+            [5, 6, 7]
+        )
+
+    def test_last_member_leaving_flushes(self):
+        """Test the live state is written and evicted when the last member leaves"""
+        live_sessions.join(self.session.share_id)
+        live_sessions.join(self.session.share_id)
+        submit_text(self.session.share_id, self.user, 'print(2)\n')
+
+        live_sessions.leave(self.session.share_id)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.session_state['code'], 'print(1)\n')
+
+        live_sessions.leave(self.session.share_id)
+        self.assertIsNone(live_sessions.get(self.session.share_id, create=False))
+        self.session.refresh_from_db()
+        self.assertEqual(document_state(self.session), ('print(2)\n', 1))
+
+    def test_catch_up_returns_only_missed_ops(self):
+        """Test a client resuming from a sequence gets just the later ops and terminal lines"""
+        for i in range(3):
+            submit_text(self.session.share_id, self.user, f'print({i + 2})\n')
+            live_sessions.append_terminal_output(self.session.share_id, f'line {i}')
+
+        missed = live_sessions.catch_up(self.session.share_id, 1, terminal_since=2)
+        self.assertEqual([entry['seq'] for entry in missed['ops']], [2, 3])
+        self.assertEqual(missed['terminal_output'], ['line 2'])
+        self.assertEqual(missed['terminal_total'], 3)
+        self.assertIsNone(live_sessions.catch_up(self.session.share_id, 9))
+
+    def test_activity_writes_are_throttled(self):
+        """Test activity alone is written at most once per interval"""
+        live_sessions.join(self.session.share_id)
+        live_sessions.touch(self.session.share_id)
+        self.assertEqual(live_sessions.flush(), 1)
+        for _ in range(5):
+            live_sessions.touch(self.session.share_id)
+            with self.assertNumQueries(0):
+                self.assertEqual(live_sessions.flush(), 0)
+        self.assertEqual(live_sessions.flush(force=True), 1)
+
+
+@override_settings(COLLAB_FLUSH_INTERVAL=3600)
+class CollaborativeConsumerTestCase(TransactionTestCase):
+    """
+    Test cases for the collaborative session WebSocket consumer
+    """
+
+    def setUp(self):
+        """Create a session with a view-only member"""
+        self.owner = User.objects.create_user(username='host', password='securepassword123')
+        self.guest = User.objects.create_user(username='guest', password='securepassword123')
+        self.session = SharedCode.objects.create(
+            user=self.owner, title='Live', code_content='', session_type='collaborative',
+            session_state={'code': 'abc'}
+        )
+        SessionMember.objects.create(session=self.session, user=self.guest, permission='view')
+
+    def tearDown(self):
+        live_sessions.discard(self.session.share_id)
+
+    def test_permission_is_cached_and_invalidated_by_events(self):
+        """Test edit rights come from the connect-time cache and follow permission_changed"""
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/python/code/{self.session.share_id}/'
+            )
+            communicator.scope['user'] = self.guest
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # user_joined, session_state and members_update, in any order
+            messages = [await communicator.receive_json_from() for _ in range(3)]
+            members = next(message for message in messages if message['type'] == 'members_update')
+            self.assertEqual([member['username'] for member in members['members']], ['guest'])
+
+            edit = {'type': 'op', 'base_seq': 0, 'ops': [{'type': 'insert', 'pos': 3, 'text': 'd'}]}
+            await communicator.send_json_to(edit)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+
+            await get_channel_layer().group_send(f'code_session_{self.session.share_id}', {
+                'type': 'permission_changed', 'user_id': str(self.guest.id), 'permission': 'edit',
+            })
+            self.assertEqual((await communicator.receive_json_from())['type'], 'permission_changed')
+            await communicator.send_json_to(edit)
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'ack', 'seq': 1})
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.session_state['code'], 'abcd')
+
+    def test_reconnect_resumes_from_sequence(self):
+        """Test a reconnecting client receives only the ops after its last sequence"""
+        SessionMember.objects.filter(user=self.guest).update(permission='edit')
+        url = f'/ws/python/code/{self.session.share_id}/'
+
+        async def connect(path, user):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            return communicator
+
+        async def run():
+            host = await connect(url, self.owner)
+            for _ in range(3):
+                await host.receive_json_from()
+            for pos, text in enumerate('def'):
+                await host.send_json_to({'type': 'op', 'base_seq': pos, 'ops': [{'type': 'insert', 'pos': 3 + pos, 'text': text}]})
+                await host.receive_json_from()
+
+            guest = await connect(f'{url}?since=1&terminal_since=0', self.guest)
+            messages = [await guest.receive_json_from() for _ in range(3)]
+            await guest.disconnect()
+            await host.disconnect()
+            return messages
+
+        messages = async_to_sync(run)()
+        resume = next(message for message in messages if message['type'] == 'resume')
+        self.assertEqual([entry['seq'] for entry in resume['ops']], [2, 3])
+        self.assertEqual(resume['seq'], 3)
+        self.assertFalse(any(message['type'] == 'session_state' for message in messages))
+
+    def test_edit_after_session_ends(self):
+        """Test an op sent after the owner ends the session closes the socket instead of reloading it"""
+        self.client.force_login(self.owner)
+        end_url = reverse('homepage:end_session', args=[self.session.share_id])
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/python/code/{self.session.share_id}/'
+            )
+            communicator.scope['user'] = self.owner
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            for _ in range(3):
+                await communicator.receive_json_from()
+
+            response = await database_sync_to_async(self.client.post)(end_url)
+            self.assertEqual(response.status_code, 200)
+
+            await communicator.send_json_to({'type': 'op', 'base_seq': 0, 'ops': [{'type': 'insert', 'pos': 0, 'text': 'x'}]})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'removed_from_session')
+            self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+        self.assertIsNone(live_sessions.get(self.session.share_id, create=False))
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.session_state['code'], 'abc')
+
+
+class IDECollaborationTestCase(TestCase):
+    """
+    Test cases for multi-file IDE collaboration, batch saves and collaborator access
+    """
+
+    def setUp(self):
+        """Create an owner with two files, an editor, a viewer and an outsider"""
+        self.client = Client()
+        self.owner = User.objects.create_user(username='ideowner', password='securepassword123')
+        self.editor = User.objects.create_user(username='ideeditor', password='securepassword123')
+        self.viewer = User.objects.create_user(username='ideviewer', password='securepassword123')
+        self.outsider = User.objects.create_user(username='ideoutsider', password='securepassword123')
+        UserProfile.objects.update(paidUser=True)
+        self.project = IDEProject.objects.create(user=self.owner, name='Shared Project')
+        IDEFile.objects.create(project=self.project, name='main.py', path='main.py', content='print(1)\n')
+        IDEFile.objects.create(project=self.project, name='util.py', path='lib/util.py', content='x = 1\n')
+        IDEProjectCollaborator.objects.create(project=self.project, user=self.editor, permission='edit')
+        IDEProjectCollaborator.objects.create(project=self.project, user=self.viewer, permission='view')
+
+    def tearDown(self):
+        ide_documents.leave(self.project.project_id)
+
+    def test_edits_to_several_files_flush_in_one_update(self):
+        """Test concurrent ops are transformed in memory and written with a single bulk UPDATE"""
+        pid = self.project.project_id
+        ide_documents.join(pid)
+        self.assertEqual(ide_documents.open_file(pid, 'main.py'), ('print(1)\n', 0))
+        ide_documents.open_file(pid, 'lib/util.py')
+
+        ide_documents.submit_ops(pid, 'main.py', 0, [insert_op(0, '# a\n')])
+        seq, ops = ide_documents.submit_ops(pid, 'main.py', 0, [delete_op(6, 1), insert_op(6, '2')])
+        self.assertEqual((seq, ops), (2, [delete_op(10, 1), insert_op(10, '2')]))
+        ide_documents.submit_text(pid, 'lib/util.py', 'x = 2\n')
+        self.assertEqual(IDEFile.objects.get(path='main.py').content, 'print(1)\n')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(ide_documents.flush(pid), 2)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries.captured_queries), 1)
+        main = IDEFile.objects.get(path='main.py')
+        self.assertEqual(main.content, '# a\nprint(2)\n')
+        self.assertEqual(main.size, len('# a\nprint(2)\n'))
+        self.assertEqual(IDEFile.objects.get(path='lib/util.py').content, 'x = 2\n')
+        self.assertEqual(ide_documents.flush(pid), 0)
+
+        with self.assertRaises(StaleBaseError):
+            ide_documents.submit_ops(pid, 'main.py', 5, [insert_op(0, 'x')])
+        with self.assertRaises(InvalidOperation):
+            ide_documents.submit_ops(pid, 'missing.py', 0, [insert_op(0, 'x')])
+
+    def test_deleted_file_is_not_recreated_by_flush(self):
+        """Test a flush only updates files that still exist"""
+        pid = self.project.project_id
+        ide_documents.join(pid)
+        ide_documents.open_file(pid, 'main.py')
+        ide_documents.submit_text(pid, 'main.py', 'gone')
+        IDEFile.objects.filter(path='main.py').delete()
+
+        self.assertEqual(ide_documents.flush(pid), 0)
+        self.assertFalse(IDEFile.objects.filter(path='main.py').exists())
+
+    def test_batch_save_and_collaborator_access(self):
+        """Test editors can batch-save, viewers can only read and outsiders see nothing"""
+        files_url = reverse('homepage:ide_get_files', args=[self.project.project_id])
+        save_url = reverse('homepage:ide_save_files', args=[self.project.project_id])
+        payload = json.dumps({'files': [
+            {'path': 'main.py', 'content': 'print(3)\n'},
+            {'path': 'pkg/new.py', 'content': 'y = 1\n'},
+        ]})
+
+        self.client.login(username='ideoutsider', password='securepassword123')
+        self.assertEqual(self.client.get(files_url).status_code, 404)
+        self.assertEqual(self.client.post(save_url, payload, content_type='application/json').status_code, 404)
+        for url in (
+            reverse('homepage:ide_get_project', args=[self.project.project_id]),
+            reverse('homepage:ide_get_file', args=[self.project.project_id, 'main.py']),
+        ):
+            self.assertEqual(self.client.get(url).status_code, 404)
+        save_one = json.dumps({'path': 'main.py', 'content': 'x'})
+        response = self.client.post(
+            reverse('homepage:ide_save_file', args=[self.project.project_id]), save_one, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+        self.client.login(username='ideviewer', password='securepassword123')
+        self.assertEqual(self.client.get(files_url).status_code, 200)
+        self.assertEqual(self.client.post(save_url, payload, content_type='application/json').status_code, 404)
+
+        self.client.login(username='ideeditor', password='securepassword123')
+        response = self.client.post(save_url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], ['pkg/new.py'])
+        self.assertEqual(response.json()['updated'], ['main.py'])
+        new_file = IDEFile.objects.get(project=self.project, path='pkg/new.py')
+        self.assertEqual((new_file.name, new_file.directory.path, new_file.file_type), ('new.py', 'pkg', 'python'))
+        self.assertEqual(IDEFile.objects.get(project=self.project, path='main.py').content, 'print(3)\n')
+
+    def test_owner_invites_and_removes_collaborators(self):
+        """Test only the owner manages collaborators and fixed file routes are not shadowed"""
+        url = reverse('homepage:ide_collaborators', args=[self.project.project_id])
+        invite = json.dumps({'username': 'ideoutsider', 'permission': 'view'})
+
+        self.client.login(username='ideeditor', password='securepassword123')
+        self.assertEqual(self.client.post(url, invite, content_type='application/json').status_code, 403)
+
+        self.client.login(username='ideowner', password='securepassword123')
+        self.assertEqual(self.client.post(url, invite, content_type='application/json').status_code, 200)
+        self.assertEqual(self.project.permission_for(self.outsider), 'view')
+        response = self.client.get(url)
+        self.assertEqual(len(response.json()['collaborators']), 3)
+
+        remove = reverse('homepage:ide_remove_collaborator', args=[self.project.project_id])
+        self.client.post(remove, json.dumps({'user_id': self.outsider.id}), content_type='application/json')
+        self.assertIsNone(self.project.permission_for(self.outsider))
+
+        save = reverse('homepage:ide_save_file', args=[self.project.project_id])
+        response = self.client.post(save, json.dumps({'path': 'main.py', 'content': 'saved'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(IDEFile.objects.get(project=self.project, path='main.py').content, 'saved')
+
+
+class IDECollaborationConsumerTestCase(TransactionTestCase):
+    """
+    Test cases for the IDE collaboration WebSocket consumer
+    """
+
+    def setUp(self):
+        """Create a project shared with an editor and a viewer"""
+        self.owner = User.objects.create_user(username='ideowner', password='securepassword123')
+        self.editor = User.objects.create_user(username='ideeditor', password='securepassword123')
+        self.viewer = User.objects.create_user(username='ideviewer', password='securepassword123')
+        self.project = IDEProject.objects.create(user=self.owner, name='Live Project')
+        IDEFile.objects.create(project=self.project, name='main.py', path='main.py', content='abc')
+        IDEProjectCollaborator.objects.create(project=self.project, user=self.editor, permission='edit')
+        IDEProjectCollaborator.objects.create(project=self.project, user=self.viewer, permission='view')
+
+    def test_concurrent_edits_converge_and_persist(self):
+        """Test two members editing from the same base converge and the last one out writes the file"""
+        url = f'/ws/ide/collaboration/{self.project.project_id}/'
+
+        async def connect(user):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), url)
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'open', 'file_path': 'main.py'})
+            return communicator
+
+        async def receive_until(communicator, kind):
+            while True:
+                message = await communicator.receive_json_from()
+                if message['type'] == kind:
+                    return message
+
+        async def run():
+            owner = await connect(self.owner)
+            self.assertEqual((await receive_until(owner, 'file_state'))['content'], 'abc')
+            editor = await connect(self.editor)
+            self.assertEqual((await receive_until(editor, 'file_state'))['seq'], 0)
+            viewer = await connect(self.viewer)
+            await receive_until(viewer, 'file_state')
+
+            await owner.send_json_to({'type': 'change', 'file_path': 'main.py', 'base_seq': 0,
+                                      'ops': [{'type': 'insert', 'pos': 0, 'text': 'X'}]})
+            await editor.send_json_to({'type': 'change', 'file_path': 'main.py', 'base_seq': 0,
+                                       'ops': [{'type': 'insert', 'pos': 3, 'text': 'Y'}]})
+            await viewer.send_json_to({'type': 'change', 'file_path': 'main.py', 'base_seq': 0,
+                                       'ops': [{'type': 'insert', 'pos': 0, 'text': 'Z'}]})
+            self.assertEqual((await receive_until(viewer, 'error'))['message'], 'You do not have edit permission')
+            self.assertEqual((await receive_until(owner, 'ack'))['seq'], 1)
+            remote = await receive_until(owner, 'code_change')
+            self.assertEqual((remote['seq'], remote['ops']), (2, [{'type': 'insert', 'pos': 4, 'text': 'Y'}]))
+
+            for communicator in (viewer, editor, owner):
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(IDEFile.objects.get(project=self.project, path='main.py').content, 'XabcY')
+        self.assertIsNone(ide_documents.get(self.project.project_id, create=False))
+
+
+class PresenceCoalescerTestCase(TestCase):
+    """
+    Test cases for coalesced presence frames
+    """
+
+    def test_updates_are_coalesced_per_tick(self):
+        """Test a burst of cursor moves becomes one immediate frame plus one frame with the latest positions"""
+        coalescer = PresenceCoalescer()
+        layer = get_channel_layer()
+
+        async def run():
+            channel = await layer.new_channel()
+            await layer.group_add('presence_test', channel)
+            for i in range(20):
+                await coalescer.publish(layer, 'presence_test', 'cursor', 1, position={'row': i})
+                await coalescer.publish(layer, 'presence_test', 'cursor', 2, position={'row': -i})
+            first = (await layer.receive(channel))['message']
+            second = (await layer.receive(channel))['message']
+            await layer.group_discard('presence_test', channel)
+            return first, second
+
+        first, second = async_to_sync(run)()
+        self.assertEqual(first['updates'], [{'kind': 'cursor', 'user_id': 1, 'position': {'row': 0}}])
+        self.assertEqual(second['type'], 'presence')
+        self.assertEqual(
+            sorted((update['user_id'], update['position']['row']) for update in second['updates']),
+            [(1, 19), (2, -19)]
+        )
+
+
+class ChannelLayerConfigTestCase(TestCase):
+    """
+    Test cases for the environment-driven, sharded channel layer configuration
+    """
+
+    def test_backend_follows_environment(self):
+        """Test memory without Redis URLs, plain Redis for one URL and the sharded layer for several"""
+        with mock.patch.dict(os.environ, {'CHANNEL_REDIS_URLS': '', 'REDIS_URL': ''}):
+            self.assertEqual(channel_layers_from_env()['default']['BACKEND'], 'channels.layers.InMemoryChannelLayer')
+        with mock.patch.dict(os.environ, {'CHANNEL_REDIS_URLS': 'redis://a:6379'}):
+            self.assertEqual(channel_layers_from_env()['default']['BACKEND'], 'channels_redis.core.RedisChannelLayer')
+
+        env = {
+            'CHANNEL_REDIS_URLS': 'redis://a:6379, redis://b:6379',
+            'CHANNEL_LAYER_CAPACITY': '500',
+            'CHANNEL_LAYER_EXPIRY': '10',
+            'CHANNEL_LAYER_CHANNEL_CAPACITY': 'http.request=200,websocket.send*=50',
+        }
+        with mock.patch.dict(os.environ, env):
+            layer = channel_layers_from_env()['default']
+        self.assertEqual(layer['BACKEND'], 'mywebsite.channel_layers.ShardedRedisChannelLayer')
+        self.assertEqual(layer['CONFIG']['hosts'], ['redis://a:6379', 'redis://b:6379'])
+        self.assertEqual((layer['CONFIG']['capacity'], layer['CONFIG']['expiry']), (500, 10))
+        self.assertEqual(layer['CONFIG']['channel_capacity'], {'http.request': 200, 'websocket.send*': 50})
+
+        with mock.patch.dict(os.environ, {'CHANNEL_LAYER_BACKEND': 'carrier-pigeon'}):
+            with self.assertRaises(ValueError):
+                channel_layers_from_env()
+
+    def test_ring_is_balanced_and_stable(self):
+        """Test groups spread evenly, a new shard moves few of them and specific channels hash like their prefix"""
+        hosts = [f'redis://shard{n}:6379' for n in range(3)]
+        three = ShardedRedisChannelLayer(hosts=hosts)
+        four = ShardedRedisChannelLayer(hosts=hosts + ['redis://shard3:6379'])
+        groups = [f'code_session_{n}' for n in range(3000)]
+
+        placement = [three.consistent_hash(group) for group in groups]
+        for index in range(3):
+            self.assertGreater(placement.count(index), 700)
+        moved = sum(three.consistent_hash(group) != four.consistent_hash(group) for group in groups)
+        self.assertLess(moved, len(groups) * 0.35)
+        self.assertEqual(three.consistent_hash('specific.abc!def'), three.consistent_hash('specific.abc!'))
+
+    def test_check_command_on_configured_layer(self):
+        """Test the check command round-trips and fans out through the default layer"""
+        out = StringIO()
+        call_command('check_channel_layer', messages=20, stdout=out)
+        self.assertIn('Round trip: 20 message(s)', out.getvalue())
+        self.assertIn('reached 3 channel(s)', out.getvalue())
+
+    def fan_out(self, hosts):
+        """Add channels of two workers' layers to one group, send to it and return what each channel got"""
+        async def run():
+            worker_a = ShardedRedisChannelLayer(hosts=hosts, prefix='test_asgi')
+            worker_b = ShardedRedisChannelLayer(hosts=hosts, prefix='test_asgi')
+            try:
+                channels = [await worker_a.new_channel() for _ in range(2)] + [await worker_b.new_channel()]
+                for name in channels:
+                    await (worker_b if name == channels[-1] else worker_a).group_add('chat_room', name)
+                await worker_b.group_send('chat_room', {'type': 'chat.message', 'text': 'hi'})
+                received = [await worker_a.receive(name) for name in channels[:2]]
+                received.append(await worker_b.receive(channels[-1]))
+                for name in channels:
+                    await worker_a.group_discard('chat_room', name)
+                return received
+            finally:
+                await worker_a.close_pools()
+                await worker_b.close_pools()
+
+        return [message['text'] for message in async_to_sync(run)()]
+
+    @unittest.skipUnless(fakeredis, 'install requirements-dev.txt to run the sharded layer against fakeredis')
+    def test_fan_out_across_workers_on_fake_redis(self):
+        """Test group messages cross workers and keys land on the shard the ring picks, on in-process Redis"""
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+        hosts = [
+            {'address': f'redis://shard{n}:6379', 'connection_class': FakeAsyncConnection, 'server': server}
+            for n, server in enumerate(servers)
+        ]
+        self.assertEqual(self.fan_out(hosts), ['hi', 'hi', 'hi'])
+
+        # A group is stored only on the shard the ring picks for it
+        layer = ShardedRedisChannelLayer(hosts=hosts, prefix='test_asgi')
+
+        async def add():
+            await layer.group_add('chat_room', 'specific.abc!def')
+            await layer.close_pools()
+
+        async_to_sync(add)()
+        key = layer._group_key('chat_room')
+        self.assertEqual(
+            [fakeredis.FakeStrictRedis(server=server).exists(key) for server in servers],
+            [int(index == layer.consistent_hash('chat_room')) for index in range(3)]
+        )
+
+    @unittest.skipUnless(os.getenv('CHANNEL_LAYER_TEST_REDIS_URLS'),
+                         'set CHANNEL_LAYER_TEST_REDIS_URLS to local Redis servers, e.g. redis://localhost:6380')
+    def test_fan_out_across_workers_on_redis(self):
+        """Test a group message sent by one worker's layer reaches channels of another"""
+        hosts = os.environ['CHANNEL_LAYER_TEST_REDIS_URLS'].split(',')
+        out = StringIO()
+        call_command('check_channel_layer', urls=','.join(hosts), stdout=out)
+        self.assertIn('Round trip', out.getvalue())
+        self.assertEqual(self.fan_out(hosts), ['hi', 'hi', 'hi'])
+
+
+class WireProtocolTestCase(TransactionTestCase):
+    """
+    Test cases for the negotiated binary WebSocket wire protocol
+    """
+
+    def test_encode_decode_round_trip(self):
+        """Test field codes shrink frames, large bodies are compressed and both survive a round trip"""
+        message = {'type': 'code_op', 'seq': 4, 'user_id': 7, 'username': 'host', 'client_id': 'abc',
+                   'ops': [{'type': 'insert', 'pos': 3, 'text': 'x'}], 'custom': {'nested': True}}
+        frame = wire.encode(message)
+        self.assertEqual(frame[0], 0)
+        self.assertLess(len(frame), len(json.dumps(message)) / 2)
+        self.assertEqual(wire.decode(frame), message)
+
+        snapshot = {'type': 'session_state', 'state': {'code': 'print("hello")\n' * 500, 'seq': 1}}
+        frame = wire.encode(snapshot)
+        self.assertEqual(frame[0] & wire.COMPRESSED, wire.COMPRESSED)
+        self.assertLess(len(frame), 1024)
+        self.assertEqual(wire.decode(frame), snapshot)
+
+        for bad in (b'', b'\x01not zlib', b'\x00' + wire.msgpack.packb([1, 2])):
+            with self.assertRaises(wire.WireDecodeError):
+                wire.decode(bad)
+
+    def test_session_page_gets_every_field_code(self):
+        """Test the client's field table is rendered from FIELD_CODES, so new codes reach it"""
+        owner = User.objects.create_user(username='wirepage', password='securepassword123')
+        session = SharedCode.objects.create(user=owner, title='Fields', code_content='', session_type='collaborative')
+        self.client.force_login(owner)
+        try:
+            response = self.client.get(reverse('homepage:join_collaborative_session', args=[session.share_id]))
+        finally:
+            live_sessions.discard(session.share_id)
+        fields = response.context['wire_fields']
+        self.assertEqual({name: code for code, name in enumerate(fields)}, wire.FIELD_CODES)
+        self.assertContains(response, '<script id="wire-fields" type="application/json">')
+        self.assertIn('"channel_id"', response.content.decode())
+
+    def test_group_frames_encode_lazily_per_protocol(self):
+        """Test a group frame carries the message once and each protocol in use is encoded once"""
+        class Member(wire.WireProtocolMixin):
+            def __init__(self, binary):
+                self.binary_protocol = binary
+                self.sent = []
+
+            async def send(self, text_data=None, bytes_data=None):
+                self.sent.append(bytes_data if text_data is None else text_data)
+
+        message = {'type': 'presence', 'updates': [{'kind': 'cursor', 'user_id': 1}]}
+        event = wire.encode_frame(message)
+        self.assertEqual(set(event), {'frame_id', 'message'})
+
+        async def relay(members):
+            for member in members:
+                await member.send_frame(event)
+
+        text_only = [Member(False), Member(False)]
+        with mock.patch.object(wire, 'encode', wraps=wire.encode) as encode:
+            async_to_sync(relay)(text_only)
+            self.assertEqual(encode.call_count, 0)
+            mixed = [Member(True), Member(True), Member(False)]
+            async_to_sync(relay)(mixed)
+            self.assertEqual(encode.call_count, 1)
+        self.assertEqual([wire.decode(frame) for frame in mixed[0].sent + mixed[1].sent], [message, message])
+        self.assertEqual([json.loads(member.sent[0]) for member in text_only + mixed[2:]], [message] * 3)
+
+    def test_negotiated_binary_socket(self):
+        """Test a client offering the msgpack subprotocol gets binary frames and may send them"""
+        owner = User.objects.create_user(username='wirehost', password='securepassword123')
+        session = SharedCode.objects.create(user=owner, title='Wire', code_content='', session_type='collaborative',
+                                            session_state={'code': 'abc'})
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/python/code/{session.share_id}/',
+                subprotocols=[wire.MSGPACK_PROTOCOL, wire.JSON_PROTOCOL]
+            )
+            communicator.scope['user'] = owner
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, wire.MSGPACK_PROTOCOL)
+            messages = [wire.decode(await communicator.receive_from()) for _ in range(3)]
+
+            await communicator.send_to(bytes_data=wire.encode(
+                {'type': 'op', 'base_seq': 0, 'ops': [{'type': 'insert', 'pos': 3, 'text': 'd'}]}
+            ))
+            ack = wire.decode(await communicator.receive_from())
+            await communicator.disconnect()
+            return messages, ack
+
+        try:
+            messages, ack = async_to_sync(run)()
+        finally:
+            live_sessions.discard(session.share_id)
+        state = next(message for message in messages if message['type'] == 'session_state')
+        self.assertEqual(state['state']['code'], 'abc')
+        self.assertEqual(ack, {'type': 'ack', 'seq': 1})
+
+
+class WebSocketBenchmarkTestCase(TransactionTestCase):
+    """
+    Test cases for the in-process WebSocket benchmark harness
+    """
+
+    def test_scenarios_deliver_to_every_other_client(self):
+        """Test each scenario fans every tracked message out to all other clients and reports metrics"""
+        for name in ('chat', 'collab', 'terminal'):
+            with self.subTest(scenario=name):
+                result = run_scenario(SCENARIOS[name](), clients=4, rounds=3, senders=2, noise_per_round=2, seed=1)
+                self.assertEqual(result['messages'], 6)
+                self.assertEqual(result['deliveries'], 18)
+                self.assertEqual(result['lost'], 0)
+                self.assertIsNotNone(result['p99_ms'])
+                self.assertGreater(result['frames_per_sec'], 0)
+        self.assertGreater(SharedCode.objects.get(title='Benchmark').session_state['seq'], 0)
+
+    def test_baseline_regressions_fail_the_command(self):
+        """Test a result worse than the baseline beyond the tolerance raises CommandError"""
+        from django.core.management.base import CommandError
+        from homepage.management.commands.ws_benchmark import Command
+        import tempfile
+
+        result = {'scenario': 'chat', 'lost': 0, 'p99_ms': 10.0, 'queries_per_message': 6.0, 'frames_per_sec': 1000.0}
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'results': [dict(result, queries_per_message=4.0)]}, f)
+        self.addCleanup(os.remove, f.name)
+
+        command = Command(stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, 'queries_per_message 4.0 -> 6.0'):
+            command.compare([result], f.name, tolerance=0.25)
+        command.compare([dict(result, queries_per_message=4.5)], f.name, tolerance=0.25)
+
+
+class ChannelMessagePaginationTestCase(TestCase):
+    """
+    Test cases for keyset pagination of channel messages and their aggregated reactions
+    """
+
+    def setUp(self):
+        """Create a channel with 30 messages, the last ten sharing one timestamp"""
+        self.client = Client()
+        self.user = User.objects.create_user(username='chanreader', password='securepassword123')
+        self.other = User.objects.create_user(username='chanwriter', password='securepassword123')
+        self.server = Server.objects.create(name='Paging', owner=self.user)
+        ServerMember.objects.create(server=self.server, user=self.user, role='owner')
+        ServerMember.objects.create(server=self.server, user=self.other)
+        self.channel = ServerChannel.objects.create(server=self.server, name='general')
+        ServerMessage.objects.bulk_create([
+            ServerMessage(channel=self.channel, sender=self.other, content=f'message {n}') for n in range(30)
+        ])
+        self.messages = list(ServerMessage.objects.filter(channel=self.channel).order_by('id'))
+        start = timezone.now() - timedelta(hours=1)
+        for n, message in enumerate(self.messages):
+            message.timestamp = start + timedelta(minutes=min(n, 20))
+        ServerMessage.objects.bulk_update(self.messages, ['timestamp'])
+        self.client.login(username='chanreader', password='securepassword123')
+        self.url = reverse('homepage:get_channel_messages', args=[self.channel.channel_id])
+
+    def contents(self, response):
+        return [message['content'] for message in response.json()['messages']]
+
+    def test_newest_page_and_paging_back(self):
+        """Test the default page is the newest, in chronological order, and cursors walk through ties"""
+        response = self.client.get(self.url, {'limit': 8})
+        data = response.json()
+        self.assertEqual(self.contents(response), [f'message {n}' for n in range(22, 30)])
+        self.assertTrue(data['has_older'])
+        self.assertFalse(data['has_newer'])
+        self.assertIsNone(data['newer_cursor'])
+
+        seen = self.contents(response)
+        while data['has_older']:
+            response = self.client.get(self.url, {'limit': 8, 'before': data['older_cursor']})
+            data = response.json()
+            seen = self.contents(response) + seen
+        self.assertEqual(seen, [f'message {n}' for n in range(30)])
+
+        response = self.client.get(self.url, {'limit': 8, 'after': data['newer_cursor']})
+        self.assertEqual(self.contents(response), [f'message {n}' for n in range(6, 14)])
+        self.assertTrue(response.json()['has_newer'])
+
+    def test_around_centres_on_message(self):
+        """Test ?around returns the anchor with older and newer neighbours"""
+        anchor = self.messages[24]
+        response = self.client.get(self.url, {'limit': 6, 'around': str(anchor.message_id)})
+        data = response.json()
+        self.assertEqual(self.contents(response), [f'message {n}' for n in range(22, 28)])
+        self.assertTrue(data['has_older'])
+        self.assertTrue(data['has_newer'])
+
+        response = self.client.get(self.url, {'around': str(self.messages[0].message_id)})
+        self.assertEqual(self.contents(response)[0], 'message 0')
+        self.assertFalse(response.json()['has_older'])
+
+        for params in ({'around': 'not-a-uuid'}, {'limit': 'ten'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(response.json()['success'])
+
+    def test_reactions_are_aggregated(self):
+        """Test reactions come back as one entry per emoji with counts and the caller's own"""
+        message = self.messages[-1]
+        ServerMessageReaction.objects.create(message=message, user=self.other, emoji='👍')
+        ServerMessageReaction.objects.create(message=message, user=self.user, emoji='👍')
+        ServerMessageReaction.objects.create(message=message, user=self.other, emoji='🎉')
+        response = self.client.get(self.url, {'limit': 1})
+        self.assertEqual(response.json()['messages'][0]['reactions'], [
+            {'emoji': '👍', 'count': 2, 'me': True},
+            {'emoji': '🎉', 'count': 1, 'me': False},
+        ])
+
+    def test_query_count_is_constant(self):
+        """Test the number of queries does not grow with page size, replies or reactions"""
+        self.client.get(self.url, {'limit': 2})
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, {'limit': 2})
+
+        for n, message in enumerate(self.messages):
+            message.reply_to = self.messages[0] if n else None
+        ServerMessage.objects.bulk_update(self.messages, ['reply_to'])
+        ServerMessageReaction.objects.bulk_create([
+            ServerMessageReaction(message=message, user=user, emoji=emoji)
+            for message in self.messages for user in (self.user, self.other) for emoji in '👍🎉'
+        ])
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url, {'limit': 30})
+        self.assertEqual(len(response.json()['messages']), 30)
+        self.assertEqual(len(large.captured_queries), len(small.captured_queries))
+
+    def test_invalid_cursor_and_non_member(self):
+        """Test a malformed cursor is a 400 and non-members are refused"""
+        self.assertEqual(self.client.get(self.url, {'before': 'not-a-cursor'}).status_code, 400)
+        User.objects.create_user(username='chanoutsider', password='securepassword123')
+        self.client.login(username='chanoutsider', password='securepassword123')
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class ReadStateTestCase(TestCase):
+    """
+    Test cases for unread and mention badges of channels and DMs
+    """
+
+    def setUp(self):
+        """Create a server with two channels, an owner and two members"""
+        self.client = Client()
+        self.owner = User.objects.create_user(username='badgeowner', password='securepassword123')
+        self.alice = User.objects.create_user(username='alice', password='securepassword123')
+        self.bob = User.objects.create_user(username='bob', password='securepassword123')
+        self.server = Server.objects.create(name='Badges', owner=self.owner)
+        self.general = ServerChannel.objects.create(server=self.server, name='general')
+        for user, role in ((self.owner, 'owner'), (self.alice, 'member'), (self.bob, 'member')):
+            ServerMember.objects.create(server=self.server, user=user, role=role)
+        self.random = ServerChannel.objects.create(server=self.server, name='random')
+
+    def state(self, user, channel):
+        return ReadState.objects.get(user=user, channel=channel)
+
+    def post(self, sender, content, channel=None):
+        return ServerMessage.objects.create(channel=channel or self.general, sender=sender, content=content)
+
+    def test_members_get_a_state_per_channel(self):
+        """Test joining a server and creating a channel both create caught-up states"""
+        self.assertEqual(ReadState.objects.filter(channel__isnull=False).count(), 6)
+        self.assertEqual(self.state(self.alice, self.random).unread_count, 0)
+        ServerMember.objects.filter(user=self.bob).delete()
+        self.assertFalse(ReadState.objects.filter(user=self.bob).exists())
+
+    def test_messages_count_unread_and_mentions(self):
+        """Test each message is unread for everyone but its sender and mentions are counted"""
+        self.post(self.alice, 'hello')
+        with CaptureQueriesContext(connection) as queries:
+            self.post(self.alice, 'hey @bob, and @nobody.')
+        self.assertEqual(sum('homepage_readstate' in query['sql'] for query in queries.captured_queries), 1)
+        self.assertEqual(self.state(self.alice, self.general).unread_count, 0)
+        self.assertEqual(self.state(self.bob, self.general).unread_count, 2)
+        self.assertEqual(self.state(self.bob, self.general).mention_count, 1)
+        self.assertEqual(self.state(self.owner, self.general).mention_count, 0)
+
+        # @everyone only counts from owners and admins
+        self.post(self.alice, '@everyone look')
+        self.assertEqual(self.state(self.owner, self.general).mention_count, 0)
+        self.post(self.owner, '@everyone look')
+        self.assertEqual(self.state(self.alice, self.general).mention_count, 1)
+        self.assertEqual(self.state(self.bob, self.general).mention_count, 2)
+
+    def test_badges_in_one_query(self):
+        """Test the badges endpoint returns channel, server and DM badges with a single query"""
+        self.post(self.alice, 'one')
+        self.post(self.alice, '@badgeowner two', channel=self.random)
+        Friendship.objects.create(from_user=self.alice, to_user=self.owner, status='accepted')
+        DirectMessage.objects.create(sender=self.alice, recipient=self.owner, message='psst')
+        self.client.login(username='badgeowner', password='securepassword123')
+
+        response = self.client.get(reverse('homepage:get_unread_badges'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('homepage:get_unread_badges'))
+        data = response.json()
+        self.assertEqual(sum('homepage_readstate' in query['sql'] for query in queries.captured_queries), 1)
+        self.assertEqual(sorted((c['unread'], c['mentions']) for c in data['channels']), [(1, 0), (1, 1)])
+        self.assertEqual(data['servers'], [{'server_id': str(self.server.server_id), 'unread': 2, 'mentions': 1}])
+        self.assertEqual(data['direct_messages'], [{'user_id': self.alice.id, 'unread': 1}])
+
+    def test_ack_channel(self):
+        """Test acking a message recounts what follows it and acking the channel clears it"""
+        first = self.post(self.alice, 'one')
+        self.post(self.alice, '@bob two')
+        self.post(self.alice, 'three')
+        self.client.login(username='bob', password='securepassword123')
+        url = reverse('homepage:ack_channel', args=[self.general.channel_id])
+
+        response = self.client.post(url, json.dumps({'message_id': str(first.message_id)}), content_type='application/json')
+        self.assertEqual(response.json(), {'success': True, 'unread': 2, 'mentions': 1})
+        response = self.client.post(url)
+        self.assertEqual(response.json(), {'success': True, 'unread': 0, 'mentions': 0})
+        # Markers do not move backwards
+        response = self.client.post(url, json.dumps({'message_id': str(first.message_id)}), content_type='application/json')
+        self.assertEqual(response.json()['unread'], 0)
+
+        outsider = User.objects.create_user(username='outsider', password='securepassword123')
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.post(url).status_code, 403)
+
+    def test_ack_recount_matches_live_mentions(self):
+        """Test the recount after an ack counts mentions exactly as arriving messages do"""
+        bobby = User.objects.create_user(username='bobby', password='securepassword123')
+        ServerMember.objects.create(server=self.server, user=bobby, role='member')
+        first = self.post(self.alice, 'one')
+        self.post(self.alice, 'hi @bobby')
+        self.post(self.alice, '@everyone from a member')
+        self.post(self.owner, '@here from the owner')
+        live = self.state(self.bob, self.general)
+        self.assertEqual((live.unread_count, live.mention_count), (4, 1))
+
+        ReadState.objects.filter(pk=live.pk).update(unread_count=99, mention_count=99)
+        state = read_states.ack_channel(self.bob, self.general, first)
+        self.assertEqual((state.unread_count, state.mention_count), (3, 1))
+
+    def test_ack_recounts_when_a_message_arrives_meanwhile(self):
+        """Test a message counted while an ack recounts is not wiped out by the ack"""
+        first = self.post(self.alice, 'one')
+        self.post(self.alice, 'two')
+        recount = read_states._unread_after
+
+        def recount_with_new_message(*args):
+            counts = recount(*args)
+            if not ServerMessage.objects.filter(content='late').exists():
+                self.post(self.alice, 'late')
+            return counts
+
+        with mock.patch.object(read_states, '_unread_after', side_effect=recount_with_new_message):
+            state = read_states.ack_channel(self.bob, self.general, first)
+        self.assertEqual(state.unread_count, 2)
+        self.assertEqual(self.state(self.bob, self.general).unread_count, 2)
+
+    def test_direct_messages_are_acked_when_read(self):
+        """Test reading a conversation clears its badge and only writes when something was unread"""
+        Friendship.objects.create(from_user=self.alice, to_user=self.bob, status='accepted')
+        self.client.login(username='alice', password='securepassword123')
+        for text in ('hi', 'there'):
+            self.client.post(reverse('homepage:send_direct_message'),
+                             json.dumps({'recipient_id': self.bob.id, 'message': text}), content_type='application/json')
+        self.assertEqual(ReadState.objects.get(user=self.bob, peer=self.alice).unread_count, 2)
+
+        self.client.login(username='bob', password='securepassword123')
+        self.client.get(reverse('homepage:get_direct_messages', args=[self.alice.id]))
+        self.assertEqual(ReadState.objects.get(user=self.bob, peer=self.alice).unread_count, 0)
+        self.assertFalse(DirectMessage.objects.filter(is_read=False).exists())
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('homepage:get_direct_messages', args=[self.alice.id]))
+        self.assertFalse(any(query['sql'].startswith('UPDATE "homepage_') for query in queries.captured_queries))
+
+        # DMs shown as they arrive over the gateway are acked without refetching the conversation
+        DirectMessage.objects.create(sender=self.alice, recipient=self.bob, message='pushed')
+        response = self.client.post(reverse('homepage:ack_direct_messages', args=[self.alice.id]))
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(ReadState.objects.get(user=self.bob, peer=self.alice).unread_count, 0)
+
+    def test_backfill_command(self):
+        """Test backfill creates missing channel states and counts unread DMs"""
+        ReadState.objects.all().delete()
+        DirectMessage.objects.bulk_create([
+            DirectMessage(sender=self.alice, recipient=self.bob, message='old'),
+            DirectMessage(sender=self.alice, recipient=self.bob, message='older'),
+        ])
+        call_command('backfill_read_states', stdout=StringIO())
+        self.assertEqual(ReadState.objects.filter(channel__isnull=False).count(), 6)
+        self.assertEqual(ReadState.objects.get(user=self.bob, peer=self.alice).unread_count, 2)
+        call_command('backfill_read_states', stdout=StringIO())
+        self.assertEqual(ReadState.objects.count(), 7)
+
+
+class MessageSearchTestCase(TestCase):
+    """
+    Test cases for full-text search over server and direct messages
+    """
+
+    def setUp(self):
+        """Create a server with two channels and a few messages, plus a DM"""
+        self.client = Client()
+        self.alice = User.objects.create_user(username='searchalice', password='securepassword123')
+        self.bob = User.objects.create_user(username='searchbob', password='securepassword123')
+        self.outsider = User.objects.create_user(username='searchout', password='securepassword123')
+        self.server = Server.objects.create(name='Search', owner=self.alice)
+        ServerMember.objects.create(server=self.server, user=self.alice, role='owner')
+        ServerMember.objects.create(server=self.server, user=self.bob)
+        self.general = ServerChannel.objects.create(server=self.server, name='general')
+        self.help = ServerChannel.objects.create(server=self.server, name='help')
+        ServerMessage.objects.create(channel=self.general, sender=self.alice, content='The tests keep running forever')
+        ServerMessage.objects.create(channel=self.help, sender=self.bob, content='How do I run tests? <b>help</b>')
+        ServerMessage.objects.create(channel=self.general, sender=self.bob, content='Lunch at noon')
+        DirectMessage.objects.create(sender=self.alice, recipient=self.bob, message='secret test plan')
+
+    def contents(self, user, query, **filters):
+        return [result['snippet'] for result in search_messages(user, query, **filters)]
+
+    def test_messages_are_indexed_and_ranked(self):
+        """Test new messages are searchable with stemming and highlighted, escaped snippets"""
+        if connection.vendor == 'sqlite':
+            self.assertIsInstance(get_backend(), SQLiteFTSBackend)
+        self.assertEqual(MessageSearchDocument.objects.count(), 4)
+        results = search_messages(self.bob, 'run tests')
+        self.assertEqual(len(results), 2)
+        self.assertEqual({result['kind'] for result in results}, {'server'})
+        snippets = ' '.join(result['snippet'] for result in results)
+        self.assertIn('<mark>running</mark>', snippets)
+        self.assertIn('&lt;b&gt;help&lt;/b&gt;', snippets)
+        self.assertNotIn('<b>', snippets)
+
+        self.assertEqual(len(search_messages(self.bob, 'test')), 3)
+        self.assertEqual(search_messages(self.bob, 'lunch')[0]['channel']['name'], 'general')
+
+    def test_visibility_and_filters(self):
+        """Test users only find messages of their servers and their own DMs, narrowed by filters"""
+        self.assertEqual(search_messages(self.outsider, 'test'), [])
+        self.assertEqual(len(search_messages(self.outsider, 'test', channel=self.help)), 0)
+        dm = search_messages(self.alice, 'plan')
+        self.assertEqual([(result['kind'], result['recipient_id']) for result in dm], [('direct', self.bob.id)])
+
+        self.assertEqual(len(search_messages(self.bob, 'test', channel=self.help)), 1)
+        self.assertEqual(len(search_messages(self.bob, 'test', sender=self.alice.id)), 2)
+        self.assertEqual(len(search_messages(self.bob, 'test', kind='server')), 2)
+        self.assertEqual(search_messages(self.bob, 'test', since=timezone.now() + timedelta(minutes=1)), [])
+
+    def test_query_syntax_is_literal(self):
+        """Test FTS operators in user input do not break the query"""
+        self.assertEqual(len(search_messages(self.bob, 'tests: ("run')), 2)
+        self.assertEqual(search_messages(self.bob, '*** ---'), [])
+        self.assertEqual(len(search_messages(self.bob, 'lun*')), 1)
+
+    def test_edits_and_deletes_update_the_index(self):
+        """Test edited text is reindexed and deleted messages disappear"""
+        message = ServerMessage.objects.get(content='Lunch at noon')
+        message.content = 'Dinner at eight'
+        message.save()
+        self.assertEqual(search_messages(self.bob, 'lunch'), [])
+        self.assertEqual(len(search_messages(self.bob, 'dinner')), 1)
+        message.delete()
+        self.assertEqual(search_messages(self.bob, 'dinner'), [])
+
+    def test_backfill_command(self):
+        """Test backfill indexes messages that have no document, in batches"""
+        MessageSearchDocument.objects.all().delete()
+        self.assertEqual(search_messages(self.bob, 'test'), [])
+        out = StringIO()
+        call_command('backfill_message_search', batch_size=2, stdout=out)
+        self.assertIn('Indexed 3 server message(s).', out.getvalue())
+        self.assertIn('Indexed 1 direct message(s).', out.getvalue())
+        self.assertEqual(len(search_messages(self.bob, 'test')), 3)
+        call_command('backfill_message_search', stdout=StringIO())
+        self.assertEqual(MessageSearchDocument.objects.count(), 4)
+
+    def test_search_endpoint(self):
+        """Test the search endpoint validates input and returns results"""
+        self.client.login(username='searchbob', password='securepassword123')
+        url = reverse('homepage:search_messages')
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'q': 'test', 'since': 'yesterday'}).status_code, 400)
+        response = self.client.get(url, {'q': 'tests', 'server': str(self.server.server_id), 'since': '2000-01-01'})
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertIsNone(data['next_offset'])
+
+
+class GatewayConsumerTestCase(TransactionTestCase):
+    """
+    Test cases for the per-user gateway WebSocket
+    """
+
+    def setUp(self):
+        """Create two friends sharing a server, and a second server"""
+        cache.clear()
+        self.alice = User.objects.create_user(username='gwalice', password='securepassword123')
+        self.bob = User.objects.create_user(username='gwbob', password='securepassword123')
+        self.server = Server.objects.create(name='Gateway', owner=self.alice, invite_code='GATEWAY1')
+        ServerMember.objects.create(server=self.server, user=self.alice, role='owner')
+        ServerMember.objects.create(server=self.server, user=self.bob)
+        self.channel = ServerChannel.objects.create(server=self.server, name='general')
+        self.other_server = Server.objects.create(name='Elsewhere', owner=self.bob, invite_code='GATEWAY2')
+        ServerMember.objects.create(server=self.other_server, user=self.bob, role='owner')
+        self.other_channel = ServerChannel.objects.create(server=self.other_server, name='lobby')
+        Friendship.objects.create(from_user=self.alice, to_user=self.bob, status='accepted')
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/gateway/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_until(self, communicator, kind, event=None):
+        while True:
+            message = await communicator.receive_json_from()
+            if message['type'] == kind and (event is None or message.get('event') == event):
+                return message
+
+    def test_identify_and_dispatch(self):
+        """Test one socket gets the ready state and then messages, DMs and membership changes"""
+        async def run():
+            alice = await self.connect(self.alice)
+            await alice.send_json_to({'type': 'identify'})
+            ready = await self.receive_until(alice, 'ready')
+            self.assertEqual([server['name'] for server in ready['servers']], ['Gateway'])
+            self.assertEqual(ready['servers'][0]['channels'][0]['channel_id'], str(self.channel.channel_id))
+            self.assertEqual(ready['friends'], [{'id': self.bob.id, 'is_online': False}])
+
+            await database_sync_to_async(ServerMessage.objects.create)(channel=self.channel, sender=self.bob, content='hi all')
+            message = await self.receive_until(alice, 'dispatch', 'message_create')
+            self.assertEqual(message['seq'], 1)
+            self.assertEqual(message['data']['channel_id'], str(self.channel.channel_id))
+            self.assertEqual(message['data']['message']['content'], 'hi all')
+            # Pushed messages carry everything the client needs to render them
+            self.assertEqual(message['data']['message']['sender']['username'], 'gwbob')
+            self.assertIn('profile_picture', message['data']['message']['sender'])
+
+            await database_sync_to_async(DirectMessage.objects.create)(sender=self.bob, recipient=self.alice, message='psst')
+            dm = await self.receive_until(alice, 'dispatch', 'dm_create')
+            self.assertEqual((dm['seq'], dm['data']['message']['message']), (2, 'psst'))
+
+            # Joining a server subscribes the open socket to it
+            await database_sync_to_async(ServerMember.objects.create)(server=self.other_server, user=self.alice)
+            self.assertEqual((await self.receive_until(alice, 'dispatch', 'server_join'))['data']['server_id'],
+                             str(self.other_server.server_id))
+            await database_sync_to_async(ServerMessage.objects.create)(channel=self.other_channel, sender=self.bob, content='welcome')
+            message = await self.receive_until(alice, 'dispatch', 'message_create')
+            self.assertEqual(message['data']['message']['content'], 'welcome')
+
+            await alice.send_json_to({'type': 'typing', 'channel_id': str(self.other_channel.channel_id)})
+            await alice.send_json_to({'type': 'typing', 'channel_id': str(uuid.uuid4())})
+            self.assertEqual((await self.receive_until(alice, 'error'))['message'], 'Unknown channel')
+            await alice.send_json_to({'type': 'heartbeat'})
+            self.assertEqual((await self.receive_until(alice, 'heartbeat_ack'))['seq'], 4)
+            await alice.disconnect()
+
+        async_to_sync(run)()
+        self.assertFalse(UserStatus.objects.get(user=self.alice).is_online)
+
+    def test_resume_replays_missed_events(self):
+        """Test a resumed session gets unseen dispatches and messages written while away"""
+        async def run():
+            alice = await self.connect(self.alice)
+            await alice.send_json_to({'type': 'identify'})
+            session_id = (await self.receive_until(alice, 'ready'))['session_id']
+            await database_sync_to_async(ServerMessage.objects.create)(channel=self.channel, sender=self.bob, content='one')
+            await self.receive_until(alice, 'dispatch', 'message_create')
+            await database_sync_to_async(ServerMessage.objects.create)(channel=self.channel, sender=self.bob, content='two')
+            await self.receive_until(alice, 'dispatch', 'message_create')
+            await alice.disconnect()
+
+            # Sessions are kept in the database, so any worker can resume them
+            await database_sync_to_async(cache.clear)()
+            await database_sync_to_async(DirectMessage.objects.create)(sender=self.bob, recipient=self.alice, message='while away')
+
+            # Another user cannot resume the session, nor use it up
+            bob = await self.connect(self.bob)
+            await bob.send_json_to({'type': 'resume', 'session_id': session_id, 'seq': 1})
+            await self.receive_until(bob, 'invalid_session')
+            await bob.send_json_to({'type': 'typing', 'channel_id': str(self.channel.channel_id)})
+            self.assertEqual((await self.receive_until(bob, 'error'))['message'], 'Identify first')
+            await bob.disconnect()
+
+            alice = await self.connect(self.alice)
+            await alice.send_json_to({'type': 'resume', 'session_id': session_id, 'seq': 1})
+            replayed = []
+            while True:
+                message = await alice.receive_json_from()
+                if message['type'] == 'resumed':
+                    break
+                replayed.append((message['seq'], message['event']))
+            self.assertEqual(replayed, [(2, 'message_create'), (3, 'dm_create')])
+            self.assertEqual(message['seq'], 3)
+            self.assertEqual(message['heartbeat_interval'], 40)
+
+            # Sessions resume once
+            second = await self.connect(self.alice)
+            await second.send_json_to({'type': 'resume', 'session_id': session_id, 'seq': 3})
+            await self.receive_until(second, 'invalid_session')
+            await second.disconnect()
+            await alice.disconnect()
+
+        async_to_sync(run)()
+
+    def test_online_while_any_connection_is_live(self):
+        """Test status follows live connections, and connections of a crashed worker expire"""
+        def is_online():
+            return UserStatus.objects.get(user=self.alice).is_online
+
+        def worker_dies():
+            # The worker holding the socket stops without disconnecting it
+            GatewayConnection.objects.filter(user=self.alice).update(expires_at=timezone.now())
+            out = StringIO()
+            call_command('expire_gateway_state', stdout=out)
+            return out.getvalue()
+
+        async def run():
+            first = await self.connect(self.alice)
+            await first.send_json_to({'type': 'identify'})
+            ready = await self.receive_until(first, 'ready')
+            self.assertEqual(ready['heartbeat_interval'], 40)
+            second = await self.connect(self.alice)
+            await second.send_json_to({'type': 'identify'})
+            await self.receive_until(second, 'ready')
+            await first.disconnect()
+            self.assertTrue(await database_sync_to_async(is_online)())
+
+            output = await database_sync_to_async(worker_dies)()
+            self.assertIn('0 session(s) and 1 connection(s); 1 user(s) now offline', output)
+            self.assertFalse(await database_sync_to_async(is_online)())
+            await second.disconnect()
+
+        async_to_sync(run)()
+        self.assertFalse(GatewayConnection.objects.exists())
+
+    def test_anonymous_is_refused(self):
+        """Test the gateway needs a signed-in user"""
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/gateway/')
+            communicator.scope['user'] = AnonymousUser()
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(run)()
+
+
+class GatewayEventCommitTestCase(TestCase):
+    """
+    Test cases for sending gateway events only once their write commits
+    """
+
+    def setUp(self):
+        """Create a server with one channel"""
+        self.owner = User.objects.create_user(username='commitowner', password='securepassword123')
+        self.server = Server.objects.create(name='Committed', owner=self.owner, invite_code='COMMIT01')
+        self.channel = ServerChannel.objects.create(server=self.server, name='general')
+
+    def test_events_wait_for_commit(self):
+        """Test a new message and membership reach the channel layer only after the commit"""
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('homepage.gateway.get_channel_layer', return_value=layer):
+            with self.captureOnCommitCallbacks() as callbacks:
+                ServerMember.objects.create(server=self.server, user=self.owner, role='owner')
+                ServerMessage.objects.create(channel=self.channel, sender=self.owner, content='hello')
+                layer.group_send.assert_not_called()
+            self.assertEqual(len(callbacks), 2)
+            for callback in callbacks:
+                callback()
+
+        sent = [call.args[1] for call in layer.group_send.call_args_list]
+        self.assertEqual([message['type'] for message in sent], ['gateway_subscribe', 'gateway_dispatch'])
+        self.assertEqual(sent[1]['data']['message']['content'], 'hello')
+
+    def test_rolled_back_message_is_not_sent(self):
+        """Test a message whose transaction rolls back is never published"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                ServerMessage.objects.create(channel=self.channel, sender=self.owner, content='lost')
+                raise RuntimeError('boom')
+        self.assertEqual(callbacks, [])
+
+
+class ServerCounterTestCase(TestCase):
+    """
+    Test cases for the denormalized server and channel counters
+    """
+
+    def setUp(self):
+        """Create a server with two channels and two members"""
+        self.client = Client()
+        self.owner = User.objects.create_user(username='countowner', password='securepassword123')
+        self.member = User.objects.create_user(username='countmember', password='securepassword123')
+        self.server = Server.objects.create(name='Counted', owner=self.owner, invite_code='COUNTED1')
+        ServerMember.objects.create(server=self.server, user=self.owner, role='owner')
+        ServerMember.objects.create(server=self.server, user=self.member)
+        self.general = ServerChannel.objects.create(server=self.server, name='general')
+        self.random = ServerChannel.objects.create(server=self.server, name='random')
+
+    def post(self, channel, content='hello'):
+        return ServerMessage.objects.create(channel=channel, sender=self.owner, content=content)
+
+    def test_messages_and_members_are_counted(self):
+        """Test creating and deleting messages and members moves the counters"""
+        first = self.post(self.general)
+        second = self.post(self.general)
+        third = self.post(self.random)
+        self.server.refresh_from_db()
+        self.general.refresh_from_db()
+        self.assertEqual((self.server.member_count, self.server.message_count), (2, 3))
+        self.assertEqual(self.general.message_count, 2)
+        self.assertEqual(self.general.last_message_at, second.timestamp)
+        self.assertEqual(self.server.last_message_at, third.timestamp)
+
+        second.delete()
+        third.delete()
+        self.server.refresh_from_db()
+        self.general.refresh_from_db()
+        self.assertEqual(self.general.message_count, 1)
+        self.assertEqual(self.general.last_message_at, first.timestamp)
+        self.assertEqual((self.server.message_count, self.server.last_message_at), (1, first.timestamp))
+
+        ServerMember.objects.filter(user=self.member).delete()
+        self.general.delete()
+        self.server.refresh_from_db()
+        self.assertEqual((self.server.member_count, self.server.message_count, self.server.last_message_at), (1, 0, None))
+
+    def test_cascade_deletes_recount_once(self):
+        """Test deleting a channel or server does not update counters once per message or member"""
+        for _ in range(20):
+            self.post(self.general)
+        latest = self.post(self.random)
+
+        def counter_updates(queries):
+            return [q for q in queries if q['sql'].startswith(('UPDATE "homepage_server" ', 'UPDATE "homepage_serverchannel" '))]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.general.delete()
+        self.assertEqual(len(counter_updates(queries)), 1)
+        self.server.refresh_from_db()
+        self.assertEqual((self.server.message_count, self.server.last_message_at), (1, latest.timestamp))
+
+        for user in [User.objects.create_user(username=f'extra{i}', password='pass') for i in range(10)]:
+            ServerMember.objects.create(server=self.server, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            self.server.delete()
+        self.assertEqual(counter_updates(queries), [])
+
+    def test_counter_update_rolls_back_with_the_message(self):
+        """Test a message is not written when its counters cannot be"""
+        with mock.patch('homepage.server_counters.record_message', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.post(self.general)
+        self.assertFalse(ServerMessage.objects.exists())
+
+    def test_stale_instance_does_not_overwrite_counters(self):
+        """Test saving an instance loaded before new messages keeps the counters"""
+        stale_server = Server.objects.get(pk=self.server.pk)
+        stale_channel = ServerChannel.objects.get(pk=self.general.pk)
+        self.post(self.general)
+        stale_server.name = 'Renamed'
+        stale_server.save()
+        stale_channel.description = 'Chat'
+        stale_channel.save()
+        self.server.refresh_from_db()
+        self.general.refresh_from_db()
+        self.assertEqual((self.server.name, self.server.message_count), ('Renamed', 1))
+        self.assertEqual(self.general.message_count, 1)
+
+    def test_server_details_do_not_count_per_channel(self):
+        """Test the server page reads counters in a fixed number of queries"""
+        self.client.login(username='countowner', password='securepassword123')
+        self.post(self.general)
+        url = reverse('homepage:get_server_details', args=[self.server.server_id])
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url)
+        data = response.json()
+        self.assertEqual(data['server']['member_count'], 2)
+        self.assertEqual(data['server']['message_count'], 1)
+        self.assertEqual({c['name']: c['message_count'] for c in data['channels']}, {'general': 1, 'random': 0})
+
+        for n in range(5):
+            ServerChannel.objects.create(server=self.server, name=f'extra{n}')
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(many), len(few))
+        self.assertFalse(any('COUNT(' in query['sql'] for query in many.captured_queries))
+
+    def test_discover_orders_by_member_count(self):
+        """Test discovery lists bigger public servers first without counting members"""
+        outsider = User.objects.create_user(username='countoutsider', password='securepassword123')
+        small = Server.objects.create(name='Small', owner=outsider, invite_code='COUNTED2')
+        ServerMember.objects.create(server=small, user=outsider, role='owner')
+        User.objects.create_user(username='countviewer', password='securepassword123')
+        self.client.login(username='countviewer', password='securepassword123')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('homepage:discover_servers'))
+        servers = response.json()['servers']
+        self.assertEqual([(s['name'], s['member_count']) for s in servers], [('Counted', 2), ('Small', 1)])
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+
+    def test_reconcile_command_fixes_drift(self):
+        """Test the reconcile command recomputes counters of rows written without save()"""
+        message = self.post(self.general)
+        ServerMember.objects.bulk_create([ServerMember(server=self.server, user=User.objects.create_user(username='bulkmember'))])
+        ServerChannel.objects.filter(pk=self.random.pk).update(message_count=7)
+        out = StringIO()
+        call_command('reconcile_server_counters', stdout=out)
+        self.assertIn('1 channel(s) and 1 server(s)', out.getvalue())
+        self.server.refresh_from_db()
+        self.random.refresh_from_db()
+        self.assertEqual((self.server.member_count, self.server.message_count), (3, 1))
+        self.assertEqual(self.server.last_message_at, message.timestamp)
+        self.assertEqual(self.random.message_count, 0)
+
+        out = StringIO()
+        call_command('reconcile_server_counters', stdout=out)
+        self.assertIn('0 channel(s) and 0 server(s)', out.getvalue())
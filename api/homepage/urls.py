@@ -11,6 +11,8 @@ urlpatterns = [
     path('python/delete-file/', views.delete_file, name='delete_file'),
     path('save_user_data/', views.save_user_data, name='save_user_data'),
     path('load_user_data/', views.load_user_data, name='load_user_data'),
+    path('python/notebooks/', views.list_notebooks, name='list_notebooks'),
+    path('python/notebooks/<str:name>/', views.get_notebook, name='get_notebook'),
     path('migrate/', migrate_views.run_migrations, name='run_migrations'),
     
     # New features
@@ -18,6 +20,7 @@ urlpatterns = [
     path('python/get-history/', views.get_execution_history, name='get_execution_history'),
     path('python/share/', views.share_code, name='share_code'),
     path('share/<uuid:share_id>/', views.view_shared_code, name='view_shared_code'),
+    path('python/shared/feed/', views.shared_code_feed, name='shared_code_feed'),
     path('python/fork/<uuid:share_id>/', views.fork_shared_code, name='fork_shared_code'),
     path('python/update-plot-theme/', views.update_plot_theme, name='update_plot_theme'),
     path('python/get-settings/', views.get_user_settings, name='get_user_settings'),
@@ -42,6 +45,7 @@ urlpatterns = [
     path('community/update-settings/', views.update_community_settings, name='update_community_settings'),
     path('community/send-message/', views.send_direct_message, name='send_direct_message'),
     path('community/messages/<int:user_id>/', views.get_direct_messages, name='get_direct_messages'),
+    path('community/messages/<int:user_id>/ack/', views.ack_direct_messages, name='ack_direct_messages'),
     
     # Profile features
     path('profile/<int:user_id>/', views.get_user_profile, name='get_user_profile'),
@@ -61,14 +65,17 @@ urlpatterns = [
     path('api/ide/projects/create-from-template/', ide_views.create_project_from_template, name='ide_create_from_template'),
     path('api/ide/projects/<uuid:project_id>/', ide_views.get_project, name='ide_get_project'),
     path('api/ide/projects/<uuid:project_id>/delete/', ide_views.delete_project, name='ide_delete_project'),
+    path('api/ide/projects/<uuid:project_id>/collaborators/', ide_views.project_collaborators, name='ide_collaborators'),
+    path('api/ide/projects/<uuid:project_id>/collaborators/remove/', ide_views.remove_collaborator, name='ide_remove_collaborator'),
     
-    # File management
+    # File management (fixed routes before the catch-all file path)
     path('api/ide/projects/<uuid:project_id>/files/', ide_views.get_project_files, name='ide_get_files'),
-    path('api/ide/projects/<uuid:project_id>/files/<path:file_path>/', ide_views.get_file_content, name='ide_get_file'),
     path('api/ide/projects/<uuid:project_id>/files/create/', ide_views.create_file, name='ide_create_file'),
     path('api/ide/projects/<uuid:project_id>/files/save/', ide_views.save_file, name='ide_save_file'),
+    path('api/ide/projects/<uuid:project_id>/files/save-batch/', ide_views.save_files, name='ide_save_files'),
     path('api/ide/projects/<uuid:project_id>/files/delete/', ide_views.delete_file, name='ide_delete_file'),
     path('api/ide/projects/<uuid:project_id>/files/rename/', ide_views.rename_file, name='ide_rename_file'),
+    path('api/ide/projects/<uuid:project_id>/files/<path:file_path>/', ide_views.get_file_content, name='ide_get_file'),
     path('api/ide/projects/<uuid:project_id>/directories/create/', ide_views.create_directory, name='ide_create_directory'),
     
     # File upload/download
@@ -79,6 +86,7 @@ urlpatterns = [
     # Code execution
     path('api/ide/projects/<uuid:project_id>/execute/', ide_views.execute_code, name='ide_execute_code'),
     path('api/ide/projects/<uuid:project_id>/history/', ide_views.get_execution_history, name='ide_execution_history'),
+    path('api/ide/projects/<uuid:project_id>/history/stats/', ide_views.get_execution_stats, name='ide_execution_stats'),
     
     # Generated files (SQLite databases, etc.)
     path('api/ide/projects/<uuid:project_id>/generated-files/', ide_views.get_project_generated_files, name='ide_get_generated_files'),
@@ -111,6 +119,9 @@ urlpatterns = [
     # Channel management
     path('api/channels/<uuid:channel_id>/', server_views.get_channel_messages, name='get_channel_messages'),
     path('api/channels/<uuid:channel_id>/send/', server_views.send_message, name='send_server_message'),
+    path('api/channels/<uuid:channel_id>/ack/', server_views.ack_channel, name='ack_channel'),
+    path('api/unread/', server_views.get_unread_badges, name='get_unread_badges'),
+    path('api/search/messages/', server_views.search_messages, name='search_messages'),
     path('api/servers/<uuid:server_id>/channels/create/', server_views.create_channel, name='create_channel'),
     
     # Category management
@@ -1,14 +1,17 @@
 
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, condition
+from django.views.decorators.gzip import gzip_page
 from django.db import transaction, IntegrityError
 from django.db import models
 from .models import PythonCodeSession, UserFiles, UserProfile
+from .workspace import load_workspace, workspace_etag, system_file_contents
 from auth_app.rate_limiting import rate_limit_per_user
 import json
 from django.conf import settings
@@ -152,41 +155,17 @@ print(f"Hello, {{name}}! Enjoy exploring Python with scientific libraries!")
 print("\\nAvailable libraries: numpy, pandas, matplotlib, scipy, scikit-learn, seaborn")
 print("Your Python files are saved to your account!")
 '''
-            PythonCodeSession.objects.create(
-                user=user,
-                filename=current_filename,
-                code_content=code_content
-            )
         
-        saved_files = PythonCodeSession.objects.filter(user=user).values_list('filename', flat=True)
-        
-        system_files = ['text.txt', 'tester.csv', 'binary.dat']
-        for system_file in system_files:
-            user_file, created = UserFiles.objects.get_or_create(
-                user=user,
-                filename=system_file,
-                defaults={
-                    'is_system_file': True,
-                    'file_type': 'text' if system_file.endswith('.txt') else 
-                               'csv' if system_file.endswith('.csv') else 'binary'
-                }
-            )
-            if created:
-                if system_file == 'text.txt':
-                    user_file.content = f"Hello {user.username}!\nThis is your personal text file.\nYou can modify this content and it will be saved to your account."
-                elif system_file == 'tester.csv':
-                    user_file.content = f"name,age,city,user\nJohn,25,NYC,{user.username}\nJane,30,LA,guest\nBob,35,Chicago,{user.username}"
-                elif system_file == 'binary.dat':
-                    user_file.content = f"Personal binary data for {user.username}"
-                user_file.save()
-        
-        text_file = UserFiles.objects.get(user=user, filename='text.txt')
-        csv_file = UserFiles.objects.get(user=user, filename='tester.csv')
-        binary_file = UserFiles.objects.get(user=user, filename='binary.dat')
-        
-        text_content = text_file.content
-        csv_content = csv_file.content
-        binary_content = f"Personal binary data for {user.username}\nLength: {len(binary_file.content)} characters"
+        saved_files = list(PythonCodeSession.objects.filter(user=user).values_list('filename', flat=True))
+        if 'main.py' not in saved_files:
+            # main.py is only stored once the user saves it
+            saved_files.insert(0, 'main.py')
+        
+        # System files come from the shared copy unless the user saved their own
+        system_files = system_file_contents(user)
+        text_content = system_files['text.txt']
+        csv_content = system_files['tester.csv']
+        binary_content = f"Personal binary data for {user.username}\nLength: {len(system_files['binary.dat'])} characters"
         binary_hex = "Your personal binary file (simplified view)"
         
         migration_needed = False
@@ -239,42 +218,29 @@ print(f"Hello, {{name}}!")
 def get_files(request):
     user = request.user
     
-    try:
-        text_file = UserFiles.objects.get(user=user, filename='text.txt')
-        csv_file = UserFiles.objects.get(user=user, filename='tester.csv')
-        binary_file = UserFiles.objects.get(user=user, filename='binary.dat')
-        
-        python_files = {}
-        files_list = []
-        for session in PythonCodeSession.objects.filter(user=user):
-            python_files[session.filename] = session.code_content
-            # Add file info for account page display
-            files_list.append({
-                'filename': session.filename,
-                'updated_at': session.updated_at.isoformat(),
-                'created_at': session.created_at.isoformat(),
-                'size': len(session.code_content)
-            })
-        
-        return JsonResponse({
-            'text_content': text_file.content,
-            'csv_content': csv_file.content,
-            'binary_content': binary_file.content,
-            'binary_hex': f"User file for {user.username}",
-            'python_files': python_files,
-            'saved_files': list(python_files.keys()),
-            'files': files_list  # Added for account page
-        })
-        
-    except UserFiles.DoesNotExist:
-        return JsonResponse({
-            'text_content': f"Welcome {user.username}! Your personal text file.",
-            'csv_content': f"name,age,city,user\n{user.username},25,Home,active",
-            'binary_content': f"Personal data for {user.username}",
-            'python_files': {},
-            'saved_files': [],
-            'files': []  # Added for account page
+    system_files = system_file_contents(user)
+    
+    python_files = {}
+    files_list = []
+    for session in PythonCodeSession.objects.filter(user=user):
+        python_files[session.filename] = session.code_content
+        # Add file info for account page display
+        files_list.append({
+            'filename': session.filename,
+            'updated_at': session.updated_at.isoformat(),
+            'created_at': session.created_at.isoformat(),
+            'size': len(session.code_content)
         })
+    
+    return JsonResponse({
+        'text_content': system_files['text.txt'],
+        'csv_content': system_files['tester.csv'],
+        'binary_content': system_files['binary.dat'],
+        'binary_hex': f"User file for {user.username}",
+        'python_files': python_files,
+        'saved_files': list(python_files.keys()),
+        'files': files_list  # Added for account page
+    })
 
 @login_required
 @ensure_csrf_cookie
@@ -292,121 +258,27 @@ def save_user_data(request):
         user_data = json.loads(request.body)
         user = request.user
         
-        # Log what we're receiving
         import logging
         logger = logging.getLogger(__name__)
-        logger.info(f"💾 Saving data for user {user.username}")
-        logger.info(f"📝 Scripts to save: {list(user_data.get('scripts', {}).keys())}")
+        logger.debug(f"Saving data for user {user.username}: {list(user_data.get('scripts', {}).keys())}")
         
-        # Check total file limit before saving
-        existing_files = PythonCodeSession.objects.filter(user=user).count()
-        files_saved = 0
-        files_updated = 0
-        files_skipped = 0
+        from .workspace import sync_workspace, FileLimitError
         
-        # Save current code
-        if user_data.get('currentCode'):
-            try:
-                session = PythonCodeSession.objects.get(user=user, filename='main.py')
-                session.code_content = user_data['currentCode']
-                session.save()
-                files_updated += 1
-                logger.info(f"✅ Updated main.py")
-            except PythonCodeSession.DoesNotExist:
-                if existing_files >= 10:
-                    return JsonResponse({
-                        'status': 'error', 
-                        'message': 'Maximum 10 files allowed. Delete some files first.'
-                    }, status=400)
-                try:
-                    PythonCodeSession.objects.create(
-                        user=user,
-                        filename='main.py',
-                        code_content=user_data['currentCode']
-                    )
-                    files_saved += 1
-                    logger.info(f"✅ Created main.py")
-                except IntegrityError:
-                    # File was created by another request
-                    pass
-        
-        # Save scripts with file limit check
-        if user_data.get('scripts'):
-            for key, content in user_data['scripts'].items():
-                if key.startswith('python_script_'):
-                    filename = key.replace('python_script_', '')
-                    try:
-                        session = PythonCodeSession.objects.get(user=user, filename=filename)
-                        session.code_content = content
-                        session.save()
-                        files_updated += 1
-                        logger.info(f"✅ Updated {filename}")
-                    except PythonCodeSession.DoesNotExist:
-                        # Check limit before creating
-                        current_count = PythonCodeSession.objects.filter(user=user).count()
-                        if current_count >= 10:
-                            files_skipped += 1
-                            logger.warning(f"⚠️ Skipped {filename} - file limit reached")
-                            continue  # Skip this file
-                        try:
-                            PythonCodeSession.objects.create(
-                                user=user,
-                                filename=filename,
-                                code_content=content
-                            )
-                            files_saved += 1
-                            logger.info(f"✅ Created {filename}")
-                        except IntegrityError:
-                            logger.warning(f"⚠️ IntegrityError for {filename}")
-                            pass  # File exists, skip
-                            
-                elif key.startswith('data_file_'):
-                    filename = key.replace('data_file_', '')
-                    try:
-                        file_obj = UserFiles.objects.get(user=user, filename=filename)
-                        file_obj.content = content
-                        file_obj.save()
-                        files_updated += 1
-                        logger.info(f"✅ Updated data file {filename}")
-                    except UserFiles.DoesNotExist:
-                        try:
-                            UserFiles.objects.create(
-                                user=user,
-                                filename=filename,
-                                content=content,
-                                is_system_file=False
-                            )
-                            files_saved += 1
-                            logger.info(f"✅ Created data file {filename}")
-                        except IntegrityError:
-                            pass  # File exists, skip
-        
-        # Save notebook data
-        if user_data.get('notebooks'):
-            try:
-                session = PythonCodeSession.objects.get(user=user, filename='_notebook_data.json')
-                session.code_content = json.dumps(user_data['notebooks'])
-                session.save()
-            except PythonCodeSession.DoesNotExist:
-                try:
-                    PythonCodeSession.objects.create(
-                        user=user,
-                        filename='_notebook_data.json',
-                        code_content=json.dumps(user_data['notebooks'])
-                    )
-                except IntegrityError:
-                    pass
+        # Only files whose content hash changed are written
+        try:
+            result = sync_workspace(user, user_data)
+        except FileLimitError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
         
-        logger.info(f"📊 Save complete: {files_saved} created, {files_updated} updated, {files_skipped} skipped")
+        stats = result['stats']
+        logger.debug(f"Save complete: {stats['created']} created, {stats['updated']} updated, "
+                     f"{stats['unchanged']} unchanged, {stats['skipped']} skipped")
         
         return JsonResponse({
             'status': 'success', 
             'message': 'Data saved successfully',
-            'stats': {
-                'created': files_saved,
-                'updated': files_updated,
-                'skipped': files_skipped
-            }
+            'stats': stats,
+            'versions': result['versions']
         })
         
     except json.JSONDecodeError:
@@ -415,44 +287,63 @@ def save_user_data(request):
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 @login_required
+@gzip_page
+@condition(etag_func=workspace_etag)
 def load_user_data(request):
+    """Workspace snapshot; answers 304 while the workspace version is unchanged"""
     try:
-        user = request.user
-        user_data = {
-            'currentCode': '',
-            'scripts': {},
-            'notebooks': {},
-            'settings': {
-                'theme': 'monokai',
-                'fontSize': 14,
-                'lastLoaded': timezone.now().isoformat()
-            }
+        user_data = load_workspace(request.user)
+        user_data['settings'] = {
+            'theme': 'monokai',
+            'fontSize': 14,
+            'lastLoaded': timezone.now().isoformat()
         }
         
-        # Load current code (main.py)
-        try:
-            main_session = PythonCodeSession.objects.get(user=user, filename='main.py')
-            user_data['currentCode'] = main_session.code_content
-        except PythonCodeSession.DoesNotExist:
-            pass
+        response = JsonResponse(user_data)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
         
-        # Load all Python scripts
-        for session in PythonCodeSession.objects.filter(user=user):
-            if session.filename != 'main.py' and not session.filename.endswith('.json'):
-                user_data['scripts'][f'python_script_{session.filename}'] = session.code_content
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+@login_required
+def list_notebooks(request):
+    """List the user's notebooks without their cells"""
+    try:
+        from .models import Notebook
         
-        # Load data files
-        for file_obj in UserFiles.objects.filter(user=user, is_system_file=False):
-            user_data['scripts'][f'data_file_{file_obj.filename}'] = file_obj.content
+        notebooks = Notebook.objects.filter(user=request.user).values(
+            'name', 'cell_count', 'version', 'updated_at'
+        )
+        return JsonResponse({
+            'status': 'success',
+            'notebooks': [
+                {**notebook, 'updated_at': notebook['updated_at'].isoformat()}
+                for notebook in notebooks
+            ]
+        })
         
-        # Load notebook data
-        try:
-            notebook_session = PythonCodeSession.objects.get(user=user, filename='_notebook_data.json')
-            user_data['notebooks'] = json.loads(notebook_session.code_content)
-        except (PythonCodeSession.DoesNotExist, json.JSONDecodeError):
-            pass
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
+@login_required
+def get_notebook(request, name):
+    """Load a single notebook with its cells"""
+    try:
+        from .models import Notebook
         
-        return JsonResponse(user_data)
+        notebook = Notebook.objects.filter(user=request.user, name=name).first()
+        if notebook is None:
+            return JsonResponse({'status': 'error', 'message': 'Notebook not found'}, status=404)
+        
+        return JsonResponse({
+            'status': 'success',
+            'name': notebook.name,
+            'version': notebook.version,
+            'notebook': notebook.to_document()
+        })
         
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -514,16 +405,10 @@ def save_execution_history(request):
             
             from .models import ExecutionHistory
             
-            # Limit history to last 100 entries per user
-            history_count = ExecutionHistory.objects.filter(user=request.user).count()
-            if history_count >= 100:
-                # Delete oldest entries
-                oldest = ExecutionHistory.objects.filter(user=request.user).order_by('executed_at')[:history_count-99]
-                ExecutionHistory.objects.filter(id__in=[h.id for h in oldest]).delete()
-            
-            history = ExecutionHistory.objects.create(
-                user=request.user,
-                code_snippet=code,
+            # Overwrites the user's oldest slot once their history is full
+            history = ExecutionHistory.record(
+                request.user,
+                code=code,
                 output=output,
                 error=error,
                 execution_time=execution_time,
@@ -544,14 +429,24 @@ def save_execution_history(request):
 
 @login_required
 def get_execution_history(request):
-    """Retrieve execution history for the user"""
+    """Retrieve execution history for the user, newest first (?cursor=&limit=)"""
     try:
         from .models import ExecutionHistory
+        from .pagination import keyset_page, approximate_count
         
-        limit = int(request.GET.get('limit', 50))
-        offset = int(request.GET.get('offset', 0))
+        try:
+            limit = max(1, min(int(request.GET.get('limit', 50)), 100))
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid limit'}, status=400)
         
-        history = ExecutionHistory.objects.filter(user=request.user)[offset:offset+limit]
+        history = ExecutionHistory.objects.filter(user=request.user).only(
+            'id', 'code_snippet', 'output', 'error', 'execution_time',
+            'filename', 'was_successful', 'executed_at'
+        )
+        try:
+            history, next_cursor = keyset_page(history, request.GET.get('cursor'), limit)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
         
         history_data = []
         for h in history:
@@ -567,11 +462,18 @@ def get_execution_history(request):
                 'executed_at': h.executed_at.isoformat()
             })
         
-        return JsonResponse({
+        response = {
             'status': 'success',
             'history': history_data,
-            'total': ExecutionHistory.objects.filter(user=request.user).count()
-        })
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if request.GET.get('include_total'):
+            response['total'] = approximate_count(
+                f'exec_history_total:{request.user.id}',
+                ExecutionHistory.objects.filter(user=request.user)
+            )
+        return JsonResponse(response)
         
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -624,7 +526,10 @@ def view_shared_code(request, share_id):
     try:
         from .models import SharedCode
         
-        shared_code = SharedCode.objects.get(share_id=share_id)
+        # Large fields are only loaded if the page has to be rendered
+        shared_code = SharedCode.objects.select_related('user').defer(
+            'code_content', 'highlighted_html', 'imported_files', 'session_state'
+        ).get(share_id=share_id)
         
         # Check if expired
         if shared_code.expires_at and timezone.now() > shared_code.expires_at:
@@ -637,15 +542,118 @@ def view_shared_code(request, share_id):
         # Increment view count
         shared_code.increment_view_count()
         
-        return render(request, 'homepage/shared_code.html', {
-            'shared_code': shared_code,
-            'is_owner': request.user.is_authenticated and request.user == shared_code.user
-        })
+        if request.user.is_authenticated or not shared_code.is_public:
+            response = render(request, 'homepage/shared_code.html', {
+                'shared_code': shared_code,
+                'view_count': shared_code.view_count,
+                'fork_count': shared_code.fork_count,
+                'is_owner': request.user.is_authenticated and request.user == shared_code.user
+            })
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        
+        # Anonymous views of public snippets are identical until the snippet is saved again,
+        # apart from the counts, which are filled into the cached page on every request
+        from django.core.cache import cache
+        from django.http import HttpResponse, HttpResponseNotModified
+        from django.utils.http import quote_etag, parse_etags
+        from django.utils.safestring import mark_safe
+        
+        version = f'{shared_code.share_id}-{int(shared_code.updated_at.timestamp() * 1000000)}'
+        # Weak: a revalidated copy may show older counts, but every view is still counted
+        etag = 'W/' + quote_etag(version)
+        max_age = getattr(settings, 'SHARED_CODE_CACHE_TIMEOUT', 300)
+        if shared_code.expires_at:
+            # Never keep the page past its expiry
+            max_age = max(0, min(max_age, int((shared_code.expires_at - timezone.now()).total_seconds())))
+        
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            cache_key = f'shared_code_page:{version}'
+            html = cache.get(cache_key)
+            if html is None:
+                # Markers are HTML comments, which escaped snippet text can never contain
+                html = render(request, 'homepage/shared_code.html', {
+                    'shared_code': shared_code,
+                    'view_count': mark_safe('<!--view_count-->'),
+                    'fork_count': mark_safe('<!--fork_count-->'),
+                    'is_owner': False
+                }).content.decode()
+                cache.set(cache_key, html, max_age)
+            response = HttpResponse(
+                html.replace('<!--view_count-->', str(shared_code.view_count))
+                .replace('<!--fork_count-->', str(shared_code.fork_count))
+            )
+        
+        # Browsers revalidate every time and shared caches never store the page,
+        # so making the snippet private or editing it takes effect immediately
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
         
     except SharedCode.DoesNotExist:
         return render(request, 'homepage/shared_code_not_found.html', status=404)
 
 
+def shared_code_feed(request):
+    """Paginated discovery feed read from the precomputed SharedCodeRanking boards"""
+    try:
+        from .models import SharedCodeRanking
+        from django.db.models import Q
+        
+        board = request.GET.get('board', 'trending')
+        if board not in dict(SharedCodeRanking.BOARD_CHOICES):
+            return JsonResponse({'status': 'error', 'message': 'Unknown board'}, status=400)
+        try:
+            after = max(int(request.GET.get('after', 0)), 0)
+            limit = min(max(int(request.GET.get('limit', 20)), 1), 50)
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid pagination parameters'}, status=400)
+        
+        # Rankings are refreshed periodically, so re-check visibility at read time
+        rankings = list(
+            SharedCodeRanking.objects.filter(board=board, rank__gt=after)
+            .filter(shared_code__is_public=True, shared_code__is_active=True)
+            .filter(Q(shared_code__expires_at__isnull=True) | Q(shared_code__expires_at__gt=timezone.now()))
+            .select_related('shared_code__user')
+            .defer('shared_code__code_content', 'shared_code__highlighted_html',
+                   'shared_code__imported_files', 'shared_code__session_state')
+            .order_by('rank')[:limit + 1]
+        )
+        has_more = len(rankings) > limit
+        rankings = rankings[:limit]
+        
+        items = []
+        for ranking in rankings:
+            shared_code = ranking.shared_code
+            items.append({
+                'rank': ranking.rank,
+                'score': ranking.score,
+                'share_id': str(shared_code.share_id),
+                'title': shared_code.title,
+                'username': shared_code.user.username,
+                'view_count': shared_code.view_count,
+                'fork_count': shared_code.fork_count,
+                'created_at': shared_code.created_at.isoformat(),
+                'url': reverse('homepage:view_shared_code', args=[shared_code.share_id]),
+            })
+        
+        response = JsonResponse({
+            'status': 'success',
+            'board': board,
+            'items': items,
+            'computed_at': rankings[0].computed_at.isoformat() if rankings else None,
+            'next_after': rankings[-1].rank if has_more else None,
+            'has_more': has_more,
+        })
+        response['Cache-Control'] = 'public, max-age=60'
+        return response
+        
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
 @login_required
 def fork_shared_code(request, share_id):
     """Fork a shared code to user's account"""
@@ -840,14 +848,21 @@ def join_collaborative_session(request, session_id):
             except UserProfile.DoesNotExist:
                 pass
         
+        from .collab import document_state
+        from .wire import field_table
+        session_code, session_seq = document_state(session)
+        
         context = {
             'session': session,
+            'session_code': session_code,
+            'session_seq': session_seq,
             'is_owner': request.user == session.user,
             'can_edit': member.permission == 'edit' or request.user == session.user,
             'can_import_export': can_import_export,
             'user_py_files': user_py_files,
             'member_permission': member.permission,
             'user_theme': user_theme,
+            'wire_fields': field_table(),
         }
         
         return render(request, 'homepage/collaborative_session.html', context)
@@ -1052,7 +1067,11 @@ def export_session_to_files(request, session_id):
             
             data = json.loads(request.body)
             filename = data.get('filename', f"{session.title}.py")
-            code_content = data.get('code', session.session_state.get('code', ''))
+            if 'code' in data:
+                code_content = data['code']
+            else:
+                from .collab import document_state
+                code_content, _ = document_state(session)
             
             # Ensure .py extension
             if not filename.endswith('.py'):
@@ -1092,6 +1111,11 @@ def end_session(request, session_id):
             if request.user != session.user:
                 return JsonResponse({'status': 'error', 'message': 'Not authorized'}, status=403)
             
+            # Write back any live state and make new connections see the session as ended
+            from .collab import live_sessions
+            live_sessions.flush(session_id, force=True)
+            live_sessions.discard(session_id)
+            
             session.is_active = False
             session.save(update_fields=['is_active'])
             
@@ -1412,12 +1436,9 @@ def get_direct_messages(request, user_id):
             models.Q(sender=other_user, recipient=request.user)
         ).order_by('created_at').select_related('sender', 'recipient')
         
-        # Mark messages as read
-        DirectMessage.objects.filter(
-            sender=other_user,
-            recipient=request.user,
-            is_read=False
-        ).update(is_read=True)
+        # Mark messages as read (no write unless the conversation has unread messages)
+        from .read_states import ack_direct_messages
+        ack_direct_messages(request.user, other_user)
         
         messages_data = []
         for msg in messages:
@@ -1450,6 +1471,24 @@ def get_direct_messages(request, user_id):
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
 
 
+@login_required
+@require_POST
+def ack_direct_messages(request, user_id):
+    """Mark a conversation read, e.g. after showing messages that arrived over the gateway"""
+    try:
+        other_user = User.objects.get(id=user_id)
+        
+        from .read_states import ack_direct_messages as ack_conversation
+        ack_conversation(request.user, other_user)
+        
+        return JsonResponse({'status': 'success'})
+        
+    except User.DoesNotExist:
+        return JsonResponse({'status': 'error', 'message': 'User not found'}, status=404)
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
 # Profile Views
 @login_required
 def get_user_profile(request, user_id):
@@ -0,0 +1,201 @@
+"""
+WebSocket wire protocols.
+
+Clients that offer the `pycomp.msgpack.v1` subprotocol get binary frames:
+a one-byte header (bit 0 set = zlib-compressed body) followed by the message
+as MessagePack, with well-known field names replaced by small integer codes
+(FIELD_CODES) at every nesting level. Bodies larger than
+WIRE_COMPRESS_THRESHOLD bytes, such as code snapshots and terminal output,
+are compressed when that makes them smaller. Clients may send either binary
+frames in the same format or JSON text. Everyone else keeps plain JSON text
+frames with full field names.
+
+Consumers mix in `WireProtocolMixin` and use `send_message(dict)` and
+`decode_message(text_data, bytes_data)` instead of json.dumps/json.loads.
+Group broadcasts that every member receives unchanged are wrapped with
+`encode_frame()` and relayed with `send_frame()`: each worker process
+encodes such a message at most once per protocol, and only for protocols
+its members actually use.
+"""
+import json
+import uuid
+import zlib
+from collections import OrderedDict
+
+import msgpack
+from django.conf import settings
+
+MSGPACK_PROTOCOL = 'pycomp.msgpack.v1'
+JSON_PROTOCOL = 'pycomp.json.v1'
+
+COMPRESSED = 0x01
+
+# Append only: codes are part of the protocol
+FIELD_CODES = {
+    'type': 0,
+    'message': 1,
+    'user_id': 2,
+    'username': 3,
+    'user': 4,
+    'timestamp': 5,
+    'seq': 6,
+    'ops': 7,
+    'pos': 8,
+    'text': 9,
+    'length': 10,
+    'client_id': 11,
+    'code': 12,
+    'content': 13,
+    'file_path': 14,
+    'terminal_output': 15,
+    'terminal_total': 16,
+    'output': 17,
+    'error': 18,
+    'permission': 19,
+    'members': 20,
+    'is_online': 21,
+    'is_owner': 22,
+    'updates': 23,
+    'kind': 24,
+    'position': 25,
+    'status': 26,
+    'is_typing': 27,
+    'message_id': 28,
+    'sender': 29,
+    'id': 30,
+    'profile_picture': 31,
+    'reply_to': 32,
+    'sender_username': 33,
+    'emoji': 34,
+    'state': 35,
+    'base_seq': 36,
+    'last_active': 37,
+    'event': 38,
+    'data': 39,
+    'session_id': 40,
+    'channel_id': 41,
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def field_table():
+    """Field names indexed by code, for clients (templates render it with json_script)"""
+    return [FIELD_NAMES.get(code) for code in range(max(FIELD_NAMES) + 1)]
+
+
+class WireDecodeError(ValueError):
+    """Raised when an incoming frame is not a valid message in the negotiated protocol"""
+
+
+def compress_threshold():
+    return getattr(settings, 'WIRE_COMPRESS_THRESHOLD', 1024)
+
+
+def negotiate(subprotocols):
+    """The subprotocol to accept from those the client offered (None for plain JSON)"""
+    for protocol in (MSGPACK_PROTOCOL, JSON_PROTOCOL):
+        if protocol in subprotocols:
+            return protocol
+    return None
+
+
+def _shorten(value):
+    if isinstance(value, dict):
+        return {FIELD_CODES.get(key, key): _shorten(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_shorten(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {FIELD_NAMES.get(key, key) if isinstance(key, int) else key: _expand(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def encode(message):
+    """Binary frame for `message`"""
+    body = msgpack.packb(_shorten(message), use_bin_type=True)
+    if len(body) > compress_threshold():
+        compressed = zlib.compress(body, 6)
+        if len(compressed) < len(body):
+            return bytes([COMPRESSED]) + compressed
+    return b'\x00' + body
+
+
+def decode(frame):
+    """Message dict from a binary frame; raises WireDecodeError"""
+    try:
+        body = frame[1:]
+        if frame[0] & COMPRESSED:
+            body = zlib.decompress(body)
+        message = msgpack.unpackb(body, raw=False, strict_map_key=False)
+    except (IndexError, ValueError, TypeError, zlib.error, msgpack.UnpackException) as e:
+        raise WireDecodeError(f'Invalid frame: {e}') from None
+    if not isinstance(message, dict):
+        raise WireDecodeError('Invalid frame: not a message')
+    return _expand(message)
+
+
+FRAME_CACHE_SIZE = 256  # Group frames remembered per process, per protocol
+
+_frames = OrderedDict()  # (frame_id, binary) -> encoded frame
+
+
+def encode_frame(message):
+    """Group message for `send_frame()` on every member; encoded on first use per protocol"""
+    return {'frame_id': uuid.uuid4().hex, 'message': message}
+
+
+def _encoded_frame(event, binary):
+    key = (event['frame_id'], binary)
+    frame = _frames.get(key)
+    if frame is None:
+        frame = encode(event['message']) if binary else json.dumps(event['message'])
+        _frames[key] = frame
+        while len(_frames) > FRAME_CACHE_SIZE:
+            _frames.popitem(last=False)
+    return frame
+
+
+class WireProtocolMixin:
+    """
+    Mixin for AsyncWebsocketConsumer: negotiates the wire protocol when the
+    socket is accepted and encodes/decodes frames accordingly.
+    """
+
+    binary_protocol = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = negotiate(self.scope.get('subprotocols') or [])
+        self.binary_protocol = subprotocol == MSGPACK_PROTOCOL
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def send_message(self, message):
+        if self.binary_protocol:
+            await self.send(bytes_data=encode(message))
+        else:
+            await self.send(text_data=json.dumps(message))
+
+    async def send_frame(self, event):
+        """Relay a group message wrapped with encode_frame()"""
+        if self.binary_protocol:
+            await self.send(bytes_data=_encoded_frame(event, True))
+        else:
+            await self.send(text_data=_encoded_frame(event, False))
+
+    def decode_message(self, text_data=None, bytes_data=None):
+        """Message dict from an incoming frame (JSON text or binary); raises WireDecodeError"""
+        if bytes_data is not None:
+            return decode(bytes_data)
+        try:
+            message = json.loads(text_data)
+        except (TypeError, ValueError) as e:
+            raise WireDecodeError(f'Invalid JSON: {e}') from None
+        if not isinstance(message, dict):
+            raise WireDecodeError('Invalid JSON: not a message')
+        return message
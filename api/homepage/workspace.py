@@ -0,0 +1,324 @@
+"""
+Versioned autosave for the free playground workspace.
+
+The client sends only the files whose content changed since the server last
+acknowledged them (same payload shape as before: currentCode, scripts,
+notebooks). Each stored file carries a content hash and a version number;
+unchanged content is skipped, changed files are written with one bulk upsert
+per table, and the full version vector is returned for the client to track.
+"""
+import hashlib
+import json
+import logging
+
+from django.db import transaction
+from django.db.models import CharField, F, TextField, Value
+from django.utils import timezone
+
+from .models import PythonCodeSession, UserFiles, UserProfile, Notebook, NotebookCell
+
+logger = logging.getLogger(__name__)
+
+MAX_CODE_FILES = 10
+MAIN_FILE = 'main.py'
+DEFAULT_NOTEBOOK = 'default'
+
+# Shared, read-only system files: filename -> (file_type, content template).
+# Users only get a UserFiles row for one of these once they change it.
+SYSTEM_FILES = {
+    'text.txt': (
+        'text',
+        "Hello {username}!\nThis is your personal text file.\n"
+        "You can modify this content and it will be saved to your account."
+    ),
+    'tester.csv': (
+        'csv',
+        "name,age,city,user\nJohn,25,NYC,{username}\nJane,30,LA,guest\nBob,35,Chicago,{username}"
+    ),
+    'binary.dat': (
+        'binary',
+        "Personal binary data for {username}"
+    ),
+}
+
+
+class FileLimitError(Exception):
+    """Raised when a required file cannot be created because the file limit is reached"""
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def code_file_key(filename):
+    """Client-side key for a PythonCodeSession filename"""
+    if filename == MAIN_FILE:
+        return 'currentCode'
+    return f'python_script_{filename}'
+
+
+def data_file_key(filename):
+    """Client-side key for a UserFiles filename"""
+    return f'data_file_{filename}'
+
+
+def _plan_writes(changes, rows, stats, build, limit=None):
+    """Work out which changed files need writing, updating `rows` to their new hash/version"""
+    writes = []
+    file_count = len(rows)
+    for filename, content in changes.items():
+        digest = content_hash(content)
+        existing = rows.get(filename)
+        if existing is None:
+            if limit is not None and file_count >= limit:
+                if filename == MAIN_FILE:
+                    raise FileLimitError(f'Maximum {limit} files allowed. Delete some files first.')
+                stats['skipped'] += 1
+                logger.debug('Skipped %s - file limit reached', filename)
+                continue
+            file_count += 1
+            version = 1
+            stats['created'] += 1
+        elif existing[0] == digest:
+            stats['unchanged'] += 1
+            continue
+        else:
+            version = existing[1] + 1
+            stats['updated'] += 1
+
+        writes.append(build(filename, content, digest, version))
+        rows[filename] = (digest, version, existing[2] if existing else False)
+    return writes
+
+
+def sync_workspace(user, user_data):
+    """
+    Apply an autosave payload for `user` in one transaction.
+
+    Returns {'stats': {...}, 'versions': {client_key: version}}.
+    Raises FileLimitError if main.py is new and the file limit is reached.
+    """
+    code_changes = {}
+    data_changes = {}
+
+    if user_data.get('currentCode'):
+        code_changes[MAIN_FILE] = user_data['currentCode']
+    for key, content in (user_data.get('scripts') or {}).items():
+        if key.startswith('python_script_'):
+            code_changes[key[len('python_script_'):]] = content
+        elif key.startswith('data_file_'):
+            data_changes[key[len('data_file_'):]] = content
+
+    stats = {'created': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0}
+
+    with transaction.atomic():
+        # One read per table gives the current hashes, versions and file count
+        code_rows = {
+            filename: (digest, version, False)
+            for filename, digest, version in PythonCodeSession.objects.filter(user=user)
+            .values_list('filename', 'content_hash', 'version')
+        }
+        data_rows = {
+            filename: (digest, version, is_system)
+            for filename, digest, version, is_system in UserFiles.objects.filter(user=user)
+            .values_list('filename', 'content_hash', 'version', 'is_system_file')
+        }
+
+        code_writes = _plan_writes(
+            code_changes, code_rows, stats,
+            lambda filename, content, digest, version: PythonCodeSession(
+                user=user, filename=filename, code_content=content,
+                content_hash=digest, version=version
+            ),
+            limit=MAX_CODE_FILES
+        )
+        data_writes = _plan_writes(
+            data_changes, data_rows, stats,
+            lambda filename, content, digest, version: UserFiles(
+                user=user, filename=filename, content=content,
+                content_hash=digest, version=version, is_system_file=False
+            )
+        )
+
+        if code_writes:
+            PythonCodeSession.objects.bulk_create(
+                code_writes,
+                update_conflicts=True,
+                unique_fields=['user', 'filename'],
+                update_fields=['code_content', 'content_hash', 'version', 'updated_at']
+            )
+        if data_writes:
+            UserFiles.objects.bulk_create(
+                data_writes,
+                update_conflicts=True,
+                unique_fields=['user', 'filename'],
+                update_fields=['content', 'content_hash', 'version', 'updated_at']
+            )
+        notebook_versions = {}
+        notebooks_changed = False
+        if user_data.get('notebooks'):
+            notebooks_changed = save_notebooks(user, user_data['notebooks'], stats, notebook_versions)
+
+        if code_writes or data_writes or notebooks_changed:
+            # bulk_create sends no signals, so bump the workspace version here
+            bump_workspace_version(user.id)
+
+    versions = {code_file_key(filename): row[1] for filename, row in code_rows.items()}
+    versions.update({
+        data_file_key(filename): row[1]
+        for filename, row in data_rows.items() if not row[2]
+    })
+    if notebook_versions:
+        versions['notebooks'] = notebook_versions
+    return {'stats': stats, 'versions': versions}
+
+
+def cell_hash(cell):
+    return content_hash(json.dumps(cell, sort_keys=True, separators=(',', ':')))
+
+
+def split_notebooks(notebooks):
+    """
+    Normalise a `notebooks` payload to {name: (metadata, cells)}.
+
+    The payload is either a single notebook document (a dict with a `cells`
+    list) or a mapping of notebook name to document. `cells` is None for
+    documents without a cell list; they are stored whole in `metadata`.
+    """
+    if not isinstance(notebooks, dict) or isinstance(notebooks.get('cells'), list):
+        notebooks = {DEFAULT_NOTEBOOK: notebooks}
+
+    split = {}
+    for name, document in notebooks.items():
+        if isinstance(document, dict) and isinstance(document.get('cells'), list):
+            metadata = {key: value for key, value in document.items() if key != 'cells'}
+            split[str(name)[:255]] = (metadata, document['cells'])
+        else:
+            split[str(name)[:255]] = (document, None)
+    return split
+
+
+def save_notebooks(user, notebooks, stats, versions):
+    """
+    Store notebooks cell by cell, writing only cells whose content changed.
+
+    Notebooks missing from the payload are left alone. Returns True if
+    anything was written; fills `versions` with {name: version}.
+    """
+    documents = split_notebooks(notebooks)
+    existing = {
+        notebook.name: notebook
+        for notebook in Notebook.objects.filter(user=user, name__in=documents)
+    }
+    stored_hashes = {
+        (notebook_id, position): digest
+        for notebook_id, position, digest in NotebookCell.objects.filter(
+            notebook__in=existing.values()
+        ).values_list('notebook_id', 'position', 'content_hash')
+    }
+
+    changed = False
+    cell_writes = []
+    for name, (metadata, cells) in documents.items():
+        notebook = existing.get(name)
+        created = notebook is None
+        if created:
+            notebook = Notebook.objects.create(user=user, name=name)
+
+        writes = []
+        for position, cell in enumerate(cells or []):
+            digest = cell_hash(cell)
+            if stored_hashes.get((notebook.id, position)) != digest:
+                writes.append(NotebookCell(
+                    notebook=notebook, position=position, data=cell, content_hash=digest
+                ))
+
+        cell_count = len(cells or [])
+        has_cells = cells is not None
+        if notebook.cell_count > cell_count:
+            NotebookCell.objects.filter(notebook=notebook, position__gte=cell_count).delete()
+
+        if (created or writes or notebook.metadata != metadata
+                or notebook.cell_count != cell_count or notebook.has_cells != has_cells):
+            Notebook.objects.filter(pk=notebook.pk).update(
+                metadata=metadata,
+                has_cells=has_cells,
+                cell_count=cell_count,
+                version=F('version') + 1,
+                updated_at=timezone.now()
+            )
+            notebook.version += 1
+            changed = True
+            stats['created' if created else 'updated'] += 1
+        else:
+            stats['unchanged'] += 1
+        cell_writes.extend(writes)
+        versions[name] = notebook.version
+
+    if cell_writes:
+        NotebookCell.objects.bulk_create(
+            cell_writes,
+            update_conflicts=True,
+            unique_fields=['notebook', 'position'],
+            update_fields=['data', 'content_hash', 'updated_at']
+        )
+    return changed
+
+
+def bump_workspace_version(user_id):
+    """Invalidate the user's load_user_data ETag"""
+    UserProfile.objects.filter(user_id=user_id).update(workspace_version=F('workspace_version') + 1)
+
+
+def workspace_etag(request):
+    """ETag for the user's workspace snapshot; one query"""
+    version = UserProfile.objects.filter(user=request.user).values_list('workspace_version', flat=True).first()
+    return f'ws-{request.user.id}-{version or 0}'
+
+
+def load_workspace(user):
+    """Build the load_user_data payload from a single UNION query over the file and notebook tables"""
+    user_data = {
+        'currentCode': '',
+        'scripts': {},
+        'notebook_names': [],  # Notebook contents are fetched per notebook
+    }
+
+    code_files = PythonCodeSession.objects.filter(user=user).order_by().annotate(
+        kind=Value('code', output_field=CharField())
+    ).values_list('kind', 'filename', 'code_content')
+    data_files = UserFiles.objects.filter(user=user, is_system_file=False).order_by().annotate(
+        kind=Value('data', output_field=CharField())
+    ).values_list('kind', 'filename', 'content')
+
+    notebooks = Notebook.objects.filter(user=user).order_by().annotate(
+        kind=Value('notebook', output_field=CharField()),
+        content=Value('', output_field=TextField())
+    ).values_list('kind', 'name', 'content')
+
+    for kind, filename, content in code_files.union(data_files, notebooks, all=True):
+        if kind == 'data':
+            user_data['scripts'][data_file_key(filename)] = content
+        elif kind == 'notebook':
+            user_data['notebook_names'].append(filename)
+        elif filename == MAIN_FILE:
+            user_data['currentCode'] = content
+        elif not filename.endswith('.json'):
+            user_data['scripts'][code_file_key(filename)] = content
+    return user_data
+
+
+def default_system_file(filename, username):
+    """Content of a system file the user has not changed"""
+    return SYSTEM_FILES[filename][1].format(username=username)
+
+
+def system_file_contents(user):
+    """System file contents for `user`: the shared copy unless they saved their own; one query"""
+    overrides = dict(
+        UserFiles.objects.filter(user=user, filename__in=SYSTEM_FILES).values_list('filename', 'content')
+    )
+    return {
+        filename: overrides[filename] if filename in overrides else default_system_file(filename, user.username)
+        for filename in SYSTEM_FILES
+    }
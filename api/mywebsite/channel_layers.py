@@ -0,0 +1,117 @@
+"""
+Channel layer configuration for running more than one ASGI worker.
+
+`channel_layers_from_env()` builds settings.CHANNEL_LAYERS:
+
+    CHANNEL_LAYER_BACKEND      memory (default without Redis hosts), redis or sharded
+    CHANNEL_REDIS_URLS         comma-separated Redis URLs, one per shard (falls back to REDIS_URL)
+    CHANNEL_LAYER_PREFIX       key prefix, so several sites can share one Redis (default: asgi)
+    CHANNEL_LAYER_CAPACITY     messages a channel may hold before sends fail (default: 100)
+    CHANNEL_LAYER_CHANNEL_CAPACITY  per-channel overrides, e.g. "http.request=200,websocket.send*=50"
+    CHANNEL_LAYER_EXPIRY       seconds an undelivered message lives (default: 60)
+    CHANNEL_LAYER_GROUP_EXPIRY seconds a group membership lives without refresh (default: 86400)
+
+With several URLs the `sharded` backend (the default then) spreads channels
+and groups over the servers on a consistent-hash ring, so adding a shard
+only moves about 1/N of the keys.
+
+Groups, chat and presence then work across workers, but live collaborative
+documents (homepage.collab, homepage.ide_collab) are still held per process:
+route each session's / project's sockets to the same worker (sticky routing
+on the URL) when running several.
+"""
+import binascii
+import bisect
+import os
+
+from channels_redis.core import RedisChannelLayer
+
+VIRTUAL_NODES = 160  # Ring points per shard; more points spread keys more evenly
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that picks shards from a consistent-hash ring.
+
+    The stock layer maps a CRC onto `len(hosts)` equal slices, which moves
+    almost every key when a shard is added. It also hashes the full name of a
+    process-specific channel on send but only its `prefix!` part on receive;
+    here both use the non-local part so they always agree.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ring = sorted(
+            (_hash(f'{_host_key(host)}#{point}'), index)
+            for index, host in enumerate(self.hosts)
+            for point in range(VIRTUAL_NODES)
+        )
+        self._ring_points = [point for point, _ in self._ring]
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if '!' in value:
+            value = self.non_local_name(value)
+        position = bisect.bisect(self._ring_points, _hash(value)) % len(self._ring)
+        return self._ring[position][1]
+
+
+def _hash(value):
+    return binascii.crc32(value.encode('utf8'))
+
+
+def _host_key(host):
+    # Identify shards by address so the ring survives reordering the list
+    if isinstance(host, dict):
+        return host.get('address') or repr(sorted(host.items()))
+    return str(host)
+
+
+def _env_int(name, default):
+    value = os.getenv(name, '').strip()
+    return int(value) if value else default
+
+
+def _channel_capacity(value):
+    """Parse "pattern=capacity,..." into channels_redis' channel_capacity dict"""
+    capacities = {}
+    for item in value.split(','):
+        if '=' in item:
+            pattern, capacity = item.rsplit('=', 1)
+            capacities[pattern.strip()] = int(capacity)
+    return capacities
+
+
+def channel_layers_from_env():
+    """CHANNEL_LAYERS for the current environment (see module docstring)"""
+    urls = [url.strip() for url in os.getenv('CHANNEL_REDIS_URLS', os.getenv('REDIS_URL', '')).split(',') if url.strip()]
+    backend = os.getenv('CHANNEL_LAYER_BACKEND', '').strip().lower()
+    if not backend:
+        backend = 'memory' if not urls else 'sharded' if len(urls) > 1 else 'redis'
+
+    config = {
+        'capacity': _env_int('CHANNEL_LAYER_CAPACITY', 100),
+        'expiry': _env_int('CHANNEL_LAYER_EXPIRY', 60),
+        'group_expiry': _env_int('CHANNEL_LAYER_GROUP_EXPIRY', 86400),
+    }
+    channel_capacity = _channel_capacity(os.getenv('CHANNEL_LAYER_CHANNEL_CAPACITY', ''))
+    if channel_capacity:
+        config['channel_capacity'] = channel_capacity
+
+    if backend == 'memory':
+        return {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': config}}
+    if backend not in ('redis', 'sharded'):
+        raise ValueError(f'Unknown CHANNEL_LAYER_BACKEND {backend!r}')
+
+    config['hosts'] = urls or ['redis://localhost:6379']
+    config['prefix'] = os.getenv('CHANNEL_LAYER_PREFIX', 'asgi')
+    return {
+        'default': {
+            'BACKEND': (
+                'mywebsite.channel_layers.ShardedRedisChannelLayer' if backend == 'sharded'
+                else 'channels_redis.core.RedisChannelLayer'
+            ),
+            'CONFIG': config,
+        }
+    }
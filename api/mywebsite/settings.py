@@ -2,6 +2,8 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 
+from .channel_layers import channel_layers_from_env
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 load_dotenv(os.path.join(BASE_DIR.parent, '.env'))
@@ -72,21 +74,9 @@ WSGI_APPLICATION = 'mywebsite.wsgi.application'
 ASGI_APPLICATION = 'mywebsite.asgi.application'
 
 # Channels configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'  # Use Redis in production
-    }
-}
-
-# For production, use Redis:
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             "hosts": [os.getenv('REDIS_URL', 'redis://localhost:6379')],
-#         },
-#     },
-# }
+# In-memory by default (single worker). Set CHANNEL_REDIS_URLS (one URL per
+# shard) to fan out across workers; see mywebsite/channel_layers.py for tuning.
+CHANNEL_LAYERS = channel_layers_from_env()
 
 DATABASE_URL = os.getenv('DATABASE_URL')
 
@@ -220,3 +210,44 @@ LOGGING = {
 BLOB_READ_WRITE_TOKEN = os.getenv('BLOB_READ_WRITE_TOKEN', '')
 
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/django_auth')
+
+# Cloud IDE execution logs: buffered writes and per-project retention
+IDE_EXEC_LOG_BATCH_SIZE = int(os.getenv('IDE_EXEC_LOG_BATCH_SIZE', 50))
+# 0 writes each log with its request (the default on Vercel, where no process outlives it)
+IDE_EXEC_LOG_FLUSH_INTERVAL = float(os.getenv('IDE_EXEC_LOG_FLUSH_INTERVAL', 0 if IS_VERCEL else 5))  # seconds
+IDE_EXEC_LOG_KEEP_LAST = int(os.getenv('IDE_EXEC_LOG_KEEP_LAST', 500))  # raw logs kept per project
+IDE_EXEC_LOG_KEEP_DAYS = int(os.getenv('IDE_EXEC_LOG_KEEP_DAYS', 30))
+
+# Playground execution history: runs kept per user and stored field sizes
+EXECUTION_HISTORY_CAPACITY = int(os.getenv('EXECUTION_HISTORY_CAPACITY', 100))
+EXECUTION_HISTORY_MAX_CODE = int(os.getenv('EXECUTION_HISTORY_MAX_CODE', 10000))  # chars
+EXECUTION_HISTORY_MAX_OUTPUT = int(os.getenv('EXECUTION_HISTORY_MAX_OUTPUT', 5000))  # chars
+
+# Hot counters (e.g. SharedCode view/fork counts): logged hits are applied this often by a background thread,
+# this many per transaction; 0 applies each hit with its request instead of logging it
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', 10))  # seconds
+COUNTER_FLUSH_BATCH_SIZE = int(os.getenv('COUNTER_FLUSH_BATCH_SIZE', 5000))
+
+# Rendered public shared-code pages: server cache lifetime and CDN s-maxage
+SHARED_CODE_CACHE_TIMEOUT = int(os.getenv('SHARED_CODE_CACHE_TIMEOUT', 300))  # seconds
+
+# Entries kept per shared code discovery board (refresh_shared_code_rankings)
+SHARED_CODE_RANKING_SIZE = int(os.getenv('SHARED_CODE_RANKING_SIZE', 100))
+
+# Collaborative sessions: live state is written back this often, keeping this many ops for late transforms
+COLLAB_FLUSH_INTERVAL = float(os.getenv('COLLAB_FLUSH_INTERVAL', 2))  # seconds
+COLLAB_OPLOG_SIZE = int(os.getenv('COLLAB_OPLOG_SIZE', 200))
+COLLAB_ACTIVITY_INTERVAL = int(os.getenv('COLLAB_ACTIVITY_INTERVAL', 60))  # seconds between last_activity writes
+COLLAB_JOIN_TERMINAL_LINES = int(os.getenv('COLLAB_JOIN_TERMINAL_LINES', 100))  # terminal lines sent to a fresh join
+
+# Cursor/typing/status updates are coalesced into at most this many frames per second per WebSocket group
+PRESENCE_TICK_RATE = int(os.getenv('PRESENCE_TICK_RATE', 10))
+
+# Binary (pycomp.msgpack.v1) WebSocket frames with bodies above this many bytes are zlib-compressed
+WIRE_COMPRESS_THRESHOLD = int(os.getenv('WIRE_COMPRESS_THRESHOLD', 1024))
+
+# Gateway sockets: a dropped session can be resumed this long, replaying at most this many missed events
+GATEWAY_RESUME_TIMEOUT = int(os.getenv('GATEWAY_RESUME_TIMEOUT', 300))  # seconds
+GATEWAY_REPLAY_SIZE = int(os.getenv('GATEWAY_REPLAY_SIZE', 500))
+# An open gateway socket keeps its user online this long after its last heartbeat (covers crashed workers)
+GATEWAY_CONNECTION_TIMEOUT = int(os.getenv('GATEWAY_CONNECTION_TIMEOUT', 120))  # seconds